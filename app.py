@@ -3,18 +3,34 @@
 功能：验证码验证、图片上传、API调用、使用次数管理
 """
 
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, Response
+from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import sqlite3
 import os
 import random
 import string
 import requests
-from datetime import datetime
+from datetime import datetime, timezone
 import json
+import csv
+import zlib
 import sys
 import time
+import traceback
 import io
+import threading
+import queue
+import atexit
+import uuid
+import socket
+from collections import deque, OrderedDict
+import re
+import base64
+import hashlib
+import shutil
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import bulk_codes
 
 # Windows 控制台编码修复
 if sys.platform == 'win32':
@@ -65,7 +81,8 @@ POSTGRES_AVAILABLE = False
 if db_type == 'postgresql':
     try:
         import psycopg2
-        from psycopg2.extras import RealDictCursor
+        import psycopg2.pool
+        from psycopg2.extras import RealDictCursor, execute_values
         POSTGRES_AVAILABLE = True
     except ImportError:
         print("警告: psycopg2 未安装，将回退到 SQLite")
@@ -77,6 +94,44 @@ if db_type == 'postgresql':
         else:
             db_config = 'codes.db'
 
+# 唯一约束冲突异常（两种数据库驱动）
+DB_INTEGRITY_ERRORS = (sqlite3.IntegrityError, psycopg2.IntegrityError) if POSTGRES_AVAILABLE else (sqlite3.IntegrityError,)
+
+# 数据库连接池配置
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))                             # PostgreSQL 连接池保持的最少连接数
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))                            # PostgreSQL 连接池最大连接数（每个进程）
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))                  # 连接池耗尽时最多等待的时间（秒）
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv('DB_POOL_HEALTHCHECK_IDLE', '30'))  # 空闲超过该时间（秒）的连接取出时先检查可用性
+
+# SQLite 并发配置（建立连接时设置）
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL').upper()          # WAL 模式下读写互不阻塞
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()         # WAL 模式下 NORMAL 即可保证数据库不损坏
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))            # 遇到写锁时最多等待的时间（毫秒）
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '16384'))               # 每个连接的页缓存大小（KB）
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))  # 内存映射读取的大小（字节，0 表示关闭）
+SQLITE_CHECKPOINT_INTERVAL = int(os.getenv('SQLITE_CHECKPOINT_INTERVAL', '300'))  # WAL 检查点间隔（秒，0 表示只依赖自动检查点）
+
+# 审计日志（生成记录、验证尝试）批量写入配置
+AUDIT_LOG_ASYNC = os.getenv('AUDIT_LOG_ASYNC', 'true').lower() == 'true'          # false 时在请求中同步写入
+AUDIT_LOG_BATCH_SIZE = int(os.getenv('AUDIT_LOG_BATCH_SIZE', '100'))               # 攒够多少条立即写入
+AUDIT_LOG_FLUSH_INTERVAL = float(os.getenv('AUDIT_LOG_FLUSH_INTERVAL', '0.5'))     # 最长写入间隔（秒）
+AUDIT_LOG_MAX_BUFFER = int(os.getenv('AUDIT_LOG_MAX_BUFFER', '10000'))             # 数据库不可用时最多缓冲的记录数
+AUDIT_LOG_DROP_POLICY = os.getenv('AUDIT_LOG_DROP_POLICY', 'drop_oldest')          # 缓冲区满时: drop_oldest / drop_newest
+
+# 验证码缓存配置（每个进程独立，其它 worker 的修改在 TTL 后生效）
+CODE_CACHE_TTL = float(os.getenv('CODE_CACHE_TTL', '10'))                    # 验证码记录缓存时间（秒，0 表示不缓存）
+CODE_CACHE_NEGATIVE_TTL = float(os.getenv('CODE_CACHE_NEGATIVE_TTL', '2'))   # 不存在的验证码缓存时间（秒）
+CODE_CACHE_MAX_ENTRIES = int(os.getenv('CODE_CACHE_MAX_ENTRIES', '10000'))  # 最多缓存的验证码数量（按最近使用淘汰）
+CODE_STATS_RECONCILE_INTERVAL = int(os.getenv('CODE_STATS_RECONCILE_INTERVAL', '3600'))  # 统计计数器对账间隔（秒，0 表示不对账）
+
+# 导出配置
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))  # 导出时每批从数据库读取并写出的行数
+
+# 管理后台批量生成验证码
+CODE_GENERATION_SYNC_LIMIT = int(os.getenv('CODE_GENERATION_SYNC_LIMIT', '1000'))    # 不超过该数量时在请求中直接生成，否则转为后台任务
+CODE_GENERATION_MAX_COUNT = int(os.getenv('CODE_GENERATION_MAX_COUNT', '1000000'))   # 单次最多生成数量
+CODE_GENERATION_BATCH_SIZE = int(os.getenv('CODE_GENERATION_BATCH_SIZE', '5000'))    # 每批写入（并提交）的数量
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = upload_folder
 app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 5 * 1024 * 1024))  # 5MB max file size
@@ -105,16 +160,72 @@ if HTTPS_PROXY:
 CONNECT_TIMEOUT = int(os.getenv('CONNECT_TIMEOUT', '10'))  # 连接超时
 READ_TIMEOUT = int(os.getenv('READ_TIMEOUT', '120'))       # 读取超时
 
-# 断路器配置
-CIRCUIT_BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', '5'))  # 失败次数阈值
+# 上游连接池配置
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '10'))                   # 每个上游地址的最大保持连接数
+UPSTREAM_POOL_IDLE_TIMEOUT = int(os.getenv('UPSTREAM_POOL_IDLE_TIMEOUT', '55'))   # 空闲连接回收时间（秒）
+
+# 上游限流配置（令牌桶，按服务商 + API Key 区分）
+UPSTREAM_RATE_LIMIT = float(os.getenv('UPSTREAM_RATE_LIMIT', '0'))        # 每分钟最多请求数（0 表示不限制）
+UPSTREAM_RATE_BURST = int(os.getenv('UPSTREAM_RATE_BURST', '5'))          # 允许的突发请求数
+UPSTREAM_RATE_LIMITS = os.getenv('UPSTREAM_RATE_LIMITS', '')              # 按服务商覆盖，如 "12ai=60/10,laozhang=20/5"
+UPSTREAM_RATE_MAX_WAIT = float(os.getenv('UPSTREAM_RATE_MAX_WAIT', '60')) # 单次生成最多排队等待配额的时间（秒）
+UPSTREAM_THROTTLE_PAUSE = float(os.getenv('UPSTREAM_THROTTLE_PAUSE', '10'))  # 429 未给出 Retry-After 时的暂停时间（秒）
+
+# 生成截止时间配置（从上传开始计算，排队、上游请求、重试和结果下载共用同一预算）
+GENERATION_DEADLINE = float(os.getenv('GENERATION_DEADLINE', '240'))     # 单次生成的总时间预算（秒）
+DEADLINE_MIN_ATTEMPT = float(os.getenv('DEADLINE_MIN_ATTEMPT', '15'))    # 剩余预算少于该值时不再发起重试/对冲（秒）
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', '2'))       # 网络错误和 500/502/504 的最大重试次数
+UPSTREAM_RETRY_BACKOFF = float(os.getenv('UPSTREAM_RETRY_BACKOFF', '1')) # 重试退避基数（秒），按 1、2、4... 倍递增
+
+# 异步生成任务配置
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', '2'))          # 初始并发生成数（0 表示本进程不执行任务）
+GENERATION_QUEUE_SIZE = int(os.getenv('GENERATION_QUEUE_SIZE', '20'))   # 最大排队任务数
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', '3600'))               # 已完成任务保留时间（秒）
+JOB_LONG_POLL_MAX = int(os.getenv('JOB_LONG_POLL_MAX', '25'))           # 任务状态长轮询最长等待（秒）
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '2'))          # 工作线程轮询数据库队列的间隔（秒）
+JOB_HEARTBEAT_INTERVAL = int(os.getenv('JOB_HEARTBEAT_INTERVAL', '10')) # 运行中任务的心跳间隔（秒）
+JOB_STALE_TIMEOUT = int(os.getenv('JOB_STALE_TIMEOUT', '60'))           # 心跳超时后视为孤儿任务（秒）
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))              # 孤儿任务最多重新执行次数
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '600'))              # 重复提交返回已完成结果的有效期（秒）
+
+# 自适应并发限制（AIMD）：上游变慢或出错时减少同时生成的任务数，恢复后逐步增加
+CONCURRENCY_MIN_LIMIT = int(os.getenv('CONCURRENCY_MIN_LIMIT', '1'))                   # 并发下限
+CONCURRENCY_MAX_LIMIT = int(os.getenv('CONCURRENCY_MAX_LIMIT', '8'))                   # 并发上限（同时创建这么多工作线程，由自适应限制决定实际并发）
+CONCURRENCY_TARGET_LATENCY = float(os.getenv('CONCURRENCY_TARGET_LATENCY', '90'))     # 超过该耗时（秒）视为过载信号
+CONCURRENCY_BACKOFF = float(os.getenv('CONCURRENCY_BACKOFF', '0.7'))                  # 过载时并发限制的乘性降低系数
+
+# 上传图片预处理配置（发送给上游之前压缩，减少传输和 base64 开销）
+PREPROCESS_ENABLED = os.getenv('PREPROCESS_ENABLED', 'true').lower() == 'true'
+PREPROCESS_MAX_EDGE = int(os.getenv('PREPROCESS_MAX_EDGE', '1536'))     # 长边最大像素
+PREPROCESS_FORMAT = os.getenv('PREPROCESS_FORMAT', 'jpeg').lower()      # jpeg 或 webp
+PREPROCESS_QUALITY = int(os.getenv('PREPROCESS_QUALITY', '88'))         # 编码质量
+PREPROCESS_CROP = os.getenv('PREPROCESS_CROP', 'true').lower() == 'true'  # 是否裁剪为 3:4 竖版
+
+# 生成结果缓存配置（相同的预处理图片 + 相同选项直接返回已生成的结果，不再调用上游）
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))  # 缓存文件总大小上限
+
+# 多线路路由配置（12ai 的 CDN/香港线路之间按延迟自动选择）
+ROUTING_ENABLED = os.getenv('ROUTING_ENABLED', 'true').lower() == 'true'
+ROUTING_PROBE_INTERVAL = int(os.getenv('ROUTING_PROBE_INTERVAL', '60'))         # 探测间隔（秒）
+ROUTING_EWMA_ALPHA = float(os.getenv('ROUTING_EWMA_ALPHA', '0.3'))              # EWMA 平滑系数
+ROUTING_MAX_ERROR_RATE = float(os.getenv('ROUTING_MAX_ERROR_RATE', '0.5'))      # 错误率超过该值视为不健康
+
+# 对冲请求配置（慢请求超过近期延迟分位数后，向另一条线路再发一次，取先完成者）
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '0.9'))             # 触发对冲的延迟分位数
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))              # 样本不足时不对冲
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '15'))                # 对冲等待时间下限（秒）
+HEDGE_BUDGET_PER_MINUTE = int(os.getenv('HEDGE_BUDGET_PER_MINUTE', '2'))   # 每分钟最多对冲次数
+
+# 断路器配置（每个上游线路一个断路器）
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', '5'))  # 统计窗口内至少失败多少次才可能打开
 CIRCUIT_BREAKER_TIMEOUT = int(os.getenv('CIRCUIT_BREAKER_TIMEOUT', '60'))     # 断路器恢复时间（秒）
-
-# 断路器状态
-circuit_breaker = {
-    'failures': 0,
-    'last_failure_time': None,
-    'open': False
-}
+CIRCUIT_BREAKER_WINDOW = int(os.getenv('CIRCUIT_BREAKER_WINDOW', '60'))       # 失败率统计窗口（秒）
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv('CIRCUIT_BREAKER_FAILURE_RATE', '0.5'))  # 窗口内失败率阈值
+CIRCUIT_BREAKER_HALF_OPEN_REQUESTS = int(os.getenv('CIRCUIT_BREAKER_HALF_OPEN_REQUESTS', '2'))  # 半开状态的试探请求数
+# 多个 worker 共享断路器状态的 SQLite 文件（为空则每个进程独立）
+CIRCUIT_BREAKER_SHARED_PATH = os.getenv('CIRCUIT_BREAKER_SHARED_PATH', '')
 
 # API 基础 URL 配置（支持环境变量覆盖）
 API_BASE_URLS = {
@@ -194,6 +305,17 @@ else:
     NANOBANANA_API_URL = f"{base_url}/chat/completions"
     API_FORMAT = 'openai'
 
+
+def build_api_url(line_base_url):
+    """按当前 API_FORMAT 为指定线路构建完整的 API URL（多线路路由使用）"""
+    clean_line_url = line_base_url.rstrip('/').rstrip('/v1')
+    if API_FORMAT == 'gemini':
+        return f"{clean_line_url}/v1beta/models/{MODEL_NAME}:generateContent"
+    if is_gemini_model:
+        return f"{clean_line_url}/v1/chat/completions"
+    return f"{line_base_url}/chat/completions"
+
+
 # 管理后台认证配置
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
@@ -223,147 +345,1133 @@ if PROXIES:
     print(f"🔀 代理配置: {PROXIES}")
 else:
     print(f"🔀 代理配置: 未配置（直连）")
-print(f"🔌 断路器阈值: {CIRCUIT_BREAKER_THRESHOLD}次, 恢复时间: {CIRCUIT_BREAKER_TIMEOUT}秒")
+print(f"🔗 上游连接池: 每线路 {UPSTREAM_POOL_SIZE} 个连接, 空闲回收 {UPSTREAM_POOL_IDLE_TIMEOUT}秒")
+print(f"🧵 生成任务: 初始并发 {GENERATION_WORKERS}, 自适应上限 {max(CONCURRENCY_MAX_LIMIT, GENERATION_WORKERS)}, 队列上限 {GENERATION_QUEUE_SIZE}")
+print(f"🔌 断路器阈值: {CIRCUIT_BREAKER_WINDOW}秒内失败 {CIRCUIT_BREAKER_THRESHOLD} 次且失败率 ≥ {CIRCUIT_BREAKER_FAILURE_RATE:.0%}, "
+      f"恢复时间: {CIRCUIT_BREAKER_TIMEOUT}秒, 共享状态: {CIRCUIT_BREAKER_SHARED_PATH or '否'}")
 print("=" * 70)
 
 from functools import wraps
 
 # ==================== 断路器机制 ====================
 
-def check_circuit_breaker():
-    """检查断路器状态，如果断路器打开则返回 False"""
-    now = time.time()
+def _initial_breaker_state():
+    return {'state': 'closed', 'opened_at': None, 'half_open_at': None, 'trials': 0, 'successes': 0}
 
-    if circuit_breaker['open']:
-        # 检查是否可以尝试恢复
-        if now - circuit_breaker['last_failure_time'] > CIRCUIT_BREAKER_TIMEOUT:
-            print("[断路器] 尝试恢复服务...")
-            circuit_breaker['open'] = False
-            circuit_breaker['failures'] = 0
-            return True
-        else:
-            remaining_time = int(CIRCUIT_BREAKER_TIMEOUT - (now - circuit_breaker['last_failure_time']))
-            print(f"[断路器] 服务暂时不可用，请 {remaining_time} 秒后重试")
+
+class LocalBreakerStore:
+    """进程内断路器状态存储"""
+
+    def __init__(self):
+        self._states = {}
+
+    def update(self, endpoint, fn):
+        state = self._states.setdefault(endpoint, _initial_breaker_state())
+        return fn(state)
+
+    def load(self, endpoint):
+        return dict(self._states.get(endpoint) or _initial_breaker_state())
+
+
+class SQLiteBreakerStore:
+    """
+    基于本地 SQLite 文件的断路器状态存储
+
+    同一台机器上的多个 gunicorn worker 共享同一个文件，任一 worker 打开断路器后其他 worker 立即生效；
+    状态变更在 BEGIN IMMEDIATE 事务中完成，半开状态的试探名额在所有 worker 之间共享。
+    """
+
+    COLUMNS = ('state', 'opened_at', 'half_open_at', 'trials', 'successes')
+
+    def __init__(self, path):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS circuit_breakers (
+                    endpoint TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    opened_at REAL,
+                    half_open_at REAL,
+                    trials INTEGER NOT NULL DEFAULT 0,
+                    successes INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def _read(self, conn, endpoint):
+        row = conn.execute(
+            'SELECT state, opened_at, half_open_at, trials, successes FROM circuit_breakers WHERE endpoint = ?',
+            (endpoint,)
+        ).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else _initial_breaker_state()
+
+    def update(self, endpoint, fn):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            state = self._read(conn, endpoint)
+            before = dict(state)
+            result = fn(state)
+            if state != before:
+                conn.execute(
+                    'INSERT OR REPLACE INTO circuit_breakers (endpoint, state, opened_at, half_open_at, trials, successes) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (endpoint,) + tuple(state[column] for column in self.COLUMNS)
+                )
+            conn.execute('COMMIT')
+            return result
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def load(self, endpoint):
+        conn = self._connect()
+        try:
+            return self._read(conn, endpoint)
+        finally:
+            conn.close()
+
+
+class CircuitBreaker:
+    """
+    单个上游线路的断路器
+
+    - closed: 正常放行，统计窗口内失败次数和失败率同时超过阈值时打开
+    - open: 拒绝请求，CIRCUIT_BREAKER_TIMEOUT 秒后进入半开状态
+    - half_open: 只放行 CIRCUIT_BREAKER_HALF_OPEN_REQUESTS 个试探请求，全部成功后关闭，任一失败重新打开
+    失败率窗口按进程统计；状态本身可通过 SQLiteBreakerStore 在多个 worker 之间共享。
+    """
+
+    def __init__(self, endpoint, store):
+        self.endpoint = endpoint
+        self._store = store
+        self._fallback_store = LocalBreakerStore()
+        self._lock = threading.Lock()
+        self._events = deque()  # (时间戳, 是否成功)
+        self.rejections = 0
+
+    def _update(self, fn):
+        with self._lock:
+            try:
+                return self._store.update(self.endpoint, fn)
+            except sqlite3.Error as e:
+                # 共享状态不可用时退回进程内状态，断路器本身不能成为故障点
+                print(f"[断路器] 共享状态读写失败，使用进程内状态: {e}")
+                return self._fallback_store.update(self.endpoint, fn)
+
+    def _trim_window(self, now):
+        while self._events and now - self._events[0][0] > CIRCUIT_BREAKER_WINDOW:
+            self._events.popleft()
+
+    def _window_counts(self, now):
+        self._trim_window(now)
+        failures = sum(1 for _, ok in self._events if not ok)
+        return len(self._events), failures
+
+    def allow_request(self):
+        """
+        是否放行请求，返回 (allowed, retry_after_seconds, trial)
+
+        trial 为 True 表示占用了半开状态的试探名额：请求结束时必须调用 record_success/record_failure，
+        没有结果（例如 429、被取消）时调用 release_trial 归还名额。
+        """
+        now = time.time()
+
+        def decide(state):
+            if state['state'] == 'open':
+                elapsed = now - (state['opened_at'] or now)
+                if elapsed < CIRCUIT_BREAKER_TIMEOUT:
+                    return False, int(CIRCUIT_BREAKER_TIMEOUT - elapsed) + 1, False
+                print(f"[断路器] {self.endpoint} 进入半开状态，开始试探...")
+                state.update(state='half_open', half_open_at=now, trials=0, successes=0)
+            if state['state'] == 'half_open':
+                # 试探请求长时间没有结果（例如被取消）时重新分配试探名额
+                if state['trials'] >= CIRCUIT_BREAKER_HALF_OPEN_REQUESTS and \
+                        now - (state['half_open_at'] or now) > CIRCUIT_BREAKER_TIMEOUT:
+                    state.update(half_open_at=now, trials=0, successes=0)
+                if state['trials'] >= CIRCUIT_BREAKER_HALF_OPEN_REQUESTS:
+                    return False, 1, False
+                state['trials'] += 1
+                return True, 0, True
+            return True, 0, False
+
+        allowed, retry_after, trial = self._update(decide)
+        if not allowed:
+            with self._lock:
+                self.rejections += 1
+            print(f"[断路器] {self.endpoint} 服务暂时不可用，请 {retry_after} 秒后重试")
+        return allowed, retry_after, trial
+
+    def release_trial(self):
+        """归还没有结果的试探请求占用的名额（仍处于半开状态时），让其它请求继续试探"""
+        def apply(state):
+            if state['state'] == 'half_open' and state['trials'] > state['successes']:
+                state['trials'] -= 1
+
+        self._update(apply)
+
+    def record_success(self):
+        now = time.time()
+        with self._lock:
+            self._events.append((now, True))
+            # 成功时也清理窗口外的记录，否则持续成功时队列会无限增长
+            self._trim_window(now)
+
+        def apply(state):
+            if state['state'] == 'half_open':
+                state['successes'] += 1
+                if state['successes'] >= CIRCUIT_BREAKER_HALF_OPEN_REQUESTS:
+                    print(f"[断路器] {self.endpoint} 服务已恢复，断路器已关闭")
+                    state.update(_initial_breaker_state())
+                    return True
             return False
 
-    return True
+        if self._update(apply):
+            with self._lock:
+                self._events.clear()
+
+    def record_failure(self):
+        now = time.time()
+        with self._lock:
+            self._events.append((now, False))
+            total, failures = self._window_counts(now)
+
+        def apply(state):
+            if state['state'] == 'half_open':
+                print(f"[断路器] {self.endpoint} 试探请求失败，断路器重新打开")
+                state.update(state='open', opened_at=now, trials=0, successes=0)
+            elif state['state'] == 'closed' and failures >= CIRCUIT_BREAKER_THRESHOLD \
+                    and failures / total >= CIRCUIT_BREAKER_FAILURE_RATE:
+                print(f"[断路器] {self.endpoint} {CIRCUIT_BREAKER_WINDOW} 秒内失败 {failures}/{total} 次，断路器已打开")
+                state.update(state='open', opened_at=now, trials=0, successes=0)
+
+        self._update(apply)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            total, failures = self._window_counts(now)
+            rejections = self.rejections
+            try:
+                state = self._store.load(self.endpoint)
+            except sqlite3.Error:
+                state = self._fallback_store.load(self.endpoint)
+        return {
+            'endpoint': self.endpoint,
+            'state': state['state'],
+            'open': state['state'] != 'closed',
+            'opened_at': state['opened_at'],
+            'window_requests': total,
+            'window_failures': failures,
+            'rejections': rejections
+        }
+
+
+class CircuitBreakerRegistry:
+    """按上游源站（scheme://host:port）管理断路器"""
+
+    def __init__(self, shared_path=''):
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self.shared_path = shared_path
+        self._store = None
+
+    def _get_store(self):
+        if self._store is None:
+            if self.shared_path:
+                try:
+                    self._store = SQLiteBreakerStore(self.shared_path)
+                except sqlite3.Error as e:
+                    print(f"[断路器] 无法打开共享状态文件 {self.shared_path}，使用进程内状态: {e}")
+                    self._store = LocalBreakerStore()
+            else:
+                self._store = LocalBreakerStore()
+        return self._store
+
+    def get(self, url):
+        parts = urlsplit(url)
+        endpoint = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(endpoint, self._get_store())
+                self._breakers[endpoint] = breaker
+            return breaker
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {
+            'threshold': CIRCUIT_BREAKER_THRESHOLD,
+            'failure_rate': CIRCUIT_BREAKER_FAILURE_RATE,
+            'window': CIRCUIT_BREAKER_WINDOW,
+            'timeout': CIRCUIT_BREAKER_TIMEOUT,
+            'half_open_requests': CIRCUIT_BREAKER_HALF_OPEN_REQUESTS,
+            'shared': bool(self.shared_path),
+            'endpoints': [breaker.snapshot() for breaker in breakers]
+        }
+
+
+circuit_breakers = CircuitBreakerRegistry(CIRCUIT_BREAKER_SHARED_PATH)
+
+
+# ==================== 上游 HTTP 连接池 ====================
+
+class UpstreamClient:
+    """
+    进程级上游 HTTP 客户端
+
+    每个上游地址（scheme + host）共享一个 requests.Session 及其连接池，
+    生成请求之间复用 keep-alive 连接，避免每次都重新进行 TCP + TLS 握手。
+    Session 的创建和空闲回收由锁保护，可在 gunicorn 多线程间安全复用。
+    """
+
+    def __init__(self, pool_size=10, idle_timeout=55):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._sessions = {}  # {origin: {'session': Session, 'adapter': HTTPAdapter, 'last_used': timestamp}}
+        # 已回收连接池的历史计数（连接池被清空后计数会丢失，这里累加保存）
+        self._retired = {'requests': 0, 'new_connections': 0}
+        self._idle_evictions = 0
+
+    def _create_entry(self):
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        # 不使用 urllib3 的自动重试：重试由 _send_with_retries 按生成截止时间控制，
+        # 429/503 由 UpstreamRateLimiter 按 Retry-After 暂停派发后重新排队
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=False,
+            max_retries=0
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return {'session': session, 'adapter': adapter, 'last_used': time.time()}
+
+    @staticmethod
+    def _pool_counters(adapter):
+        """汇总 adapter 下所有 urllib3 连接池的请求数和新建连接数"""
+        total_requests = 0
+        new_connections = 0
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            total_requests += pool.num_requests
+            new_connections += pool.num_connections
+        return total_requests, new_connections
+
+    def _session_for(self, url):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        now = time.time()
+
+        with self._lock:
+            entry = self._sessions.get(origin)
+            if entry is None:
+                entry = self._create_entry()
+                self._sessions[origin] = entry
+            elif now - entry['last_used'] > self.idle_timeout:
+                # 空闲过久的连接大概率已被服务端关闭，主动回收避免复用失效连接
+                total_requests, new_connections = self._pool_counters(entry['adapter'])
+                self._retired['requests'] += total_requests
+                self._retired['new_connections'] += new_connections
+                entry['adapter'].poolmanager.clear()
+                self._idle_evictions += 1
+                print(f"[连接池] {origin} 空闲超过 {self.idle_timeout} 秒，已回收连接")
+            entry['last_used'] = now
+            return entry['session']
+
+    def post(self, url, **kwargs):
+        return self._session_for(url).post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self._session_for(url).get(url, **kwargs)
+
+    def get_stats(self):
+        """返回连接池统计（复用命中、新建连接、空闲回收）"""
+        with self._lock:
+            total_requests = self._retired['requests']
+            new_connections = self._retired['new_connections']
+            origins = {}
+            now = time.time()
+            for origin, entry in self._sessions.items():
+                origin_requests, origin_connections = self._pool_counters(entry['adapter'])
+                total_requests += origin_requests
+                new_connections += origin_connections
+                origins[origin] = {
+                    'requests': origin_requests,
+                    'new_connections': origin_connections,
+                    'idle_seconds': round(now - entry['last_used'], 1)
+                }
+
+            return {
+                'pool_size': self.pool_size,
+                'idle_timeout': self.idle_timeout,
+                'requests': total_requests,
+                'hits': max(total_requests - new_connections, 0),
+                'new_connections': new_connections,
+                'idle_evictions': self._idle_evictions,
+                'origins': origins
+            }
+
+
+# 进程级共享的上游客户端
+upstream_client = UpstreamClient(UPSTREAM_POOL_SIZE, UPSTREAM_POOL_IDLE_TIMEOUT)
+
+
+# ==================== 上游限流 ====================
+
+def _parse_rate_limits(spec):
+    """解析 "provider=每分钟请求数/突发数" 列表，返回 {provider: (rate, burst)}"""
+    limits = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        provider, value = item.split('=', 1)
+        rate, _, burst = value.partition('/')
+        try:
+            limits[provider.strip()] = (float(rate), int(burst) if burst else UPSTREAM_RATE_BURST)
+        except ValueError:
+            print(f"[限流] 忽略无效的限流配置: {item}")
+    return limits
+
+
+def _parse_retry_after(value):
+    """解析 Retry-After（秒数或 HTTP 日期），返回等待秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamRateLimiter:
+    """
+    进程级上游令牌桶限流
+
+    每个（服务商, API Key）一个令牌桶，所有生成请求（包括对冲请求）共享。
+    上游返回 429/503 时读取 Retry-After 或限流响应头，在窗口重新开放前暂停该桶的全部派发，
+    等待中的请求排队，而不是各自立即重试。
+    """
+
+    def __init__(self, default_rate, default_burst, overrides=None):
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.overrides = overrides or {}
+        self._cond = threading.Condition()
+        self._buckets = {}
+
+    def _bucket(self, key, provider):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = self.overrides.get(provider, (self.default_rate, self.default_burst))
+            bucket = {
+                'provider': provider,
+                'rate': rate / 60.0,       # 每秒补充的令牌数
+                'burst': max(burst, 1),
+                'tokens': float(max(burst, 1)),
+                'updated_at': time.time(),
+                'paused_until': 0,
+                'waiting': 0,
+                'requests': 0,
+                'throttled': 0,
+                'timeouts': 0
+            }
+            self._buckets[key] = bucket
+        return bucket
+
+    def acquire(self, key, provider, timeout, cancel_event=None):
+        """等待一个令牌，超时或被取消时返回 False"""
+        deadline = time.time() + max(timeout, 0)
+        with self._cond:
+            bucket = self._bucket(key, provider)
+            bucket['waiting'] += 1
+            try:
+                while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return False
+                    now = time.time()
+                    if bucket['rate'] > 0:
+                        bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['updated_at']) * bucket['rate'])
+                    bucket['updated_at'] = now
+
+                    if now < bucket['paused_until']:
+                        wait = bucket['paused_until'] - now
+                    elif bucket['rate'] <= 0 or bucket['tokens'] >= 1:
+                        if bucket['rate'] > 0:
+                            bucket['tokens'] -= 1
+                        bucket['requests'] += 1
+                        return True
+                    else:
+                        wait = (1 - bucket['tokens']) / bucket['rate']
+
+                    # 剩余时间不够等到下一个令牌/窗口开放时直接放弃，不白白占用工作线程
+                    remaining = deadline - now
+                    if wait > remaining:
+                        bucket['timeouts'] += 1
+                        return False
+                    # 最多等待 1 秒后重新检查，以便及时响应取消
+                    self._cond.wait(min(wait, remaining, 1.0))
+            finally:
+                bucket['waiting'] -= 1
+
+    def observe(self, key, provider, response):
+        """
+        根据响应头更新限流状态，返回需要暂停派发的秒数（0 表示无需暂停）
+
+        - 429/503 的 Retry-After
+        - X-RateLimit-Remaining 为 0 时的 X-RateLimit-Reset / RateLimit-Reset
+        """
+        headers = response.headers
+        delay = None
+        if response.status_code in (429, 503):
+            delay = _parse_retry_after(headers.get('Retry-After'))
+
+        remaining = headers.get('X-RateLimit-Remaining') or headers.get('RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset') or headers.get('RateLimit-Reset')
+        if delay is None and reset and (response.status_code == 429 or remaining == '0'):
+            try:
+                reset_value = float(reset)
+                # 大于 10 年的秒数视为 Unix 时间戳，否则为剩余秒数
+                delay = max(reset_value - time.time(), 0) if reset_value > 315360000 else reset_value
+            except ValueError:
+                delay = None
+
+        if delay is None and response.status_code == 429:
+            delay = UPSTREAM_THROTTLE_PAUSE
+        if not delay:
+            return 0
+
+        with self._cond:
+            bucket = self._bucket(key, provider)
+            bucket['paused_until'] = max(bucket['paused_until'], time.time() + delay)
+            if response.status_code in (429, 503):
+                bucket['throttled'] += 1
+            self._cond.notify_all()
+        print(f"[限流] {provider} 上游限流（HTTP {response.status_code}），暂停派发 {delay:.1f} 秒")
+        return delay
+
+    def get_stats(self):
+        now = time.time()
+        with self._cond:
+            return {
+                'max_wait': UPSTREAM_RATE_MAX_WAIT,
+                'buckets': [{
+                    'provider': bucket['provider'],
+                    'rate_per_minute': round(bucket['rate'] * 60, 2),
+                    'burst': bucket['burst'],
+                    'tokens': round(bucket['tokens'], 2),
+                    'paused_for': round(max(bucket['paused_until'] - now, 0), 1),
+                    'waiting': bucket['waiting'],
+                    'requests': bucket['requests'],
+                    'throttled': bucket['throttled'],
+                    'timeouts': bucket['timeouts']
+                } for bucket in self._buckets.values()]
+            }
+
+
+def upstream_rate_key():
+    """限流桶标识：服务商 + API Key 摘要（不保存 Key 明文）"""
+    key_digest = hashlib.sha256(NANOBANANA_API_KEY.encode()).hexdigest()[:12]
+    return f"{API_PROVIDER}:{key_digest}"
+
+
+upstream_limiter = UpstreamRateLimiter(UPSTREAM_RATE_LIMIT, UPSTREAM_RATE_BURST, _parse_rate_limits(UPSTREAM_RATE_LIMITS))
+
+
+# ==================== 多线路路由 ====================
+
+# 可在其间路由的 12ai 线路
+ROUTABLE_PROVIDERS = ('12ai', '12ai-cdn', '12ai-hk')
+
 
+class EndpointRouter:
+    """
+    上游线路路由
+
+    为每条线路维护延迟和错误率的 EWMA：后台线程定期用轻量请求（GET /models）探测所有线路，
+    真实生成请求的结果也计入错误率和生成延迟。每次生成选择当前健康线路中预计耗时
+    （探测延迟 + 生成延迟）最低的一条。
+    """
+
+    def __init__(self, lines, default_name):
+        self.default_name = default_name
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._endpoints = {}
+        for name, line_base_url in lines:
+            self._endpoints[name] = {
+                'name': name,
+                'base_url': line_base_url,
+                'api_url': NANOBANANA_API_URL if name == default_name else build_api_url(line_base_url),
+                'latency_ewma': None,          # 探测延迟（秒）
+                'request_latency_ewma': None,  # 生成请求延迟（秒）
+                'error_rate': 0.0,
+                'requests': 0,
+                'errors': 0,
+                'probes': 0,
+                'last_probe_at': None,
+                'last_error': None
+            }
+
+    def _ewma(self, previous, sample):
+        if previous is None:
+            return sample
+        return ROUTING_EWMA_ALPHA * sample + (1 - ROUTING_EWMA_ALPHA) * previous
+
+    def _is_healthy(self, endpoint):
+        return endpoint['error_rate'] < ROUTING_MAX_ERROR_RATE
+
+    def _rank_key(self):
+        """
+        返回线路排序函数：健康线路优先，其次按预计耗时（探测延迟 + 生成延迟）
+
+        还没有生成请求记录的线路按其它线路生成延迟的平均值计算，既不因为没有数据被优先选中，
+        也不会一直得不到流量。没有探测数据的线路排在最后。
+        """
+        known = [e['request_latency_ewma'] for e in self._endpoints.values() if e['request_latency_ewma'] is not None]
+        default_request_latency = sum(known) / len(known) if known else 0.0
+
+        def rank(endpoint):
+            latency = endpoint['latency_ewma']
+            request_latency = endpoint['request_latency_ewma']
+            if request_latency is None:
+                request_latency = default_request_latency
+            return (
+                not self._is_healthy(endpoint),
+                latency + request_latency if latency is not None else float('inf'),
+                endpoint['name'] != self.default_name
+            )
+        return rank
+
+    def pick(self, exclude=()):
+        """选择当前最快的健康线路，返回 {'name', 'api_url'}"""
+        self.start()
+        with self._lock:
+            candidates = [e for e in self._endpoints.values() if e['name'] not in exclude]
+            if not candidates:
+                return None
+            best = min(candidates, key=self._rank_key())
+            return {'name': best['name'], 'api_url': best['api_url']}
+
+    def alternative_for(self, url):
+        """返回与指定 URL 不同的最佳线路 URL（用于对冲请求），没有其他线路时返回 None"""
+        with self._lock:
+            endpoint = self._find_by_url(url)
+            exclude = (endpoint['name'],) if endpoint else ()
+        route = self.pick(exclude=exclude)
+        if route is None or route['api_url'] == url:
+            return None
+        return route['api_url']
+
+    def _find_by_url(self, url):
+        for endpoint in self._endpoints.values():
+            if endpoint['api_url'] == url:
+                return endpoint
+        return None
+
+    def record_request(self, url, latency, success, error=None):
+        """记录一次生成请求的结果（按 URL 对应到线路）"""
+        with self._lock:
+            endpoint = self._find_by_url(url)
+            if endpoint is None:
+                return
+            endpoint['requests'] += 1
+            endpoint['error_rate'] = self._ewma(endpoint['error_rate'], 0.0 if success else 1.0)
+            if success and latency is not None:
+                endpoint['request_latency_ewma'] = self._ewma(endpoint['request_latency_ewma'], latency)
+            if not success:
+                endpoint['errors'] += 1
+                endpoint['last_error'] = error
+
+    def _probe(self, endpoint):
+        """
+        探测单条线路：只要收到 HTTP 响应（非 5xx）即视为可达，记录往返延迟
+
+        探测使用独立的一次性连接（不重试、不复用连接池），延迟包含完整的 TCP + TLS 握手，
+        更能反映当前网络路径的质量。
+        """
+        probe_url = endpoint['base_url'].rstrip('/') + '/models'
+        headers = {'Authorization': f'Bearer {NANOBANANA_API_KEY}'} if NANOBANANA_API_KEY else {}
+        start_time = time.time()
+        try:
+            response = requests.get(probe_url, headers=headers, timeout=(CONNECT_TIMEOUT, 10),
+                                    proxies=PROXIES if PROXIES else None)
+            response.close()
+            success = response.status_code < 500
+            error = None if success else f'HTTP {response.status_code}'
+        except requests.exceptions.RequestException as e:
+            success = False
+            error = type(e).__name__
+        latency = time.time() - start_time
+
+        with self._lock:
+            endpoint['probes'] += 1
+            endpoint['last_probe_at'] = datetime.now().isoformat()
+            endpoint['error_rate'] = self._ewma(endpoint['error_rate'], 0.0 if success else 1.0)
+            if success:
+                endpoint['latency_ewma'] = self._ewma(endpoint['latency_ewma'], latency)
+            else:
+                endpoint['last_error'] = error
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            for endpoint in list(self._endpoints.values()):
+                if self._stop.is_set():
+                    return
+                self._probe(endpoint)
+            self._stop.wait(ROUTING_PROBE_INTERVAL)
+
+    def start(self):
+        """启动后台探测线程（只有多条线路时才需要，fork 后在子进程中重新启动）"""
+        if len(self._endpoints) < 2 or not ROUTING_ENABLED or self._stop.is_set():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._probe_loop, name='route-prober', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """停止后台探测线程（进程退出时调用，正在进行的探测最多等待其超时）"""
+        self._stop.set()
+        thread = self._thread
+        if thread and thread.is_alive() and self._pid == os.getpid():
+            thread.join(timeout=CONNECT_TIMEOUT + 10)
+
+    def snapshot(self):
+        with self._lock:
+            table = []
+            for endpoint in sorted(self._endpoints.values(), key=self._rank_key()):
+                entry = dict(endpoint)
+                entry['healthy'] = self._is_healthy(endpoint)
+                table.append(entry)
+            return {
+                'enabled': ROUTING_ENABLED and len(self._endpoints) > 1,
+                'probe_interval': ROUTING_PROBE_INTERVAL,
+                'endpoints': table
+            }
 
-def record_api_failure():
-    """记录 API 失败，可能触发断路器"""
-    circuit_breaker['failures'] += 1
-    circuit_breaker['last_failure_time'] = time.time()
 
-    if circuit_breaker['failures'] >= CIRCUIT_BREAKER_THRESHOLD:
-        circuit_breaker['open'] = True
-        print(f"[断路器] API 连续失败 {circuit_breaker['failures']} 次，断路器已打开")
+def _routing_lines():
+    """确定可路由的线路：仅 12ai 系列线路参与路由，地址相同的线路只保留一条"""
+    if not ROUTING_ENABLED or API_PROVIDER not in ROUTABLE_PROVIDERS:
+        return [(API_PROVIDER, base_url)]
+    lines = [(API_PROVIDER, base_url)]
+    seen = {base_url.rstrip('/')}
+    for name in ROUTABLE_PROVIDERS:
+        line_base_url = API_BASE_URLS.get(name)
+        if line_base_url and line_base_url.rstrip('/') not in seen:
+            seen.add(line_base_url.rstrip('/'))
+            lines.append((name, line_base_url))
+    return lines
 
 
-def record_api_success():
-    """记录 API 成功，重置断路器"""
-    circuit_breaker['failures'] = 0
-    circuit_breaker['last_failure_time'] = None
-    if circuit_breaker['open']:
-        print("[断路器] 服务已恢复，断路器已关闭")
-        circuit_breaker['open'] = False
+api_router = EndpointRouter(_routing_lines(), API_PROVIDER)
+atexit.register(api_router.close)
 
 
 # ==================== 网络请求辅助函数 ====================
 
-def make_api_request(url, payload, headers):
+class DeadlineExceeded(Exception):
+    """生成请求超过截止时间"""
+
+
+DEADLINE_EXCEEDED_MESSAGE = '生成超时，已超过时间预算'
+
+
+class Deadline:
+    """
+    单次生成的截止时间
+
+    在 /api/upload 中创建并随任务保存，排队、上游请求、重试和结果下载都只能使用剩余的时间预算，
+    超时后返回明确的错误，而不是让请求一直挂起。at 为 None 表示不限时。
+    """
+
+    def __init__(self, seconds=None, at=None):
+        if at is None and seconds is not None:
+            at = time.time() + seconds
+        self.at = at
+
+    def remaining(self):
+        if self.at is None:
+            return float('inf')
+        return self.at - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap):
+        """返回不超过剩余预算的超时时间"""
+        return max(min(cap, self.remaining()), 0.1)
+
+    def check(self, stage):
+        if self.expired():
+            raise DeadlineExceeded(f'生成超时（{stage}时已超过时间预算），请稍后重试')
+
+
+class HedgePolicy:
+    """
+    对冲请求策略
+
+    记录近期成功请求的延迟，请求耗时超过指定分位数时允许向另一条线路发起第二次请求；
+    每分钟的对冲次数受预算限制，避免上游费用翻倍。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=200)
+        self._recent_hedges = deque()
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_rejections = 0
+
+    def record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def hedge_delay(self):
+        """返回触发对冲前的等待时间，样本不足时返回 None"""
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(int(len(ordered) * HEDGE_PERCENTILE), len(ordered) - 1)
+        return max(ordered[index], HEDGE_MIN_DELAY)
+
+    def try_acquire(self):
+        """占用一次对冲预算，超出每分钟预算时返回 False"""
+        now = time.time()
+        with self._lock:
+            while self._recent_hedges and now - self._recent_hedges[0] > 60:
+                self._recent_hedges.popleft()
+            if len(self._recent_hedges) >= HEDGE_BUDGET_PER_MINUTE:
+                self.budget_rejections += 1
+                return False
+            self._recent_hedges.append(now)
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def get_stats(self):
+        delay = self.hedge_delay()
+        with self._lock:
+            now = time.time()
+            return {
+                'enabled': HEDGE_ENABLED,
+                'percentile': HEDGE_PERCENTILE,
+                'hedge_delay': round(delay, 2) if delay is not None else None,
+                'samples': len(self._latencies),
+                'budget_per_minute': HEDGE_BUDGET_PER_MINUTE,
+                'hedges_last_minute': sum(1 for t in self._recent_hedges if now - t <= 60),
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'budget_rejections': self.budget_rejections
+            }
+
+
+hedge_policy = HedgePolicy()
+
+
+def make_api_request(url, payload, headers, deadline=None):
     """
-    发送 API 请求，包含完整的错误处理和重试逻辑
+    发送 API 请求，包含完整的错误处理和重试逻辑，并把结果计入线路路由统计
 
+    payload 可以是普通 dict（序列化为 JSON），也可以是 StreamingPayload（流式发送）
+    deadline 限制包括重试在内的总耗时；开启 HEDGE_ENABLED 后，请求耗时超过近期延迟分位数时会向另一条线路发起对冲请求。
     返回: (response, error)
     """
-    # 检查断路器
-    if not check_circuit_breaker():
-        return None, f"服务暂时不可用，请稍后重试（断路器保护）"
+    deadline = deadline or Deadline()
+    if HEDGE_ENABLED:
+        alternative_url = api_router.alternative_for(url)
+        delay = hedge_policy.hedge_delay() if alternative_url else None
+        if delay is not None:
+            return _hedged_api_request(url, alternative_url, delay, payload, headers, deadline)
+    return _timed_api_request(url, payload, headers, deadline=deadline)
+
+
+def _timed_api_request(url, payload, headers, cancel_event=None, deadline=None):
+    """发送一次请求并记录延迟和结果（被取消的请求不计入统计）"""
+    start_time = time.time()
+    response, error = _send_with_retries(url, payload, headers, cancel_event, deadline or Deadline())
+    latency = time.time() - start_time
+    if error:
+        if not (cancel_event is not None and cancel_event.is_set()):
+            api_router.record_request(url, None, False, error)
+    else:
+        api_router.record_request(url, latency, response.status_code < 500, f'HTTP {response.status_code}')
+        if response.status_code == 200:
+            hedge_policy.record_latency(latency)
+    return response, error
+
+
+def _hedged_api_request(primary_url, alternative_url, delay, payload, headers, deadline):
+    """
+    对冲请求：主请求超过 delay 秒仍未完成时（且有预算），向备用线路再发一次，取先成功者
+
+    落选的请求会被取消：仍在上传请求体的直接中止，已在等待响应的在返回后立即关闭连接。
+    """
+    results = queue.Queue()
+    cancel_events = {}
+    lock = threading.Lock()
+
+    def attempt(target_url):
+        cancel_event = cancel_events[target_url]
+        response, error = _timed_api_request(target_url, payload, headers, cancel_event, deadline)
+        with lock:
+            if cancel_event.is_set():
+                if response is not None:
+                    response.close()
+                return
+            results.put((target_url, response, error))
+
+    def launch(target_url):
+        cancel_events[target_url] = threading.Event()
+        threading.Thread(target=attempt, args=(target_url,), name='hedge-attempt', daemon=True).start()
+
+    launch(primary_url)
+    pending = 1
+    hedged = False
+    winner = None
+    last_failure = (None, '请求失败')
+
+    while pending:
+        try:
+            target_url, response, error = results.get(timeout=None if hedged else delay)
+        except queue.Empty:
+            hedged = True
+            if deadline.remaining() < DEADLINE_MIN_ATTEMPT:
+                print(f"[对冲] 主请求已超过 {delay:.1f} 秒，但剩余时间预算不足，不再对冲")
+            elif hedge_policy.try_acquire():
+                print(f"[对冲] 主请求已超过 {delay:.1f} 秒，向备用线路发起对冲: {alternative_url}")
+                launch(alternative_url)
+                pending += 1
+            else:
+                print(f"[对冲] 主请求已超过 {delay:.1f} 秒，但本分钟对冲预算已用完")
+            continue
+
+        pending -= 1
+        if error is None and response.status_code < 500:
+            winner = (target_url, response)
+            break
+        last_failure = (response, error)
+        if response is not None and pending:
+            response.close()
+
+    # 取消仍在进行的请求，并关闭已经返回但未被采用的响应
+    with lock:
+        for target_url, cancel_event in cancel_events.items():
+            if winner is None or target_url != winner[0]:
+                cancel_event.set()
+        while not results.empty():
+            _, response, _ = results.get_nowait()
+            if response is not None:
+                response.close()
+
+    if winner is None:
+        return last_failure
+    if winner[0] != primary_url:
+        hedge_policy.record_win()
+        print(f"[对冲] 备用线路先完成: {winner[0]}")
+    return winner[1], None
+
+
+def _send_with_retries(url, payload, headers, cancel_event, deadline):
+    """
+    按上游配额和截止时间发送请求
+
+    - 发送前从令牌桶取得配额；上游返回 429/503 并给出等待时间时，暂停整个桶的派发，
+      本请求重新排队等待窗口开放后再发送，总排队时间不超过 UPSTREAM_RATE_MAX_WAIT
+    - 网络错误和 500/502/504 按指数退避重试，最多 UPSTREAM_MAX_RETRIES 次；
+      剩余时间预算不足以覆盖退避和一次新请求时不再重试
+    """
+    key = upstream_rate_key()
+    rate_wait_until = time.time() + UPSTREAM_RATE_MAX_WAIT
+    retries = 0
+    while True:
+        if deadline.expired():
+            return None, DEADLINE_EXCEEDED_MESSAGE
+        wait_budget = min(rate_wait_until - time.time(), deadline.remaining())
+        if not upstream_limiter.acquire(key, API_PROVIDER, wait_budget, cancel_event):
+            if cancel_event is not None and cancel_event.is_set():
+                return None, '请求已取消'
+            print(f"[限流] 等待上游配额超时，放弃本次请求")
+            return None, '上游接口繁忙（限流中），请稍后重试'
+
+        response, error, retryable = _send_api_request(url, payload, headers, cancel_event, deadline)
+        if response is not None:
+            delay = upstream_limiter.observe(key, API_PROVIDER, response)
+            if response.status_code in (429, 503) and delay:
+                if time.time() + delay > min(rate_wait_until, deadline.at or float('inf')):
+                    # 等待时间超出预算，把限流响应交给调用方按错误处理
+                    return response, None
+                response.close()
+                continue
+            retryable = response.status_code in (500, 502, 504)
+
+        if not retryable:
+            return response, error
+        if deadline.expired():
+            if response is not None:
+                response.close()
+            return None, DEADLINE_EXCEEDED_MESSAGE
+
+        backoff = UPSTREAM_RETRY_BACKOFF * (2 ** retries)
+        if retries >= UPSTREAM_MAX_RETRIES or deadline.remaining() < backoff + DEADLINE_MIN_ATTEMPT:
+            if retries < UPSTREAM_MAX_RETRIES:
+                print(f"[网络] 剩余时间预算 {deadline.remaining():.1f} 秒，不足以再重试")
+            return response, error
+
+        if response is not None:
+            response.close()
+        retries += 1
+        print(f"[网络] 第 {retries} 次重试将在 {backoff:.1f} 秒后开始（剩余时间预算 {deadline.remaining():.1f} 秒）")
+        if cancel_event is not None:
+            if cancel_event.wait(backoff):
+                return None, '请求已取消'
+        else:
+            time.sleep(backoff)
+
+
+def _send_api_request(url, payload, headers, cancel_event=None, deadline=None):
+    """发送一次上游请求，返回 (response, error, retryable)"""
+    # 检查该线路的断路器
+    breaker = circuit_breakers.get(url)
+    allowed, _, trial = breaker.allow_request()
+    if not allowed:
+        return None, f"服务暂时不可用，请稍后重试（断路器保护）", False
+    outcome_recorded = False
 
     print(f"[网络] 准备发送请求到: {url}")
     print(f"[网络] 使用代理: {'是' if PROXIES else '否'}")
     if PROXIES:
         print(f"[网络] 代理配置: {PROXIES}")
-    print(f"[网络] 超时设置: 连接={CONNECT_TIMEOUT}秒, 读取={READ_TIMEOUT}秒")
+    # 超时不超过生成的剩余时间预算
+    deadline = deadline or Deadline()
+    connect_timeout = deadline.timeout(CONNECT_TIMEOUT)
+    read_timeout = deadline.timeout(READ_TIMEOUT)
+    print(f"[网络] 超时设置: 连接={connect_timeout:.1f}秒, 读取={read_timeout:.1f}秒")
 
+    body = None
     try:
-        # 创建 Session
-        session = requests.Session()
-
-        # 设置重试策略
-        from requests.adapters import HTTPAdapter
-        from urllib3.util.retry import Retry
-
-        retry_strategy = Retry(
-            total=3,  # 总共重试3次
-            backoff_factor=1,  # 重试间隔递增因子
-            status_forcelist=[429, 500, 502, 503, 504],  # 需要重试的HTTP状态码
-            allowed_methods=["POST"]  # 允许重试的HTTP方法
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        session.mount("http://", adapter)
-        session.mount("https://", adapter)
+        if isinstance(payload, StreamingPayload):
+            body = payload.open(cancel_event)
+            request_kwargs = {'data': body}
+        else:
+            request_kwargs = {'json': payload}
 
-        # 发送请求（分别设置连接超时和读取超时）
-        response = session.post(
-            url,
-            json=payload,
-            headers=headers,
-            proxies=PROXIES if PROXIES else None,
-            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),  # (连接超时, 读取超时)
-            verify=True  # 验证SSL证书
-        )
+        try:
+            # 发送请求（复用进程级连接池，分别设置连接超时和读取超时）
+            response = upstream_client.post(
+                url,
+                headers=headers,
+                proxies=PROXIES if PROXIES else None,
+                timeout=(connect_timeout, read_timeout),  # (连接超时, 读取超时)
+                verify=True,  # 验证SSL证书
+                stream=True,  # 响应体由调用方流式读取
+                **request_kwargs
+            )
+        except Exception:
+            # 被取消的请求（对冲落选）不算作失败
+            if cancel_event is not None and cancel_event.is_set():
+                raise RequestCancelled('请求已取消')
+            raise
 
         print(f"[网络] 响应状态码: {response.status_code}")
         print(f"[网络] 响应时间: {response.elapsed.total_seconds():.2f}秒")
 
-        # 记录成功
-        record_api_success()
+        # 5xx 视为线路故障；429 是配额问题，由上游限流器处理，不计入断路器
+        if response.status_code >= 500:
+            breaker.record_failure()
+            outcome_recorded = True
+        elif response.status_code != 429:
+            breaker.record_success()
+            outcome_recorded = True
 
-        return response, None
+        return response, None, False
+
+    except RequestCancelled:
+        print(f"[网络] 请求已取消: {url}")
+        return None, '请求已取消', False
 
     except requests.exceptions.ConnectTimeout as e:
-        error_msg = f"连接超时（{CONNECT_TIMEOUT}秒），请检查网络或代理设置"
+        error_msg = f"连接超时（{connect_timeout:.0f}秒），请检查网络或代理设置"
         print(f"[网络] ❌ 连接超时: {e}")
-        record_api_failure()
-        return None, error_msg
+        breaker.record_failure()
+        outcome_recorded = True
+        return None, error_msg, True
 
     except requests.exceptions.ReadTimeout as e:
-        error_msg = f"读取超时（{READ_TIMEOUT}秒），服务器响应时间过长"
+        error_msg = f"读取超时（{read_timeout:.0f}秒），服务器响应时间过长"
         print(f"[网络] ❌ 读取超时: {e}")
-        record_api_failure()
-        return None, error_msg
+        breaker.record_failure()
+        outcome_recorded = True
+        return None, error_msg, True
 
     except requests.exceptions.ConnectionError as e:
         error_msg = "连接失败，请检查网络连接或API地址是否正确"
         print(f"[网络] ❌ 连接错误: {e}")
-        record_api_failure()
-        return None, error_msg
+        breaker.record_failure()
+        outcome_recorded = True
+        return None, error_msg, True
 
     except requests.exceptions.SSLError as e:
         error_msg = "SSL证书验证失败，请检查网络安全设置"
         print(f"[网络] ❌ SSL错误: {e}")
-        record_api_failure()
-        return None, error_msg
+        breaker.record_failure()
+        outcome_recorded = True
+        return None, error_msg, False
 
     except requests.exceptions.ProxyError as e:
         error_msg = "代理连接失败，请检查代理配置"
         print(f"[网络] ❌ 代理错误: {e}")
-        return None, error_msg
+        return None, error_msg, False
 
     except requests.exceptions.RequestException as e:
         error_msg = f"请求失败: {type(e).__name__} - {str(e)}"
         print(f"[网络] ❌ 请求异常: {e}")
-        record_api_failure()
-        return None, error_msg
+        breaker.record_failure()
+        outcome_recorded = True
+        return None, error_msg, False
 
     except Exception as e:
         error_msg = f"未知错误: {type(e).__name__} - {str(e)}"
         print(f"[网络] ❌ 未知异常: {e}")
-        import traceback
         print(f"[网络] 堆栈跟踪:\n{traceback.format_exc()}")
-        record_api_failure()
-        return None, error_msg
+        breaker.record_failure()
+        outcome_recorded = True
+        return None, error_msg, False
+
+    finally:
+        if body is not None:
+            body.close()
+        # 没有计入成功或失败的试探请求（429、取消、代理错误等）归还试探名额，否则断路器会一直停在半开状态
+        if trial and not outcome_recorded:
+            breaker.release_trial()
 
 
 def admin_required(f):
@@ -490,17 +1598,292 @@ class RowProxy:
             return default
 
 
-def get_db_connection():
-    """获取数据库连接（支持 PostgreSQL 和 SQLite）"""
-    if db_type == 'postgresql' and POSTGRES_AVAILABLE:
-        conn = psycopg2.connect(db_config)
-        conn.autocommit = False
-        return conn
-    else:
-        conn = sqlite3.connect(db_config)
+class DatabasePoolTimeout(Exception):
+    """等待数据库连接超时（连接池已耗尽）"""
+
+
+class PooledConnection:
+    """
+    连接池中借出的连接
+
+    接口与原始连接一致（cursor/commit/rollback 等直接转发），close() 时归还连接池而不是断开，
+    因此调用方仍按 "get_db_connection() ... finally: conn.close()" 的方式使用。
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._owner = threading.get_ident()
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise AttributeError(f"数据库连接已归还连接池，不能再使用 '{name}'")
+        return getattr(conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn, self._owner)
+
+    def __del__(self):
+        # 调用方异常退出忘记 close() 时，避免连接永久泄漏
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class DatabasePool:
+    """
+    数据库连接池（每个进程一个）
+
+    - PostgreSQL: psycopg2 ThreadedConnectionPool，连接数达到上限时最多等待 timeout 秒
+    - SQLite: 每个线程复用自己的连接（sqlite3 连接不能跨线程使用），新建连接时开启 WAL、
+      设置 busy_timeout 等 PRAGMA（见 SQLITE_* 配置），并定期执行 WAL 检查点
+
+    取出空闲超过 healthcheck_idle 秒的连接时先执行 SELECT 1，失效的连接直接丢弃重连；
+    归还时回滚未提交的事务，下一个使用者拿到的总是干净的连接。
+    检测到进程号变化（gunicorn --preload fork 出的 worker）时重建连接池，父进程的连接只丢弃引用、
+    不在子进程中关闭，避免断开父进程仍在使用的会话。
+    """
+
+    # SQLite 每个线程最多保留的空闲连接数（嵌套使用时会同时借出多个）
+    SQLITE_IDLE_PER_THREAD = 2
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_idle):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pg_pool = None
+        self.slots = None
+        self.local = None
+        self.last_used = {}    # id(连接) -> 最近归还时间
+        self.orphaned = []     # fork 前的连接池，保留引用避免被回收时关闭父进程的连接
+        self.journal_mode = None
+        self.last_checkpoint = time.monotonic()
+        self.stats = {
+            'checkouts': 0, 'created': 0, 'discarded': 0, 'health_check_failures': 0,
+            'waits': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'timeouts': 0, 'in_use': 0,
+            'checkpoints': 0
+        }
+
+    @property
+    def postgres(self):
+        return db_type == 'postgresql' and POSTGRES_AVAILABLE
+
+    def _ensure_process(self):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            if self.pid is not None:
+                print(f"[数据库] 检测到进程 fork（{self.pid} → {pid}），重建连接池")
+                self.orphaned.append((self.pg_pool, self.local))
+            self.pg_pool = None
+            self.slots = threading.BoundedSemaphore(self.maxconn)
+            self.local = threading.local()
+            self.last_used = {}
+            self.stats['in_use'] = 0
+            self.pid = pid
+
+    def _is_healthy(self, conn):
+        """检查连接是否可用（只检查空闲较久的连接，避免每次借出都多一次往返）"""
+        if self.postgres and conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            print(f"[数据库] 连接健康检查失败，丢弃并重连: {type(e).__name__}: {e}")
+            return False
+
+    def _record_checkout(self, waited=0.0, created=False):
+        with self.lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+            if created:
+                self.stats['created'] += 1
+            if waited > 0.001:
+                self.stats['waits'] += 1
+                self.stats['wait_total'] += waited
+                self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+
+    def _record_discard(self, health_check=False):
+        with self.lock:
+            self.stats['discarded'] += 1
+            if health_check:
+                self.stats['health_check_failures'] += 1
+
+    def _checkout_postgres(self):
+        started = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.stats['timeouts'] += 1
+            raise DatabasePoolTimeout(f"等待数据库连接超过 {self.timeout:g} 秒（连接池上限 {self.maxconn}）")
+        waited = time.monotonic() - started
+
+        try:
+            with self.lock:
+                if self.pg_pool is None:
+                    self.pg_pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, db_config)
+                    print(f"[数据库] 已创建 PostgreSQL 连接池（{self.minconn}-{self.maxconn}）")
+            # 数据库重启后池中的空闲连接可能全部失效，最多逐个丢弃 maxconn 次
+            for _ in range(self.maxconn + 1):
+                conn = self.pg_pool.getconn()
+                created = id(conn) not in self.last_used
+                if created or self._is_healthy(conn):
+                    self._record_checkout(waited, created)
+                    return conn
+                self.last_used.pop(id(conn), None)
+                self.pg_pool.putconn(conn, close=True)
+                self._record_discard(health_check=True)
+            raise DatabasePoolTimeout('无法获取可用的数据库连接')
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _checkout_sqlite(self):
+        idle = getattr(self.local, 'idle', None)
+        if idle is None:
+            idle = self.local.idle = []
+        while idle:
+            conn = idle.pop()
+            if self._is_healthy(conn):
+                self._record_checkout()
+                return conn
+            self.last_used.pop(id(conn), None)
+            self._record_discard(health_check=True)
+        conn = sqlite3.connect(db_config, timeout=SQLITE_BUSY_TIMEOUT / 1000)
         conn.row_factory = sqlite3.Row
+        self._configure_sqlite(conn)
+        self._record_checkout(created=True)
         return conn
 
+    def _configure_sqlite(self, conn):
+        """新建 SQLite 连接时设置并发相关的 PRAGMA（多个 worker 同时写入时避免 database is locked）"""
+        conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}')
+        if self.journal_mode is None:
+            # journal_mode 持久保存在数据库文件中，每个进程只需设置一次
+            try:
+                mode = conn.execute(f'PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}').fetchone()[0]
+            except sqlite3.OperationalError as e:
+                mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+                print(f"[数据库] 无法切换 SQLite journal_mode 到 {SQLITE_JOURNAL_MODE}: {e}")
+            self.journal_mode = str(mode).upper()
+            if self.journal_mode != SQLITE_JOURNAL_MODE:
+                print(f"[数据库] SQLite journal_mode 为 {self.journal_mode}（期望 {SQLITE_JOURNAL_MODE}）")
+        conn.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+        conn.execute(f'PRAGMA cache_size = {-SQLITE_CACHE_SIZE}')
+        conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+
+    def _maybe_checkpoint(self, conn):
+        """定期执行 WAL 检查点，避免长时间有读事务时 WAL 文件持续增长"""
+        if self.journal_mode != 'WAL' or SQLITE_CHECKPOINT_INTERVAL <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_checkpoint < SQLITE_CHECKPOINT_INTERVAL:
+                return
+            self.last_checkpoint = now
+        try:
+            # PASSIVE 不等待读写事务，不会阻塞请求
+            busy, log_pages, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            with self.lock:
+                self.stats['checkpoints'] += 1
+            if busy or (log_pages > 0 and checkpointed < log_pages):
+                print(f"[数据库] WAL 检查点未完成（{checkpointed}/{log_pages} 页），将在下次重试")
+        except sqlite3.Error as e:
+            print(f"[数据库] WAL 检查点失败: {e}")
+
+    def getconn(self):
+        """借出一个连接（用完后调用 close() 归还）"""
+        self._ensure_process()
+        conn = self._checkout_postgres() if self.postgres else self._checkout_sqlite()
+        return PooledConnection(self, conn)
+
+    def release(self, conn, owner):
+        """归还连接：回滚未提交的事务，失效的连接直接关闭"""
+        if self.pid != os.getpid():
+            return  # fork 前借出的连接，只丢弃引用
+        with self.lock:
+            self.stats['in_use'] = max(0, self.stats['in_use'] - 1)
+
+        if self.postgres:
+            broken = bool(conn.closed)
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            if broken:
+                self.last_used.pop(id(conn), None)
+                self._record_discard()
+            else:
+                self.last_used[id(conn)] = time.monotonic()
+            try:
+                self.pg_pool.putconn(conn, close=broken)
+            finally:
+                self.slots.release()
+            return
+
+        if owner != threading.get_ident():
+            # 连接在其它线程被回收（__del__），sqlite3 连接不能跨线程使用，直接丢弃
+            self.last_used.pop(id(conn), None)
+            return
+        idle = getattr(self.local, 'idle', None)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            idle = None
+        if idle is not None and len(idle) < self.SQLITE_IDLE_PER_THREAD:
+            self._maybe_checkpoint(conn)
+            self.last_used[id(conn)] = time.monotonic()
+            idle.append(conn)
+        else:
+            self.last_used.pop(id(conn), None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        waits = stats.pop('waits')
+        wait_total = stats.pop('wait_total')
+        stats.update({
+            'backend': 'postgresql' if self.postgres else 'sqlite',
+            'pid': self.pid,
+            'max_size': self.maxconn if self.postgres else None,
+            'journal_mode': None if self.postgres else self.journal_mode,
+            'waits': waits,
+            'avg_wait_ms': round(wait_total / waits * 1000, 1) if waits else 0.0,
+            'wait_max_ms': round(stats.pop('wait_max') * 1000, 1)
+        })
+        return stats
+
+
+db_pool = DatabasePool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE)
+
+
+def get_db_connection():
+    """从连接池获取数据库连接（支持 PostgreSQL 和 SQLite），用完后 close() 归还"""
+    return db_pool.getconn()
+
 
 def get_db_cursor(conn):
     """获取数据库游标（PostgreSQL 使用 RealDictCursor）"""
@@ -529,113 +1912,465 @@ def execute_query(cursor, query, params=None):
         return cursor.execute(query, params)
 
 
+def sql_seconds_ago(seconds):
+    """返回 "当前时间减去若干秒" 的 SQL 表达式（兼容 PostgreSQL 和 SQLite）"""
+    if db_type == 'postgresql':
+        return f"NOW() - INTERVAL '{int(seconds)} seconds'"
+    return f"datetime('now', '-{int(seconds)} seconds')"
+
+
 def fetchall_rows(cursor):
     """获取所有行并包装为 RowProxy（兼容 PostgreSQL 和 SQLite）"""
     rows = cursor.fetchall()
     return [RowProxy(row) for row in rows]
 
 
-def init_db():
-    """初始化数据库（支持 PostgreSQL 和 SQLite）"""
-    conn = get_db_connection()
-    c = get_db_cursor(conn)
+# ==================== 验证码统计计数器 ====================
+# 管理后台的统计数字保存在 code_stats 表中，由修改验证码的操作在同一个事务内增量更新，
+# 读取时只需汇总几行；定期对账任务按实际数据修复偏差（例如直接修改数据库造成的偏差）。
 
-    try:
-        # 验证码表
-        if db_type == 'postgresql':
-            # PostgreSQL 语法
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS verification_codes (
-                    code TEXT PRIMARY KEY,
-                    max_uses INTEGER DEFAULT 3,
-                    used_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT DEFAULT 'active',
-                    exported BOOLEAN DEFAULT FALSE
-                )
-            ''')
-            # 为已存在的表添加 exported 字段（如果不存在）
-            try:
-                c.execute("ALTER TABLE verification_codes ADD COLUMN IF NOT EXISTS exported BOOLEAN DEFAULT FALSE")
-            except:
-                pass
-        else:
-            # SQLite 语法
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS verification_codes (
-                    code TEXT PRIMARY KEY,
-                    max_uses INTEGER DEFAULT 3,
-                    used_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT DEFAULT 'active',
-                    exported BOOLEAN DEFAULT 0
-                )
-            ''')
-            # 为已存在的表添加 exported 字段（如果不存在）
-            try:
-                c.execute("ALTER TABLE verification_codes ADD COLUMN exported BOOLEAN DEFAULT 0")
-            except:
-                pass
+CODE_STATS_FIELDS = ('total', 'new', 'used', 'exhausted', 'active', 'total_uses')
 
-        # 生成记录表
-        if db_type == 'postgresql':
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS generation_logs (
-                    id SERIAL PRIMARY KEY,
-                    code TEXT,
-                    style TEXT,
-                    original_image TEXT,
-                    result_image TEXT,
-                    ip_address TEXT,
-                    user_agent TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-        else:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS generation_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT,
-                    style TEXT,
-                    original_image TEXT,
-                    result_image TEXT,
-                    ip_address TEXT,
-                    user_agent TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+# 计数器分成多行，并发更新时随机选择一行，避免所有预占都争抢同一行锁
+CODE_STATS_SHARDS = bulk_codes.CODE_STATS_SHARDS
 
-        # 验证尝试日志表
-        if db_type == 'postgresql':
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS verification_attempts (
-                    id SERIAL PRIMARY KEY,
-                    code TEXT,
-                    ip_address TEXT,
-                    success BOOLEAN,
-                    failure_reason TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-        else:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS verification_attempts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT,
-                    ip_address TEXT,
-                    success BOOLEAN,
-                    failure_reason TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+_CODE_STATS_AGGREGATE = '''
+    COUNT(*) AS total,
+    COALESCE(SUM(CASE WHEN used_count = 0 THEN 1 ELSE 0 END), 0) AS new,
+    COALESCE(SUM(CASE WHEN used_count > 0 THEN 1 ELSE 0 END), 0) AS used,
+    COALESCE(SUM(CASE WHEN used_count >= max_uses THEN 1 ELSE 0 END), 0) AS exhausted,
+    COALESCE(SUM(CASE WHEN status = 'active' THEN 1 ELSE 0 END), 0) AS active,
+    COALESCE(SUM(used_count), 0) AS total_uses
+'''
 
-        conn.commit()
 
-        # 插入测试验证码（如果不存在）
-        try:
-            execute_query(c, 'SELECT code FROM verification_codes WHERE code = ?', (TEST_VERIFICATION_CODE,))
+def _stats_row(row):
+    if isinstance(row, dict):
+        return {key: int(row[key]) for key in CODE_STATS_FIELDS}
+    return {key: int(value) for key, value in zip(CODE_STATS_FIELDS, row)}
+
+
+def aggregate_code_stats(c, where='', params=()):
+    """按 verification_codes 实际数据统计（where 为空时统计全表）"""
+    execute_query(c, f'SELECT {_CODE_STATS_AGGREGATE} FROM verification_codes {where}', params)
+    return _stats_row(c.fetchone())
+
+
+def code_stats_snapshot(c, where, params):
+    """
+    修改验证码前统计受影响的行，修改后调用 record_code_stats_change 更新计数器
+
+    PostgreSQL 先锁定受影响的行，SQLite 先取得写锁（BEGIN IMMEDIATE），
+    保证统计和修改之间没有其它事务改动这些行（例如验证时刚好用完的验证码）。
+    """
+    if db_type == 'postgresql':
+        execute_query(c, f'SELECT code FROM verification_codes {where} FOR UPDATE', params)
+    elif not c.connection.in_transaction:
+        c.execute('BEGIN IMMEDIATE')
+    return aggregate_code_stats(c, where, params)
+
+
+def record_code_stats_change(c, before, where, params):
+    """统计修改后的受影响行，把前后差值计入计数器（与修改在同一个事务中提交）"""
+    after = aggregate_code_stats(c, where, params)
+    apply_code_stats_delta(c, {key: after[key] - before[key] for key in CODE_STATS_FIELDS})
+
+
+def apply_code_stats_delta(c, delta):
+    if not any(delta.values()):
+        return
+    assignments = ', '.join(f'{key} = {key} + ?' for key in CODE_STATS_FIELDS)
+    execute_query(c, f'UPDATE code_stats SET {assignments} WHERE shard = ?',
+                  [delta.get(key, 0) for key in CODE_STATS_FIELDS] + [random.randrange(CODE_STATS_SHARDS)])
+
+
+def _reset_code_stats(c, stats):
+    """把计数器设置为给定的统计值（第 0 行保存全部数值，其余行清零）"""
+    c.execute('DELETE FROM code_stats')
+    columns = ', '.join(('shard',) + CODE_STATS_FIELDS)
+    placeholders = ', '.join('?' for _ in range(len(CODE_STATS_FIELDS) + 1))
+    for shard in range(CODE_STATS_SHARDS):
+        values = [stats[key] if shard == 0 else 0 for key in CODE_STATS_FIELDS]
+        execute_query(c, f'INSERT INTO code_stats ({columns}) VALUES ({placeholders})', [shard] + values)
+
+
+def get_code_stats():
+    """读取验证码统计（汇总计数器的几行，与验证码数量无关）"""
+    conn = get_db_connection()
+    try:
+        c = get_db_cursor(conn)
+        sums = ', '.join(f'COALESCE(SUM({key}), 0) AS {key}' for key in CODE_STATS_FIELDS)
+        c.execute(f'SELECT {sums} FROM code_stats')
+        return _stats_row(c.fetchone())
+    finally:
+        conn.close()
+
+
+def reconcile_code_stats():
+    """按实际数据核对计数器，发现偏差时修复，返回修复前后的差值（无偏差时为空字典）"""
+    conn = get_db_connection()
+    try:
+        c = get_db_cursor(conn)
+        # 对账期间阻止其它事务更新计数器：统计结果和重写计数器之间不会丢失增量
+        if db_type == 'postgresql':
+            c.execute('LOCK TABLE code_stats IN EXCLUSIVE MODE')
+        else:
+            c.execute('BEGIN IMMEDIATE')
+        actual = aggregate_code_stats(c)
+        sums = ', '.join(f'COALESCE(SUM({key}), 0) AS {key}' for key in CODE_STATS_FIELDS)
+        c.execute(f'SELECT COUNT(*) AS shards, {sums} FROM code_stats')
+        row = c.fetchone()
+        shards = row['shards'] if isinstance(row, dict) else row[0]
+        current = _stats_row(row) if isinstance(row, dict) else _stats_row(tuple(row)[1:])
+        drift = {key: actual[key] - current[key] for key in CODE_STATS_FIELDS if actual[key] != current[key]}
+        if drift or shards != CODE_STATS_SHARDS:
+            _reset_code_stats(c, actual)
+        conn.commit()
+        return drift
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+class CodeStatsReconciler:
+    """定期对账验证码统计计数器（每个进程一个后台线程，fork 后在子进程中重新启动）"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._stats = {'runs': 0, 'repairs': 0, 'last_run': None, 'last_drift': None, 'last_error': None}
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='code-stats-reconciler', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.run()
+
+    def run(self):
+        try:
+            drift = reconcile_code_stats()
+        except Exception as e:
+            with self._lock:
+                self._stats['last_error'] = f"{type(e).__name__}: {e}"
+            print(f"[统计] 计数器对账失败: {type(e).__name__}: {e}")
+            return None
+        with self._lock:
+            self._stats['runs'] += 1
+            self._stats['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self._stats['last_drift'] = drift
+            if drift:
+                self._stats['repairs'] += 1
+        if drift:
+            print(f"[统计] 计数器偏差已修复: {drift}")
+        return drift
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['interval'] = self.interval
+        return stats
+
+
+code_stats_reconciler = CodeStatsReconciler(CODE_STATS_RECONCILE_INTERVAL)
+
+
+# ==================== 数据库结构迁移 ====================
+# 每个迁移只执行一次，执行后写入 schema_version 表；启动时结构已是最新则不执行任何 DDL。
+# 新的表结构变更只能追加新的迁移，不能修改已发布的迁移。
+
+# 多进程同时启动时串行执行迁移的 PostgreSQL advisory lock 编号
+SCHEMA_MIGRATION_LOCK_ID = 7_251_208
+
+
+def _add_column(c, table, column, definition):
+    """为已存在的表添加字段（字段已存在时跳过）"""
+    if db_type == 'postgresql':
+        c.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+        return
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _migration_base_tables(c):
+    """验证码、生成记录和验证尝试日志表"""
+    if db_type == 'postgresql':
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS verification_codes (
+                code TEXT PRIMARY KEY,
+                max_uses INTEGER DEFAULT 3,
+                used_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'active',
+                exported BOOLEAN DEFAULT FALSE
+            )
+        ''')
+        _add_column(c, 'verification_codes', 'exported', 'BOOLEAN DEFAULT FALSE')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS generation_logs (
+                id SERIAL PRIMARY KEY,
+                code TEXT,
+                style TEXT,
+                original_image TEXT,
+                result_image TEXT,
+                ip_address TEXT,
+                user_agent TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS verification_attempts (
+                id SERIAL PRIMARY KEY,
+                code TEXT,
+                ip_address TEXT,
+                success BOOLEAN,
+                failure_reason TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    else:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS verification_codes (
+                code TEXT PRIMARY KEY,
+                max_uses INTEGER DEFAULT 3,
+                used_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'active',
+                exported BOOLEAN DEFAULT 0
+            )
+        ''')
+        _add_column(c, 'verification_codes', 'exported', 'BOOLEAN DEFAULT 0')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS generation_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code TEXT,
+                style TEXT,
+                original_image TEXT,
+                result_image TEXT,
+                ip_address TEXT,
+                user_agent TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS verification_attempts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                code TEXT,
+                ip_address TEXT,
+                success BOOLEAN,
+                failure_reason TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+
+def _migration_generation_jobs(c):
+    """生成任务队列表（持久化，重启/重新部署后可恢复执行）"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id TEXT PRIMARY KEY,
+            code TEXT,
+            file_path TEXT,
+            file_name TEXT,
+            params TEXT,
+            status TEXT DEFAULT 'queued',
+            result TEXT,
+            error TEXT,
+            worker_id TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            heartbeat_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            idempotency_key TEXT
+        )
+    ''')
+    _add_column(c, 'generation_jobs', 'idempotency_key', 'TEXT')
+    # 同一个幂等键同时只能对应一个任务（NULL 不受限制）
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_generation_jobs_idempotency ON generation_jobs (idempotency_key)')
+
+
+def _migration_result_cache(c):
+    """生成结果缓存表（按内容寻址，LRU 淘汰）"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS result_cache (
+            cache_key TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            hits INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_last_used ON result_cache (last_used_at)')
+
+
+def _migration_hot_query_indexes(c):
+    """常用查询的索引"""
+    # /api/status/<code>: WHERE code = ? ORDER BY created_at DESC
+    c.execute('CREATE INDEX IF NOT EXISTS idx_generation_logs_code_created ON generation_logs (code, created_at)')
+    # 管理后台列表和 CSV 导出: ORDER BY created_at DESC
+    c.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_created ON verification_codes (created_at)')
+    # 可导出验证码: WHERE status = 'active' ORDER BY created_at DESC
+    c.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_status_created ON verification_codes (status, created_at)')
+    # 安全日志导出: ORDER BY created_at DESC LIMIT 1000
+    c.execute('CREATE INDEX IF NOT EXISTS idx_verification_attempts_created ON verification_attempts (created_at)')
+    # 任务认领和排队统计: WHERE status = 'queued' ORDER BY created_at
+    c.execute('CREATE INDEX IF NOT EXISTS idx_generation_jobs_status_created ON generation_jobs (status, created_at)')
+
+
+def _migration_code_listing_keyset(c):
+    """管理后台验证码列表按 (created_at, code) 键集分页"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_created_code ON verification_codes (created_at, code)')
+    c.execute('DROP INDEX IF EXISTS idx_verification_codes_created')
+
+
+def _migration_code_stats(c):
+    """验证码统计计数器表（按现有数据初始化）"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS code_stats (
+            shard INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            new INTEGER NOT NULL DEFAULT 0,
+            used INTEGER NOT NULL DEFAULT 0,
+            exhausted INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 0,
+            total_uses INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    _reset_code_stats(c, aggregate_code_stats(c))
+
+
+def _migration_security_log_indexes(c):
+    """安全日志按时间范围、IP、验证码查询和键集分页"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_verification_attempts_created_id ON verification_attempts (created_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_verification_attempts_ip_created ON verification_attempts (ip_address, created_at, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_verification_attempts_code_created ON verification_attempts (code, created_at, id)')
+    c.execute('DROP INDEX IF EXISTS idx_verification_attempts_created')
+
+
+def _migration_code_generation_jobs(c):
+    """管理后台批量生成验证码的后台任务（进度保存在数据库中，任意 worker 都能查询）"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS code_generation_jobs (
+            id TEXT PRIMARY KEY,
+            requested INTEGER NOT NULL,
+            max_uses INTEGER NOT NULL,
+            generated INTEGER NOT NULL DEFAULT 0,
+            collisions INTEGER NOT NULL DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            sample TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+
+
+# (版本号, 说明, 迁移函数)，按版本号顺序执行
+MIGRATIONS = [
+    (1, '验证码、生成记录和验证尝试日志表', _migration_base_tables),
+    (2, '生成任务队列表', _migration_generation_jobs),
+    (3, '生成结果缓存表', _migration_result_cache),
+    (4, '常用查询索引', _migration_hot_query_indexes),
+    (5, '验证码列表分页索引', _migration_code_listing_keyset),
+    (6, '验证码统计计数器', _migration_code_stats),
+    (7, '安全日志查询索引', _migration_security_log_indexes),
+    (8, '批量生成验证码任务表', _migration_code_generation_jobs),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(c):
+    """读取当前数据库结构版本（schema_version 表不存在时为 0）"""
+    if db_type == 'postgresql':
+        c.execute("SELECT to_regclass('schema_version') IS NOT NULL AS present")
+    else:
+        c.execute("SELECT COUNT(*) AS present FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")
+    row = c.fetchone()
+    if not (row['present'] if isinstance(row, dict) else row[0]):
+        return 0
+    c.execute('SELECT COALESCE(MAX(version), 0) AS version FROM schema_version')
+    row = c.fetchone()
+    return row['version'] if isinstance(row, dict) else row[0]
+
+
+def _lock_schema(c):
+    """开启迁移事务并加锁，多个 worker 同时启动时只有一个执行迁移"""
+    if db_type == 'postgresql':
+        c.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_MIGRATION_LOCK_ID,))
+    else:
+        c.execute('BEGIN IMMEDIATE')
+
+
+def migrate_db(conn):
+    """按顺序执行尚未执行的迁移，每个迁移和它的版本记录在同一个事务中提交"""
+    c = get_db_cursor(conn)
+    version = get_schema_version(c)
+    conn.rollback()
+    if version >= SCHEMA_VERSION:
+        return version, []
+
+    applied = []
+    for target, description, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        try:
+            _lock_schema(c)
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # 加锁后重新读取，其它进程可能已经执行了这个迁移
+            version = get_schema_version(c)
+            if version >= target:
+                conn.commit()
+                continue
+            migration(c)
+            execute_query(c, 'INSERT INTO schema_version (version, description) VALUES (?, ?)', (target, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = target
+        applied.append(target)
+        print(f"[DB] 已执行迁移 {target}: {description}")
+    return version, applied
+
+
+def init_db():
+    """初始化数据库（支持 PostgreSQL 和 SQLite）：执行结构迁移并添加测试验证码"""
+    conn = get_db_connection()
+    c = get_db_cursor(conn)
+
+    try:
+        version, applied = migrate_db(conn)
+        if not applied:
+            print(f"[DB] 数据库结构已是最新 (版本 {version})")
+
+        # 插入测试验证码（如果不存在）
+        try:
+            execute_query(c, 'SELECT code FROM verification_codes WHERE code = ?', (TEST_VERIFICATION_CODE,))
             if not c.fetchone():
                 execute_query(c, 'INSERT INTO verification_codes (code, max_uses, status) VALUES (?, 999999, \'active\')', (TEST_VERIFICATION_CODE,))
+                apply_code_stats_delta(c, {'total': 1, 'new': 1, 'active': 1})
                 conn.commit()
                 print(f"[DB] 测试验证码已添加: {TEST_VERIFICATION_CODE} (无限次数)")
         except Exception as e:
@@ -649,17 +2384,96 @@ def init_db():
         conn.close()
 
 
+# ==================== 验证码与日志辅助函数 ====================
+
 def allowed_file(filename):
     """检查文件类型是否允许"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def verify_code(code):
-    """验证验证码并返回剩余次数"""
-    # 测试验证码（无限次数）
-    if code == TEST_VERIFICATION_CODE:
-        return {'max_uses': 999999, 'used_count': 0, 'remaining': '无限', 'is_test': True}, None
+class CodeCache:
+    """
+    验证码记录缓存（TTL + LRU）
+
+    缓存 max_uses、used_count、status，避免 /api/verify、/api/status 每次都查询数据库；
+    不存在的验证码也会缓存（negative_ttl，较短），防止猜测验证码时每次都打到数据库。
+    本进程修改验证码时显式失效，其它 worker 的修改最多在 ttl 秒后生效。
+    扣减次数由 reserve_code 在数据库中原子完成，不依赖缓存，缓存过期只影响显示的剩余次数。
+    """
+
+    def __init__(self, ttl, negative_ttl, max_entries):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()  # code -> (过期时间, 记录或 None)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'invalidations': 0, 'evictions': 0}
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, code):
+        """返回 (是否命中, 记录)，记录为 None 表示验证码不存在"""
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[code]
+                self._stats['misses'] += 1
+                return False, None
+            self._entries.move_to_end(code)
+            self._stats['hits'] += 1
+            if entry[1] is None:
+                self._stats['negative_hits'] += 1
+            return True, dict(entry[1]) if entry[1] is not None else None
+
+    def put(self, code, record):
+        if not self.enabled:
+            return
+        ttl = self.ttl if record is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[code] = (time.monotonic() + ttl, dict(record) if record is not None else None)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, *codes):
+        with self._lock:
+            for code in codes:
+                if self._entries.pop(code, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'enabled': self.enabled,
+            'ttl': self.ttl,
+            'negative_ttl': self.negative_ttl,
+            'max_entries': self.max_entries,
+            'hit_rate': round(stats['hits'] / lookups, 3) if lookups else 0.0
+        })
+        return stats
+
+
+code_cache = CodeCache(CODE_CACHE_TTL, CODE_CACHE_NEGATIVE_TTL, CODE_CACHE_MAX_ENTRIES)
 
+
+def load_code_record(code):
+    """从数据库读取验证码记录（不存在时返回 None）"""
     conn = get_db_connection()
     try:
         c = get_db_cursor(conn)
@@ -668,89 +2482,952 @@ def verify_code(code):
         result = c.fetchone()
 
         if not result:
-            return None, "验证码不存在"
+            return None
 
         # 兼容多种数据库返回格式（元组、Row对象、字典）
         if isinstance(result, dict):
-            max_uses = result['max_uses']
-            used_count = result['used_count']
-            status = result['status']
-        else:
-            # 元组或Row对象，按索引访问
-            max_uses = result[0]
-            used_count = result[1]
-            status = result[2]
-
-        if status != 'active':
-            return None, "验证码已失效"
-
-        remaining = max_uses - used_count
-        if remaining <= 0:
-            return None, "验证码使用次数已用完"
-
-        return {'max_uses': max_uses, 'used_count': used_count, 'remaining': remaining, 'is_test': False}, None
+            return {'max_uses': result['max_uses'], 'used_count': result['used_count'], 'status': result['status']}
+        # 元组或Row对象，按索引访问
+        return {'max_uses': result[0], 'used_count': result[1], 'status': result[2]}
     finally:
         conn.close()
 
 
-def use_code(code):
-    """使用验证码（扣减次数��"""
-    # 测试验证码不扣减次数
+def verify_code(code):
+    """验证验证码并返回剩余次数"""
+    # 测试验证码（无限次数）
     if code == TEST_VERIFICATION_CODE:
-        return
+        return {'max_uses': 999999, 'used_count': 0, 'remaining': '无限', 'is_test': True}, None
 
-    conn = get_db_connection()
-    try:
-        c = get_db_cursor(conn)
-        execute_query(c, 'UPDATE verification_codes SET used_count = used_count + 1 WHERE code = ?', (code,))
-        conn.commit()
-    finally:
-        conn.close()
+    hit, record = code_cache.get(code)
+    if not hit:
+        record = load_code_record(code)
+        code_cache.put(code, record)
 
+    if record is None:
+        return None, "验证码不存在"
+
+    if record['status'] != 'active':
+        return None, "验证码已失效"
+
+    max_uses = record['max_uses']
+    used_count = record['used_count']
+    remaining = max_uses - used_count
+    if remaining <= 0:
+        return None, "验证码使用次数已用完"
+
+    return {'max_uses': max_uses, 'used_count': used_count, 'remaining': remaining, 'is_test': False}, None
+
+
+def reserve_code(code):
+    """
+    原子预占一次验证码使用次数（验证和扣减在同一条条件 UPDATE 中完成）
+
+    并发请求不会超过 max_uses；生成失败时调用 release_code 归还。
+    返回值与 verify_code 相同，remaining 为预占后的剩余次数。
+    """
+    # 测试验证码不扣减次数
+    if code == TEST_VERIFICATION_CODE:
+        return {'max_uses': 999999, 'used_count': 0, 'remaining': '无限', 'is_test': True}, None
 
-def log_generation(code, style, original_image, result_image, ip_address=None, user_agent=None):
-    """记录生成历史（包含IP和用户代理）"""
     conn = get_db_connection()
     try:
         c = get_db_cursor(conn)
-        # 根据数据库类型使用不同的占位符
         if db_type == 'postgresql':
             c.execute('''
-                INSERT INTO generation_logs (code, style, original_image, result_image, ip_address, user_agent)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (code, style, original_image, result_image, ip_address, user_agent))
+                UPDATE verification_codes SET used_count = used_count + 1
+                WHERE code = %s AND status = 'active' AND used_count < max_uses
+                RETURNING max_uses, used_count
+            ''', (code,))
+            row = c.fetchone()
         else:
+            # SQLite：条件 UPDATE 取得写锁，同一事务内读取更新后的值
             c.execute('''
-                INSERT INTO generation_logs (code, style, original_image, result_image, ip_address, user_agent)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (code, style, original_image, result_image, ip_address, user_agent))
+                UPDATE verification_codes SET used_count = used_count + 1
+                WHERE code = ? AND status = 'active' AND used_count < max_uses
+            ''', (code,))
+            row = None
+            if c.rowcount:
+                c.execute('SELECT max_uses, used_count FROM verification_codes WHERE code = ?', (code,))
+                row = c.fetchone()
+        if row is not None:
+            max_uses, used_count = (row['max_uses'], row['used_count']) if isinstance(row, dict) else (row[0], row[1])
+            # 由更新后的次数推算统计变化：第一次使用从"新"变为"已使用"，用满时计入"已用完"
+            apply_code_stats_delta(c, {'total_uses': 1,
+                                       'new': -1 if used_count == 1 else 0,
+                                       'used': 1 if used_count == 1 else 0,
+                                       'exhausted': 1 if used_count == max_uses else 0})
         conn.commit()
     finally:
         conn.close()
 
+    if row is None:
+        # 预占失败时才查询具体原因（不存在 / 已失效 / 已用完），缓存可能已过时，重新读取
+        code_cache.invalidate(code)
+        _, error = verify_code(code)
+        return None, error or "验证码使用次数已用完"
+
+    code_cache.put(code, {'max_uses': max_uses, 'used_count': used_count, 'status': 'active'})
+    return {'max_uses': max_uses, 'used_count': used_count, 'remaining': max_uses - used_count, 'is_test': False}, None
+
+
+def release_code(code):
+    """归还一次预占的使用次数（生成失败时调用）"""
+    if code == TEST_VERIFICATION_CODE:
+        return
 
-def log_verification_attempt(code, ip_address, success, failure_reason=None):
-    """记录验证尝试（用于安全审计）"""
     conn = get_db_connection()
     try:
         c = get_db_cursor(conn)
-        # 根据数据库类型使用不同的占位符
-        if db_type == 'postgresql':
-            c.execute('''
-                INSERT INTO verification_attempts (code, ip_address, success, failure_reason)
-                VALUES (%s, %s, %s, %s)
-            ''', (code, ip_address, success, failure_reason))
-        else:
-            c.execute('''
-                INSERT INTO verification_attempts (code, ip_address, success, failure_reason)
-                VALUES (?, ?, ?, ?)
-            ''', (code, ip_address, success, failure_reason))
+        before = code_stats_snapshot(c, 'WHERE code = ?', (code,))
+        execute_query(c, 'UPDATE verification_codes SET used_count = used_count - 1 WHERE code = ? AND used_count > 0', (code,))
+        record_code_stats_change(c, before, 'WHERE code = ?', (code,))
         conn.commit()
     finally:
         conn.close()
+    code_cache.invalidate(code)
+    print(f"[验证码] 已归还预占的使用次数: {code}")
+
 
+# 审计日志表和写入的字段（created_at 在记录产生时确定，不受批量写入延迟影响；
+# 与直接写入的 CURRENT_TIMESTAMP 一致：SQLite 为 UTC 时间，PostgreSQL 转换为会话时区的时间）
+AUDIT_LOG_TABLES = {
+    'generation_logs': ('code', 'style', 'original_image', 'result_image', 'ip_address', 'user_agent', 'created_at'),
+    'verification_attempts': ('code', 'ip_address', 'success', 'failure_reason', 'created_at'),
+}
+
+
+class AuditLogWriter:
+    """
+    审计日志批量写入（write-behind）
+
+    请求中只把记录放入内存缓冲区，后台线程每攒够 batch_size 条或每隔 flush_interval 秒
+    用一次批量 INSERT 写入数据库，请求耗时不再包含审计日志的写入。
+    数据库不可用时记录保留在缓冲区中重试，超过 max_buffer 条后按 drop_policy 丢弃：
+    drop_oldest 丢弃最早的记录，drop_newest 丢弃新产生的记录。进程退出时会写入剩余的记录。
+    """
+
+    RETRY_INTERVAL = 5  # 写入失败后的重试间隔（秒）
+
+    def __init__(self, enabled, batch_size, flush_interval, max_buffer, drop_policy):
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_buffer = max(self.batch_size, max_buffer)
+        self.drop_policy = drop_policy if drop_policy in ('drop_oldest', 'drop_newest') else 'drop_oldest'
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._closed = False
+        self._dropping = False
+        self._stats = {'written': 0, 'batches': 0, 'dropped': 0, 'failures': 0, 'last_error': None}
+
+    def write(self, table, values):
+        row = (table, tuple(values) + (datetime.now(timezone.utc),))
+        if not self.enabled:
+            self._write_batch([row])
+            return
+        self._ensure_thread()
+        with self._cond:
+            if len(self._buffer) >= self.max_buffer:
+                self._drop(1, incoming=True)
+                if self.drop_policy == 'drop_newest':
+                    return
+            self._buffer.append(row)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _drop(self, count, incoming=False):
+        """缓冲区已满时按丢弃策略丢弃记录（调用方持有锁，incoming 表示丢弃的是尚未放入的新记录）"""
+        if self.drop_policy == 'drop_oldest':
+            for _ in range(count):
+                self._buffer.popleft()
+        elif not incoming:
+            for _ in range(count):
+                self._buffer.pop()
+        self._stats['dropped'] += count
+        if not self._dropping:
+            self._dropping = True
+            print(f"[审计日志] 缓冲区已满（{self.max_buffer} 条），按 {self.drop_policy} 策略丢弃记录")
+
+    def _ensure_thread(self):
+        """启动后台写入线程（fork 后在子进程中重新启动）"""
+        pid = os.getpid()
+        if self._pid == pid and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                # fork 前缓冲的记录属于父进程，由父进程负责写入
+                self._buffer.clear()
+                self._pid = pid
+            self._thread = threading.Thread(target=self._flush_loop, name='audit-log-writer', daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while not self._closed:
+            with self._cond:
+                if len(self._buffer) < self.batch_size and not self._closed:
+                    self._cond.wait(self.flush_interval)
+            if not self.flush():
+                time.sleep(self.RETRY_INTERVAL)
+
+    def flush(self):
+        """把缓冲区中的记录写入数据库，返回是否全部写入成功"""
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._buffer:
+                        return True
+                    batch = [self._buffer.popleft() for _ in range(min(len(self._buffer), self.batch_size))]
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    with self._lock:
+                        # 写入失败的记录放回队首，数据库恢复后重试
+                        self._buffer.extendleft(reversed(batch))
+                        overflow = len(self._buffer) - self.max_buffer
+                        if overflow > 0:
+                            self._drop(overflow)
+                        self._stats['failures'] += 1
+                        self._stats['last_error'] = f"{type(e).__name__}: {e}"
+                    print(f"[审计日志] 批量写入失败，{len(batch)} 条记录将稍后重试: {type(e).__name__}: {e}")
+                    return False
+                with self._lock:
+                    self._stats['written'] += len(batch)
+                    self._stats['batches'] += 1
+                    self._dropping = False
+
+    def _write_batch(self, batch):
+        grouped = {}
+        for table, values in batch:
+            grouped.setdefault(table, []).append(values)
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            for table, rows in grouped.items():
+                columns = ', '.join(AUDIT_LOG_TABLES[table])
+                if db_type == 'postgresql':
+                    # 一条多行 INSERT 写入整批记录
+                    execute_values(c, f'INSERT INTO {table} ({columns}) VALUES %s', rows, page_size=self.batch_size)
+                else:
+                    # 与 SQLite 的 CURRENT_TIMESTAMP 格式相同（UTC，精确到秒）
+                    rows = [values[:-1] + (values[-1].strftime('%Y-%m-%d %H:%M:%S'),) for values in rows]
+                    placeholders = ', '.join('?' for _ in AUDIT_LOG_TABLES[table])
+                    c.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def close(self):
+        """停止后台线程并写入剩余的记录（进程退出时调用）"""
+        self._closed = True
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval + 5)
+        if self._buffer and self._pid == os.getpid():
+            if self.flush():
+                print("[审计日志] 退出前已写入剩余记录")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buffered'] = len(self._buffer)
+        stats.update({'enabled': self.enabled, 'batch_size': self.batch_size, 'max_buffer': self.max_buffer,
+                      'drop_policy': self.drop_policy})
+        return stats
+
+
+audit_log = AuditLogWriter(AUDIT_LOG_ASYNC, AUDIT_LOG_BATCH_SIZE, AUDIT_LOG_FLUSH_INTERVAL,
+                           AUDIT_LOG_MAX_BUFFER, AUDIT_LOG_DROP_POLICY)
+atexit.register(audit_log.close)
+
+
+def log_generation(code, style, original_image, result_image, ip_address=None, user_agent=None):
+    """记录生成历史（包含IP和用户代理），由后台线程批量写入"""
+    audit_log.write('generation_logs', (code, style, original_image, result_image, ip_address, user_agent))
+
+
+def log_verification_attempt(code, ip_address, success, failure_reason=None):
+    """记录验证尝试（用于安全审计），由后台线程批量写入"""
+    audit_log.write('verification_attempts', (code, ip_address, success, failure_reason))
+
+
+# ==================== 上游请求体构建 ====================
+
+# 每次从文件读取并编码的原始字节数（必须是 3 的倍数，保证分块 base64 可以直接拼接）
+PAYLOAD_CHUNK_SIZE = 48 * 1024
+
+
+class RequestCancelled(Exception):
+    """上游请求被主动取消"""
+
+
+class StreamingPayload:
+    """
+    流式 JSON 请求体
+
+    请求体由三段组成: JSON 骨架前半段 + 图片文件的 base64 编码 + JSON 骨架后半段。
+    骨架只序列化一次，图片在发送时按块从文件读取并编码，
+    不会在内存中同时保留原图、base64 字符串和完整的 JSON 字符串。
+    """
+
+    # 骨架中图片数据的占位符
+    IMAGE_PLACEHOLDER = '@@IMAGE_BASE64@@'
+
+    def __init__(self, skeleton, image_path):
+        self.skeleton = skeleton
+        self.image_path = image_path
+        body = json.dumps(skeleton).encode('utf-8')
+        prefix, suffix = body.split(self.IMAGE_PLACEHOLDER.encode('utf-8'), 1)
+        self.prefix = prefix
+        self.suffix = suffix
+        self.image_bytes = os.path.getsize(image_path)
+        self.image_b64_length = (self.image_bytes + 2) // 3 * 4
+        self.content_length = len(prefix) + self.image_b64_length + len(suffix)
+
+    def open(self, cancel_event=None):
+        """返回一个新的只读流（每次发送/重试都需要新的读取位置）"""
+        return StreamingPayloadReader(self, cancel_event)
+
+
+class StreamingPayloadReader:
+    """StreamingPayload 的文件式读取器，供 requests/urllib3 作为请求体分块发送"""
+
+    def __init__(self, payload, cancel_event=None):
+        self._payload = payload
+        self._cancel_event = cancel_event
+        self._file = None
+        self._buffer = bytearray()
+        self._stage = 0  # 0: 前半段骨架, 1: 图片数据, 2: 后半段骨架, 3: 结束
+        self._position = 0
+
+    def __len__(self):
+        return self._payload.content_length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(PAYLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def _fill(self):
+        """向缓冲区追加下一段数据，没有更多数据时返回 False"""
+        if self._stage == 0:
+            self._buffer += self._payload.prefix
+            self._stage = 1
+            self._file = open(self._payload.image_path, 'rb')
+        elif self._stage == 1:
+            chunk = self._file.read(PAYLOAD_CHUNK_SIZE)
+            if chunk:
+                self._buffer += base64.b64encode(chunk)
+            else:
+                self._file.close()
+                self._file = None
+                self._buffer += self._payload.suffix
+                self._stage = 3
+        else:
+            return False
+        return True
+
+    def read(self, size=-1):
+        # 请求被取消（对冲请求已由另一线路完成）时中止上传
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise RequestCancelled('请求已取消')
+        if size is None or size < 0:
+            size = self._payload.content_length
+        while len(self._buffer) < size and self._fill():
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        """支持回到开头（urllib3 重试时会回绕请求体）"""
+        if whence == 0 and offset == self._position:
+            return self._position
+        if whence != 0 or offset != 0:
+            raise io.UnsupportedOperation('StreamingPayloadReader 只支持回到开头')
+        self.close()
+        self._buffer = bytearray()
+        self._stage = 0
+        self._position = 0
+        return 0
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def build_upstream_payload(prompt_text, image_path, mime_type, random_seed):
+    """按 API_FORMAT 构建流式请求体（gemini 原生格式或 OpenAI 兼容格式）"""
+    placeholder = StreamingPayload.IMAGE_PLACEHOLDER
+    if API_FORMAT == 'gemini':
+        # Gemini 原生格式 (用于 12ai Gemini 模型)
+        skeleton = {
+            "contents": [{
+                "parts": [
+                    {"text": prompt_text},
+                    {"inline_data": {"mime_type": mime_type, "data": placeholder}}
+                ]
+            }],
+            "generationConfig": {
+                "responseModalities": ["TEXT", "IMAGE"],
+                "seed": random_seed  # 添加随机种子确保每次生成不同
+            }
+        }
+    else:
+        # OpenAI 兼容格式
+        skeleton = {
+            "model": MODEL_NAME,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt_text},
+                        {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{placeholder}"}}
+                    ]
+                }
+            ],
+            "temperature": 0.9,
+            "top_p": 0.95,
+            "seed": random_seed,
+            "max_tokens": 4096
+        }
+    return StreamingPayload(skeleton, image_path)
+
+
+# ==================== 上游响应流式解析 ====================
+
+# 响应读取块大小
+RESPONSE_CHUNK_SIZE = 64 * 1024
+# 字符串超过该长度且内容为图片数据时，改为边解析边解码写入文件
+RESPONSE_INLINE_LIMIT = 16 * 1024
+# 非图片的超长字符串最多保留的长度（超出部分丢弃）
+RESPONSE_TEXT_LIMIT = 256 * 1024
+# 调试用原始响应预览的最大长度
+RESPONSE_PREVIEW_LIMIT = 2000
+
+_JSON_STRING_SPECIAL = re.compile(rb'["\\]')
+_JSON_LITERAL_END = re.compile(rb'[\s,\]}]')
+_BASE64_PREFIX = re.compile(rb'^[A-Za-z0-9+/=\\\r\n]*$')
+
+
+class Base64FileDecoder:
+    """分块 base64 解码器：输入 JSON 字符串中的原始字节，解码后写入文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._file = open(path, 'wb')
+        self._carry = b''
+
+    def write(self, raw):
+        data = self._carry + raw
+        # JSON 字符串末尾可能是被截断的转义序列，留到下一块处理
+        pending_escape = b''
+        trailing = len(data) - len(data.rstrip(b'\\'))
+        if trailing % 2:
+            data, pending_escape = data[:-1], b'\\'
+        data = data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'').replace(b'\n', b'').replace(b'\r', b'')
+        usable = len(data) // 4 * 4
+        self._carry = data[usable:] + pending_escape
+        if usable:
+            chunk = base64.b64decode(data[:usable])
+            self._file.write(chunk)
+            self.size += len(chunk)
+
+    def close(self):
+        remainder = self._carry.rstrip(b'\\')
+        if remainder:
+            chunk = base64.b64decode(remainder + b'=' * (-len(remainder) % 4))
+            self._file.write(chunk)
+            self.size += len(chunk)
+        self._carry = b''
+        self._file.close()
+
+
+class SpilledImage:
+    """响应中已直接解码写入磁盘的图片数据（在解析结果中代替超长的 base64 字符串）"""
+
+    def __init__(self, path, size, mime_type, is_data_url):
+        self.path = path
+        self.size = size
+        self.mime_type = mime_type
+        self.is_data_url = is_data_url
+
+    def __repr__(self):
+        prefix = f'data:{self.mime_type};base64,' if self.is_data_url else ''
+        return f'{prefix}<已写入磁盘 {self.size} bytes>'
+
+
+class StreamingResponseParser:
+    """
+    上游响应的增量 JSON 解析器
 
-def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color='white', beautify='no'):
+    边接收边解析响应体：普通的小字段照常组装为 dict/list；
+    超长的图片字符串（data:image/...;base64,... 或纯 base64）不在内存中拼接，
+    而是分块解码直接写入 spill_prefix 开头的临时文件，在结果中以 SpilledImage 表示。
+    同时保留一段有限长度的原始响应预览用于调试。
+    """
+
+    def __init__(self, spill_prefix):
+        self.spill_prefix = spill_prefix
+        self.spilled = []
+        self.preview = bytearray()
+        self.total_bytes = 0
+        self.root = None
+        self._done = False
+        self._stack = []        # [[container, pending_key]]
+        self._in_string = False
+        self._is_key = False
+        self._escape_pending = False
+        self._string = bytearray()
+        self._string_truncated = False
+        self._decoder = None
+        self._spill_mime = None
+        self._spill_is_data_url = False
+        self._literal = bytearray()
+
+    # ---------- 值的组装 ----------
+
+    def _emit(self, value):
+        if not self._stack:
+            self.root = value
+            self._done = True
+            return
+        frame = self._stack[-1]
+        container = frame[0]
+        if isinstance(container, dict):
+            container[frame[1]] = value
+            frame[1] = None
+        else:
+            container.append(value)
+
+    def _start_string(self):
+        frame = self._stack[-1] if self._stack else None
+        self._is_key = bool(frame) and isinstance(frame[0], dict) and frame[1] is None
+        self._in_string = True
+        self._string = bytearray()
+        self._string_truncated = False
+        self._decoder = None
+
+    def _append_string(self, raw):
+        if self._decoder is not None:
+            self._decoder.write(raw)
+            return
+        if self._string_truncated:
+            return
+        self._string += raw
+        if self._is_key or len(self._string) <= RESPONSE_INLINE_LIMIT:
+            return
+
+        # 字符串超过内联长度：判断是否为图片数据，是则转为流式解码
+        head = bytes(self._string)
+        if head.startswith(b'data:image') and b'base64,' in head:
+            header, data = head.split(b'base64,', 1)
+            self._spill_mime = header[5:].split(b';', 1)[0].decode('ascii', 'replace')
+            self._spill_is_data_url = True
+        elif _BASE64_PREFIX.match(head):
+            data = head
+            self._spill_mime = 'image/png'
+            self._spill_is_data_url = False
+        else:
+            if len(self._string) > RESPONSE_TEXT_LIMIT:
+                del self._string[RESPONSE_TEXT_LIMIT:]
+                self._string_truncated = True
+            return
+
+        self._decoder = Base64FileDecoder(f"{self.spill_prefix}.part{len(self.spilled)}")
+        self._string = bytearray()
+        self._decoder.write(data)
+
+    def _end_string(self):
+        self._in_string = False
+        if self._decoder is not None:
+            self._decoder.close()
+            value = SpilledImage(self._decoder.path, self._decoder.size, self._spill_mime, self._spill_is_data_url)
+            self.spilled.append(value)
+            self._decoder = None
+        else:
+            value = json.loads(b'"' + bytes(self._string) + b'"')
+            if self._string_truncated:
+                value += '...(已截断)'
+        self._string = bytearray()
+
+        if self._is_key:
+            self._stack[-1][1] = value
+        else:
+            self._emit(value)
+
+    def _end_literal(self):
+        if self._literal:
+            self._emit(json.loads(bytes(self._literal)))
+            self._literal = bytearray()
+
+    # ---------- 逐块解析 ----------
+
+    def feed(self, data):
+        if len(self.preview) < RESPONSE_PREVIEW_LIMIT:
+            self.preview += data[:RESPONSE_PREVIEW_LIMIT - len(self.preview)]
+        self.total_bytes += len(data)
+
+        i = 0
+        n = len(data)
+        while i < n:
+            if self._in_string:
+                if self._escape_pending:
+                    self._append_string(data[i:i + 1])
+                    self._escape_pending = False
+                    i += 1
+                    continue
+                match = _JSON_STRING_SPECIAL.search(data, i)
+                if not match:
+                    self._append_string(data[i:])
+                    break
+                j = match.start()
+                if data[j:j + 1] == b'\\':
+                    if j + 1 < n:
+                        self._append_string(data[i:j + 2])
+                        i = j + 2
+                    else:
+                        self._append_string(data[i:j + 1])
+                        self._escape_pending = True
+                        i = n
+                else:
+                    self._append_string(data[i:j])
+                    self._end_string()
+                    i = j + 1
+                continue
+
+            if self._literal:
+                match = _JSON_LITERAL_END.search(data, i)
+                if not match:
+                    self._literal += data[i:]
+                    break
+                self._literal += data[i:match.start()]
+                self._end_literal()
+                i = match.start()
+                continue
+
+            ch = data[i:i + 1]
+            if ch in b' \t\r\n,:':
+                i += 1
+            elif ch == b'"':
+                self._start_string()
+                i += 1
+            elif ch == b'{':
+                self._stack.append([{}, None])
+                i += 1
+            elif ch == b'[':
+                self._stack.append([[], None])
+                i += 1
+            elif ch in b'}]':
+                container = self._stack.pop()[0]
+                self._emit(container)
+                i += 1
+            else:
+                self._literal += ch
+                i += 1
+
+    def close(self):
+        self._end_literal()
+        if not self._done or self._in_string or self._stack:
+            raise ValueError(f'响应不是完整的 JSON（已接收 {self.total_bytes} bytes）')
+        return self.root
+
+    def parse_response(self, response, deadline=None):
+        """读取整个 requests 响应流并返回解析结果（超过截止时间时抛出 DeadlineExceeded）"""
+        for chunk in response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+            if chunk:
+                self.feed(chunk)
+            if deadline is not None:
+                deadline.check('读取响应')
+        return self.close()
+
+    def preview_text(self):
+        return bytes(self.preview).decode('utf-8', 'replace')
+
+    def cleanup(self):
+        """删除未被使用的临时图片文件"""
+        for item in self.spilled:
+            if os.path.exists(item.path):
+                os.remove(item.path)
+
+
+def save_generated_image(value, result_path, reference_path, api_format):
+    """
+    将响应中的图片数据保存为结果文件
+
+    value 可以是 SpilledImage（已解码到临时文件）、data URL 字符串或纯 base64 字符串。
+    生成图片与发送的原图大小几乎相同时视为上游返回了原图，抛出异常。
+    """
+    if isinstance(value, SpilledImage):
+        image_size = value.size
+    else:
+        base64_data = value.split('base64,')[-1]
+        image_bytes = base64.b64decode(base64_data)
+        image_size = len(image_bytes)
+
+    # 检查图片大小
+    original_size = os.path.getsize(reference_path)
+    print(f"[API] 原图大小: {original_size} bytes")
+    print(f"[API] 生成图片大小: {image_size} bytes")
+
+    # 检查是否和原图大小相同（可能返回了原图）
+    if abs(image_size - original_size) < 100:
+        print(f"[API] ❌ 错误: 生成图片大小与原图几乎相同！")
+        print(f"[API] ❌ API 返回了原图而不是生成的新图片")
+        last_api_call['error'] = 'API返回了原图而非生成的图片'
+        raise Exception("API返回了原图，图片生成失败。请尝试调整prompt或更换模型。")
+
+    if isinstance(value, SpilledImage):
+        os.replace(value.path, result_path)
+    else:
+        with open(result_path, 'wb') as f:
+            f.write(image_bytes)
+
+    saved_size = os.path.getsize(result_path)
+    print(f"[API] 保存后大小: {saved_size} bytes")
+    print(f"[API] ✓ 图片生成成功 ({api_format}): {result_path}")
+    last_api_call['success'] = True
+    last_api_call['format'] = api_format
+    return result_path
+
+
+def _is_image_value(value):
+    """判断响应字段是否为图片数据（流式解码的图片或 data URL）"""
+    if isinstance(value, SpilledImage):
+        return value.is_data_url
+    return isinstance(value, str) and value.startswith('data:image') and 'base64' in value
+
+
+def handle_api_result(result, parser, reference_path, result_path, deadline=None):
+    """
+    从解析后的上游响应中提取图片并保存
+
+    支持: OpenAI 字符串 content、OpenAI 数组 content、Gemini candidates、{"image": ...}、{"url": ...}
+    返回结果文件路径；无法识别响应格式时返回 None（调用方回退到模拟模式）
+    """
+    print(f"[API] 响应键: {list(result.keys())}")
+    print(f"[API] 响应内容预览: {json.dumps(result, ensure_ascii=False, default=repr)[:400]}...")
+
+    # 先保存原始响应信息（无论解析是否成功，方便调试）
+    last_api_call['response_keys'] = list(result.keys())
+    last_api_call['raw_response'] = parser.preview_text()
+    last_api_call['response_bytes'] = parser.total_bytes
+    last_api_call['error'] = None
+
+    # 安全地获取 content_type
+    content_type = 'N/A'
+    if 'choices' in result and len(result['choices']) > 0:
+        try:
+            content = result['choices'][0].get('message', {}).get('content', 'N/A')
+            content_type = str(type(content))
+        except (KeyError, IndexError, AttributeError):
+            content_type = 'unknown'
+    last_api_call['content_type'] = content_type
+
+    # ========== 处理 OpenAI 兼容响应格式 ==========
+    # OpenAI 格式: {"choices": [{"message": {"content": "..."}}]}
+    if 'choices' in result and len(result['choices']) > 0:
+        choice = result['choices'][0]
+        print(f"[API] 检测到 OpenAI 格式响应")
+        print(f"[API] Choice 数据: {list(choice.keys())}")
+        message = choice.get('message')
+        if isinstance(message, dict) and 'content' in message:
+            content = message['content']
+            print(f"[API] Content 类型: {type(content)}")
+
+            # 格式1: content 是字符串（直接 base64 data URL）
+            if isinstance(content, (str, SpilledImage)):
+                print(f"[API] Content 预览: {repr(content)[:200]}...")
+                if _is_image_value(content):
+                    return save_generated_image(content, result_path, reference_path, 'openai_base64')
+
+            # 格式2: content 是数组（OpenAI 多模态格式）
+            elif isinstance(content, list):
+                print(f"[API] Content 是数组格式，长度: {len(content)}")
+                for i, item in enumerate(content):
+                    if isinstance(item, dict) and item.get('type') == 'image_url':
+                        url = item.get('image_url', {}).get('url', '')
+                        print(f"[API] 找到 image_url: {repr(url)[:80]}")
+                        if _is_image_value(url):
+                            return save_generated_image(url, result_path, reference_path, 'openai_array')
+                    elif isinstance(item, dict):
+                        print(f"[API] Content[{i}] 类型: {item.get('type', 'unknown')}")
+                print(f"[API] ⚠ 数组中未找到有效的图片数据")
+
+    # ========== 处理 Gemini API 响应格式 (向后兼容) ==========
+    # Gemini 格式: {"candidates": [{"content": {"parts": [{"inlineData": {"data": "base64..."}}]}}]}
+    if 'candidates' in result and len(result['candidates']) > 0:
+        candidate = result['candidates'][0]
+        print(f"[API] Candidate 数据: {list(candidate.keys())}")
+        parts = candidate.get('content', {}).get('parts')
+        if parts:
+            print(f"[API] Parts 数量: {len(parts)}")
+            for i, part in enumerate(parts):
+                # 检查 inlineData（驼峰命名）或 inline_data（下划线命名）
+                inline_data = part.get('inlineData') or part.get('inline_data')
+                if inline_data and 'data' in inline_data:
+                    return save_generated_image(inline_data['data'], result_path, reference_path, 'gemini')
+                print(f"[API] Part {i} 没有 inlineData")
+        else:
+            print(f"[API] Candidate 中没有 content/parts")
+
+    # ========== 兼容其他格式 ==========
+    # 格式1: {"image": "base64_string"}
+    if 'image' in result:
+        return save_generated_image(result['image'], result_path, reference_path, 'base64')
+
+    # 格式2: {"url": "https://..."}
+    elif 'url' in result:
+        deadline = deadline or Deadline()
+        deadline.check('下载图片')
+        img_response = upstream_client.get(result['url'], timeout=deadline.timeout(30), stream=True)
+        try:
+            if img_response.status_code == 200:
+                # 流式写入磁盘，不在内存中保留整张图片
+                with open(result_path, 'wb') as f:
+                    for chunk in img_response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+                        f.write(chunk)
+                        deadline.check('下载图片')
+                print(f"[API] ✓ 图片下载成功 (URL格式): {result_path}")
+                last_api_call['success'] = True
+                last_api_call['format'] = 'url'
+                return result_path
+            print(f"[API] 下载图片失败: {img_response.status_code}")
+            last_api_call['error'] = f'下载失败: {img_response.status_code}'
+        finally:
+            img_response.close()
+        return None
+
+    print(f"[API] ⚠ 未知响应格式，使用模拟模式")
+    print(f"[API] 完整响应: {json.dumps(result, ensure_ascii=False, default=repr)[:1500]}")
+    last_api_call['error'] = f'未知响应格式。响应键: {list(result.keys())}'
+    return None
+
+
+# ==================== 图片预处理 ====================
+
+IMAGE_MIME_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp'
+}
+
+
+def preprocess_upload_image(image_path):
+    """
+    预处理上传图片，返回发送给上游的图片信息
+
+    处理步骤: 应用 EXIF 方向 -> 裁剪为 3:4 竖版 -> 限制长边 -> 重新编码为 JPEG/WebP。
+    处理后没有变小或预处理失败时回退为原图（按扩展名确定 MIME 类型）。
+    返回的 path 不是原图时由调用方在请求结束后删除。
+
+    返回: {'path': 文件路径, 'mime_type': MIME 类型, 'original_bytes': 原始大小, 'processed_bytes': 处理后大小}
+    """
+    from PIL import Image, ImageOps
+
+    original_bytes = os.path.getsize(image_path)
+    extension = image_path.rsplit('.', 1)[-1].lower()
+    fallback = {
+        'path': image_path,
+        'mime_type': IMAGE_MIME_TYPES.get(extension, 'image/jpeg'),
+        'original_bytes': original_bytes,
+        'processed_bytes': original_bytes
+    }
+
+    if not PREPROCESS_ENABLED:
+        return fallback
+
+    processed_path = None
+    try:
+        start_time = time.time()
+        with Image.open(image_path) as source:
+            # exif_transpose 总是返回新图片，是否旋转要看方向标签
+            transformed = source.getexif().get(0x0112, 1) != 1
+            img = ImageOps.exif_transpose(source)
+
+            # 透明背景合成到白色底上（JPEG 不支持透明通道）
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                canvas = Image.new('RGB', img.size, (255, 255, 255))
+                canvas.paste(img, (0, 0), img)
+                img = canvas
+                transformed = True
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+                transformed = True
+
+            # 裁剪为 3:4 竖版（水平居中，垂直方向偏上保留头部）
+            if PREPROCESS_CROP:
+                width, height = img.size
+                target_ratio = 3 / 4
+                if width / height > target_ratio:
+                    new_width = int(height * target_ratio)
+                    left = (width - new_width) // 2
+                    img = img.crop((left, 0, left + new_width, height))
+                    transformed = True
+                elif width / height < target_ratio:
+                    new_height = int(width / target_ratio)
+                    top = (height - new_height) // 3
+                    img = img.crop((0, top, width, top + new_height))
+                    transformed = True
+
+            # 限制长边尺寸
+            if max(img.size) > PREPROCESS_MAX_EDGE:
+                img.thumbnail((PREPROCESS_MAX_EDGE, PREPROCESS_MAX_EDGE), Image.LANCZOS)
+                transformed = True
+
+            if PREPROCESS_FORMAT == 'webp':
+                processed_path = image_path.rsplit('.', 1)[0] + '_prep.webp'
+                img.save(processed_path, 'WEBP', quality=PREPROCESS_QUALITY, method=4)
+                mime_type = 'image/webp'
+            else:
+                processed_path = image_path.rsplit('.', 1)[0] + '_prep.jpg'
+                img.save(processed_path, 'JPEG', quality=PREPROCESS_QUALITY, optimize=True, progressive=True)
+                mime_type = 'image/jpeg'
+            size = img.size
+
+        processed_bytes = os.path.getsize(processed_path)
+
+        # 处理后没有变小时直接发送原图（上游支持原图格式时），避免增加上传流量
+        if processed_bytes >= original_bytes and extension in IMAGE_MIME_TYPES:
+            os.remove(processed_path)
+            print(f"[预处理] 处理后未变小 ({original_bytes} -> {processed_bytes} bytes)，使用原图")
+            return fallback
+
+        print(f"[预处理] {original_bytes} -> {processed_bytes} bytes ({processed_bytes / original_bytes:.0%}), "
+              f"尺寸 {size[0]}x{size[1]}, 格式 {mime_type}, {'已变换' if transformed else '仅重新编码'}, "
+              f"耗时 {time.time() - start_time:.2f}秒")
+        return {
+            'path': processed_path,
+            'mime_type': mime_type,
+            'original_bytes': original_bytes,
+            'processed_bytes': processed_bytes
+        }
+    except Exception as e:
+        print(f"[预处理] 预处理失败，使用原图: {type(e).__name__}: {e}")
+        if processed_path and os.path.exists(processed_path):
+            os.remove(processed_path)
+        return fallback
+
+
+def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color='white', beautify='no', deadline=None,
+                        fresh=False, on_result=None):
     """
     调用图片生成 API (12ai.org NanoBanana Pro)
 
@@ -761,13 +3438,33 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
         background: 背景 (textured, solid)
         bg_color: 背景色 (white, gray, blue, black, warm)
         beautify: 是否美颜 (yes, no)
+        deadline: 生成截止时间（Deadline），超时抛出 DeadlineExceeded，不回退到模拟模式
+        fresh: 为 True 时不使用结果缓存（用户希望得到新的随机结果）
+        on_result: 上游调用结束时以是否成功为参数调用（在回退到模拟模式之前），用于自适应并发
     """
-    import base64
+    prepared = preprocess_upload_image(image_path)
+    try:
+        return _call_nanobanana_api(image_path, prepared, style, clothing, angle, background, bg_color, beautify,
+                                    deadline, fresh, on_result)
+    finally:
+        # 预处理生成的图片只用于本次请求，结束后删除（上传目录只保留原图）
+        if prepared['path'] != image_path and os.path.exists(prepared['path']):
+            os.remove(prepared['path'])
+
+
+def _call_nanobanana_api(image_path, prepared, style, clothing, angle, background, bg_color, beautify, deadline, fresh,
+                         on_result):
+    """call_nanobanana_api 的实现（prepared 为 preprocess_upload_image 的结果）"""
     from PIL import Image, ImageFilter, ImageEnhance
 
-    # ==================== 读取并编码图片 ====================
-    with open(image_path, 'rb') as f:
-        image_data = base64.b64encode(f.read()).decode()
+    deadline = deadline or Deadline()
+
+    # ==================== 记录预处理结果 ====================
+    last_api_call['preprocess'] = {
+        'original_bytes': prepared['original_bytes'],
+        'processed_bytes': prepared['processed_bytes'],
+        'mime_type': prepared['mime_type']
+    }
 
     # ==================== 构建文本 prompt ====================
     # 服装处理（统一名称，不再区分性别）
@@ -859,47 +3556,37 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
     print(prompt_text)
     print("=" * 70)
 
+    # ==================== 结果缓存 ====================
+    result_path = image_path.replace('.', '_result.')
+    cache_key = None
+    if result_cache.enabled:
+        try:
+            cache_key = result_cache.make_key(prepared['path'], {
+                'style': style, 'clothing': clothing, 'angle': angle,
+                'background': background, 'bg_color': bg_color, 'beautify': beautify
+            }, prompt_text)
+            if fresh:
+                result_cache.skip()
+                print(f"[缓存] 用户要求重新生成，跳过缓存")
+            elif result_cache.get(cache_key, result_path):
+                print(f"[缓存] ✓ 命中缓存结果: {result_path}")
+                last_api_call['cache'] = 'hit'
+                return result_path
+        except (OSError, sqlite3.Error) as e:
+            print(f"[缓存] 读取缓存失败，继续调用 API: {e}")
+        last_api_call['cache'] = 'bypass' if fresh else 'miss'
+
     # ==================== 构建请求 payload ====================
     # 添加随机种子以确保每次生成不同的图片
-    import time
     random_seed = int(time.time() * 1000) % 1000000
     print(f"[API] 使用随机种子: {random_seed}")
 
-    # 根据模型类型选择不同的请求格式
+    # 根据模型类型选择不同的请求格式（图片数据在发送时从文件流式编码）
+    payload = build_upstream_payload(prompt_text, prepared['path'], prepared['mime_type'], random_seed)
     if API_FORMAT == 'gemini':
-        # Gemini 原生格式 (用于 12ai Gemini 模型)
-        payload = {
-            "contents": [{
-                "parts": [
-                    {"text": prompt_text},
-                    {"inline_data": {"mime_type": "image/jpeg", "data": image_data}}
-                ]
-            }],
-            "generationConfig": {
-                "responseModalities": ["TEXT", "IMAGE"],
-                "seed": random_seed  # 添加随机种子确保每次生成不同
-            }
-        }
         api_format_name = "Gemini 原生格式"
         payload_type = "Gemini contents/parts 格式"
     else:
-        # OpenAI 兼容格式
-        payload = {
-            "model": MODEL_NAME,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_text},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-                    ]
-                }
-            ],
-            "temperature": 0.9,
-            "top_p": 0.95,
-            "seed": random_seed,
-            "max_tokens": 4096
-        }
         api_format_name = "OpenAI 兼容格式"
         payload_type = "OpenAI chat/completions 格式"
 
@@ -909,7 +3596,7 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
     print(f"  URL: {NANOBANANA_API_URL}")
     print(f"  模型: {MODEL_NAME}")
     print(f"  Prompt 长度: {len(prompt_text)} 字符")
-    print(f"  图片数据大小: {len(image_data)} 字符 (base64)")
+    print(f"  图片数据大小: {payload.image_b64_length} 字符 (base64), 请求体 {payload.content_length} bytes, 原图 {prepared['original_bytes']} bytes, 预处理后 {prepared['processed_bytes']} bytes")
     print(f"  Payload 结构: {payload_type}")
     print("-" * 70)
     print("📤 Prompt 内容 (发送给 API):")
@@ -918,12 +3605,13 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
 
     # ========== 真实 API 调用部分 ==========
     api_key = os.getenv('NANOBANANA_API_KEY', '')
-    api_url = NANOBANANA_API_URL
+    route = api_router.pick()
+    api_url = route['api_url']
 
     # 检查 API Key 是否配置
     if api_key:
         print(f"[API] ==================== API 配置 ====================")
-        print(f"[API] API 提供商: {API_PROVIDER}")
+        print(f"[API] API 提供商: {API_PROVIDER} (线路: {route['name']})")
         print(f"[API] API 格式: {API_FORMAT.upper()}")
         print(f"[API] API Key 已配置 (长度: {len(api_key)} 字符)")
         print(f"[API] 模型: {MODEL_NAME}")
@@ -940,7 +3628,7 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
         }
 
         # 确认 payload 中的 prompt (OpenAI 格式)
-        payload_content = payload.get('messages', [{}])[0].get('content', [])
+        payload_content = payload.skeleton.get('messages', [{}])[0].get('content', [])
         if isinstance(payload_content, list):
             for item in payload_content:
                 if isinstance(item, dict) and item.get('type') == 'text':
@@ -958,10 +3646,11 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
             print(f"[API] 开始调用 API: {api_url}")
 
             # 使用新的网络请求函数
-            response, error = make_api_request(api_url, payload, headers)
+            response, error = make_api_request(api_url, payload, headers, deadline)
 
             if error:
                 last_api_call['error'] = error
+                deadline.check('调用API')
                 raise Exception(f"API 调用失败: {error}")
 
             # 保存调试信息
@@ -976,204 +3665,38 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
                 error_text = response.text[:500]
                 print(f"[API] HTTP 错误响应: {error_text}")
                 last_api_call['error'] = f'HTTP {response.status_code}: {error_text}'
-                record_api_failure()
                 raise Exception(f"API 返回错误 {response.status_code}: {error_text[:100]}")
 
             if response.status_code == 200:
-                result = response.json()
-                print(f"[API] 响应键: {list(result.keys())}")
-                print(f"[API] 响应内容预览: {json.dumps(result, ensure_ascii=False)[:400]}...")
-
-                # 先保存原始响应信息（无论解析是否成功，方便调试）
-                last_api_call['response_keys'] = list(result.keys())
-                last_api_call['raw_response'] = json.dumps(result, ensure_ascii=False)[:2000]  # 保存更多原始响应
-                last_api_call['error'] = None
-
-                # 安全地获取 content_type
-                content_type = 'N/A'
-                if 'choices' in result and len(result['choices']) > 0:
-                    try:
-                        content = result['choices'][0].get('message', {}).get('content', 'N/A')
-                        content_type = str(type(content))
-                    except (KeyError, IndexError, AttributeError):
-                        content_type = 'unknown'
-                last_api_call['content_type'] = content_type
-
-                # ========== 处理 OpenAI 兼容响应格式 ==========
-                # OpenAI 格式: {"choices": [{"message": {"content": "..."}}]}
-                if 'choices' in result and len(result['choices']) > 0:
-                    choice = result['choices'][0]
-                    print(f"[API] 检测到 OpenAI 格式响应")
-                    print(f"[API] Choice 数据: {list(choice.keys())}")
-                    if 'message' in choice:
-                        message = choice['message']
-                        print(f"[API] Message 数据存在: True")
-                        if 'content' in message:
-                            content = message['content']
-                            print(f"[API] Content 类型: {type(content)}")
-
-                            # 格式1: content 是字符串（直接 base64）
-                            if isinstance(content, str):
-                                print(f"[API] Content 长度: {len(content)}")
-                                print(f"[API] Content 预览: {content[:200]}...")
-
-                                # 检查是否是 base64 编码的图片 (data:image/...;base64,...)
-                                if content.startswith('data:image') and 'base64' in content:
-                                    import base64
-                                    # 提取 base64 数据
-                                    base64_data = content.split('base64,')[-1]
-                                    image_data = base64.b64decode(base64_data)
-                                    result_path = image_path.replace('.', '_result.')
-
-                                    # 检查图片大小
-                                    original_size = os.path.getsize(image_path)
-                                    print(f"[API] 原图大小: {original_size} bytes")
-                                    print(f"[API] 生成图片大小: {len(image_data)} bytes")
-
-                                    # 检查是否和原图大小相同（可能返回了原图）
-                                    if abs(len(image_data) - original_size) < 100:
-                                        print(f"[API] ❌ 错误: 生成图片大小与原图几乎相同！")
-                                        print(f"[API] ❌ API 返回了原图而不是生成的新图片")
-                                        last_api_call['error'] = 'API返回了原图而非生成的图片'
-                                        raise Exception("API返回了原图，图片生成失败。请尝试调整prompt或更换模型。")
-
-                                    with open(result_path, 'wb') as f:
-                                        f.write(image_data)
-
-                                    saved_size = os.path.getsize(result_path)
-                                    print(f"[API] 保存后大小: {saved_size} bytes")
-
-                                    print(f"[API] ✓ OpenAI 图片生成成功: {result_path}")
-                                    last_api_call['success'] = True
-                                    last_api_call['format'] = 'openai_base64'
-                                    return result_path
-
-                            # 格式2: content 是数组（OpenAI 多模态格式）
-                            elif isinstance(content, list):
-                                print(f"[API] Content 是数组格式，长度: {len(content)}")
-                                for i, item in enumerate(content):
-                                    print(f"[API] Content[{i}] 类型: {type(item)}, 键: {list(item.keys()) if isinstance(item, dict) else 'N/A'}")
-                                    if isinstance(item, dict):
-                                        # 检查 image_url 类型
-                                        if item.get('type') == 'image_url':
-                                            url = item.get('image_url', {}).get('url', '')
-                                            print(f"[API] 找到 image_url，长度: {len(url)}")
-                                            if url.startswith('data:image') and 'base64' in url:
-                                                import base64
-                                                # 提取 base64 数据
-                                                base64_data = url.split('base64,')[-1]
-                                                image_data = base64.b64decode(base64_data)
-                                                result_path = image_path.replace('.', '_result.')
-
-                                                # 检查图片大小
-                                                original_size = os.path.getsize(image_path)
-                                                print(f"[API] 原图大小: {original_size} bytes")
-                                                print(f"[API] 生成图片大小: {len(image_data)} bytes")
-
-                                                # 检查是否和原图大小相同
-                                                if abs(len(image_data) - original_size) < 100:
-                                                    print(f"[API] ❌ 错误: 生成图片大小与原图几乎相同！")
-                                                    last_api_call['error'] = 'API返回了原图而非生成的图片'
-                                                    raise Exception("API返回了原图，图片生成失败。")
-
-                                                with open(result_path, 'wb') as f:
-                                                    f.write(image_data)
-
-                                                saved_size = os.path.getsize(result_path)
-                                                print(f"[API] 保存后大小: {saved_size} bytes")
-
-                                                print(f"[API] ✓ OpenAI 数组格式图片生成成功: {result_path}")
-                                                last_api_call['success'] = True
-                                                last_api_call['format'] = 'openai_array'
-                                                return result_path
-                                        else:
-                                            print(f"[API] Content[{i}] 类型: {item.get('type', 'unknown')}")
-                                print(f"[API] ⚠ 数组中未找到有效的图片数据")
-
-                # ========== 处理 Gemini API 响应格式 (向后兼容) ==========
-                # Gemini 格式: {"candidates": [{"content": {"parts": [{"inlineData": {"data": "base64..."}}]}}]}
-                if 'candidates' in result and len(result['candidates']) > 0:
-                    candidate = result['candidates'][0]
-                    print(f"[API] Candidate 数据: {list(candidate.keys())}")
-                    if 'content' in candidate:
-                        print(f"[API] Content 数据存在: True")
-                        if 'parts' in candidate['content']:
-                            print(f"[API] Parts 数量: {len(candidate['content']['parts'])}")
-                            for i, part in enumerate(candidate['content']['parts']):
-                                print(f"[API] Part {i} keys: {list(part.keys())}")
-                                # 检查 inlineData（驼峰命名）或 inline_data（下划线命名）
-                                inline_data = part.get('inlineData') or part.get('inline_data')
-                                if inline_data and 'data' in inline_data:
-                                    import base64
-                                    image_data = base64.b64decode(inline_data['data'])
-                                    result_path = image_path.replace('.', '_result.')
-
-                                    # 检查图片大小
-                                    original_size = os.path.getsize(image_path)
-                                    print(f"[API] 原图大小: {original_size} bytes")
-                                    print(f"[API] 生成图片大小: {len(image_data)} bytes")
-
-                                    # 检查是否和原图大小相同（可能返回了原图）
-                                    if abs(len(image_data) - original_size) < 100:
-                                        print(f"[API] ❌ 错误: 生成图片大小与原图几乎相同！")
-                                        print(f"[API] ❌ API 返回了原图而不是生成的新图片")
-                                        last_api_call['error'] = 'API返回了原图而非生成的图片'
-                                        raise Exception("API返回了原图，图片生成失败。请尝试调整prompt或更换模型。")
-
-                                    with open(result_path, 'wb') as f:
-                                        f.write(image_data)
-
-                                    # 验证保存后的文件大小
-                                    saved_size = os.path.getsize(result_path)
-                                    print(f"[API] 保存后大小: {saved_size} bytes")
-
-                                    print(f"[API] ✓ Gemini 图片生成成功: {result_path}")
-                                    last_api_call['success'] = True
-                                    last_api_call['format'] = 'gemini'
-                                    return result_path
-                                else:
-                                    print(f"[API] Part {i} 没有 inlineData")
-                        else:
-                            print(f"[API] Content 中没有 parts")
-                    else:
-                        print(f"[API] Candidate 中没有 content")
-
-                # ========== 兼容其他格式 ==========
-                # 格式1: {"image": "base64_string"}
-                if 'image' in result:
-                    import base64
-                    image_data = base64.b64decode(result['image'])
-                    result_path = image_path.replace('.', '_result.')
-                    with open(result_path, 'wb') as f:
-                        f.write(image_data)
-                    print(f"[API] ✓ 图片生成成功 (base64格式): {result_path}")
-                    last_api_call['success'] = True
-                    last_api_call['format'] = 'base64'
-                    return result_path
-
-                # 格式2: {"url": "https://..."}
-                elif 'url' in result:
-                    img_response = requests.get(result['url'], timeout=30)
-                    if img_response.status_code == 200:
-                        result_path = image_path.replace('.', '_result.')
-                        with open(result_path, 'wb') as f:
-                            f.write(img_response.content)
-                        print(f"[API] ✓ 图片下载成功 (URL格式): {result_path}")
-                        last_api_call['success'] = True
-                        last_api_call['format'] = 'url'
-                        return result_path
-                    else:
-                        print(f"[API] 下载图片失败: {img_response.status_code}")
-                        last_api_call['error'] = f'下载失败: {img_response.status_code}'
-
-                print(f"[API] ⚠ 未知响应格式，使用模拟模式")
-                print(f"[API] 响应键: {list(result.keys())}")
-                print(f"[API] 完整响应: {json.dumps(result, ensure_ascii=False)[:1500]}")
-                last_api_call['error'] = f'未知响应格式。响应键: {list(result.keys())}'
+                parser = StreamingResponseParser(result_path)
+                try:
+                    result = parser.parse_response(response, deadline)
+                    saved_path = handle_api_result(result, parser, prepared['path'], result_path, deadline)
+                finally:
+                    parser.cleanup()
+                    response.close()
+                if on_result:
+                    on_result(bool(saved_path))
+                if saved_path:
+                    if cache_key:
+                        try:
+                            result_cache.put(cache_key, saved_path)
+                        except (OSError, sqlite3.Error) as e:
+                            print(f"[缓存] 写入缓存失败: {e}")
+                    return saved_path
+
+        except DeadlineExceeded as e:
+            # 超时直接报错，不再用模拟图片代替
+            print(f"[API] ✗ {e}")
+            last_api_call['error'] = str(e)
+            if on_result:
+                on_result(False)
+            raise
 
         except Exception as e:
+            if on_result:
+                on_result(False)
             print(f"[API] ✗ API 调用异常: {type(e).__name__}: {e}")
-            import traceback
             print(f"[API] 异常堆栈: {traceback.format_exc()}")
             print(f"[API] 将使用模拟模式")
             last_api_call['error'] = f'{type(e).__name__}: {str(e)}'
@@ -1236,21 +3759,706 @@ def call_nanobanana_api(image_path, style, clothing, angle, background, bg_color
         img = enhancer.enhance(1.05)
         img = img.filter(ImageFilter.SMOOTH)
 
-        # 保存处理后的图片
-        result_path = image_path.replace('.', '_result.')
-        img.save(result_path, quality=95)
+        # 保存处理后的图片
+        result_path = image_path.replace('.', '_result.')
+        img.save(result_path, quality=95)
+
+        print(f"[模拟模式] 图片已处理: {result_path}")
+        bg_type_text = '质感影棚' if background == 'textured' else '纯色背景'
+        bg_color_text = {'white': '白色', 'gray': '灰色', 'blue': '蓝色', 'black': '深灰', 'warm': '暖色'}.get(bg_color, '白色')
+        beauty_text = '轻微美颜' if beautify == 'yes' else '无美颜'
+        print(f"  风格: {style}, 服装: {clothing}, 背景: {bg_type_text}({bg_color_text}), 美颜: {beauty_text}")
+
+        return result_path
+
+    except Exception as e:
+        print(f"图片处理失败: {e}")
+        return image_path  # 失败时返回原图
+
+
+# ==================== 生成结果缓存 ====================
+
+class ResultCache:
+    """
+    按内容寻址的生成结果缓存
+
+    键为预处理后图片内容 + 模型 + 规范化选项（服装、角度、背景、背景色、美颜）+ Prompt 的 SHA-256，
+    值为缓存目录中的结果文件。命中时复制到本次的结果路径，不再调用上游；
+    缓存文件总大小超过 RESULT_CACHE_MAX_BYTES 时按最近使用时间淘汰（LRU）。
+    """
+
+    def __init__(self, cache_dir, max_bytes, enabled=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def make_key(self, image_path, options, prompt_text):
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(PAYLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        normalized = {key: str(value).strip().lower() for key, value in options.items()}
+        digest.update(json.dumps({'model': MODEL_NAME, 'options': normalized, 'prompt': prompt_text},
+                                 sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def skip(self):
+        """用户要求重新生成（新的随机种子），不使用缓存"""
+        self._count('bypassed')
+
+    def get(self, cache_key, result_path):
+        """命中时把缓存文件复制到 result_path 并返回该路径，否则返回 None"""
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            execute_query(c, 'SELECT file_path, size_bytes FROM result_cache WHERE cache_key = ?', (cache_key,))
+            row = c.fetchone()
+            if row is None:
+                self._count('misses')
+                return None
+            file_path, size_bytes = (row['file_path'], row['size_bytes']) if isinstance(row, dict) else (row[0], row[1])
+            if not os.path.exists(file_path):
+                # 缓存文件已丢失（例如部署后清空了目录），删除失效记录
+                execute_query(c, 'DELETE FROM result_cache WHERE cache_key = ?', (cache_key,))
+                conn.commit()
+                self._count('misses')
+                return None
+            shutil.copyfile(file_path, result_path)
+            execute_query(c, 'UPDATE result_cache SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP WHERE cache_key = ?', (cache_key,))
+            conn.commit()
+        finally:
+            conn.close()
+        self._count('hits')
+        self._count('bytes_saved', size_bytes)
+        return result_path
+
+    def put(self, cache_key, source_path):
+        """把新生成的结果加入缓存（已存在则替换为最新结果），然后按大小上限淘汰"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        ext = os.path.splitext(source_path)[1] or '.png'
+        cache_path = os.path.join(self.cache_dir, f"{cache_key}{ext}")
+        shutil.copyfile(source_path, cache_path)
+        size_bytes = os.path.getsize(cache_path)
+
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            execute_query(c, '''
+                INSERT INTO result_cache (cache_key, file_path, size_bytes, hits, created_at, last_used_at)
+                VALUES (?, ?, ?, 0, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    file_path = excluded.file_path,
+                    size_bytes = excluded.size_bytes,
+                    last_used_at = CURRENT_TIMESTAMP
+            ''', (cache_key, cache_path, size_bytes))
+            conn.commit()
+        finally:
+            conn.close()
+        self._count('stores')
+        self._evict()
+
+    def _evict(self):
+        """缓存总大小超过上限时，删除最久未使用的条目"""
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            execute_query(c, 'SELECT COALESCE(SUM(size_bytes), 0) AS total FROM result_cache')
+            row = c.fetchone()
+            total = row['total'] if isinstance(row, dict) else row[0]
+            if total <= self.max_bytes:
+                return
+
+            execute_query(c, 'SELECT cache_key, file_path, size_bytes FROM result_cache ORDER BY last_used_at, created_at')
+            evicted = 0
+            for row in c.fetchall():
+                if total <= self.max_bytes:
+                    break
+                cache_key, file_path, size_bytes = (row['cache_key'], row['file_path'], row['size_bytes']) \
+                    if isinstance(row, dict) else (row[0], row[1], row[2])
+                execute_query(c, 'DELETE FROM result_cache WHERE cache_key = ?', (cache_key,))
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                total -= size_bytes
+                evicted += 1
+            conn.commit()
+        finally:
+            conn.close()
+        if evicted:
+            self._count('evictions', evicted)
+            print(f"[缓存] 淘汰 {evicted} 个结果，缓存大小 {total} bytes")
+
+    def get_stats(self):
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            execute_query(c, 'SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS total FROM result_cache')
+            row = c.fetchone()
+            entries, total = (row['entries'], row['total']) if isinstance(row, dict) else (row[0], row[1])
+        finally:
+            conn.close()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': entries,
+                'total_bytes': total,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'bytes_saved': self.bytes_saved,
+                'stores': self.stores,
+                'evictions': self.evictions
+            }
+
+
+result_cache = ResultCache(os.path.join(upload_folder, 'cache'), RESULT_CACHE_MAX_BYTES, RESULT_CACHE_ENABLED)
+
+
+# ==================== 异步生成任务 ====================
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD 自适应并发限制
+
+    每次生成成功且耗时不超过 CONCURRENCY_TARGET_LATENCY 时，限制加性增长（每轮 +1）；
+    失败或超时则乘性降低（× CONCURRENCY_BACKOFF）。降低之前就已开始的请求不会再次触发降低，
+    避免一次上游故障让限制连续下降。限制从 initial 开始，在 [min_limit, max_limit] 之间调整。
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial=None):
+        self.max_limit = max(max_limit, min_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = float(min(max(initial or self.max_limit, self.min_limit), self.max_limit))
+        self._cond = threading.Condition()
+        self._last_decrease = 0
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.increases = 0
+        self.decreases = 0
+
+    def acquire(self, timeout):
+        """等待一个并发名额，返回开始时间；超时返回 None"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, started_at, success=None):
+        """归还名额；success 为 None 表示没有实际调用上游（不参与调整）"""
+        with self._cond:
+            self.in_flight -= 1
+            if success is not None:
+                latency = time.time() - started_at
+                self.latency_ewma = latency if self.latency_ewma is None else 0.3 * latency + 0.7 * self.latency_ewma
+                if success and latency <= CONCURRENCY_TARGET_LATENCY:
+                    if self.limit < self.max_limit:
+                        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                        self.increases += 1
+                elif started_at >= self._last_decrease:
+                    previous = self.limit
+                    self.limit = max(self.min_limit, self.limit * CONCURRENCY_BACKOFF)
+                    self._last_decrease = time.time()
+                    self.decreases += 1
+                    print(f"[并发] 上游过载（{'超时' if success else '失败'}，耗时 {latency:.1f}秒），"
+                          f"并发限制 {previous:.2f} -> {self.limit:.2f}")
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'limit': round(self.limit, 2),
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'latency_ewma': round(self.latency_ewma, 2) if self.latency_ewma is not None else None,
+                'target_latency': CONCURRENCY_TARGET_LATENCY,
+                'increases': self.increases,
+                'decreases': self.decreases
+            }
+
+
+class GenerationJobQueue:
+    """
+    持久化的生成任务队列（基于 generation_jobs 表）
+
+    /api/upload 只负责入队并立即返回任务 ID，实际的 API 调用由后台工作线程完成。
+    任务保存在数据库中，工作线程通过原子领取（PostgreSQL 使用 FOR UPDATE SKIP LOCKED，
+    SQLite 使用单条条件 UPDATE）获取任务，运行期间定期写入心跳；
+    进程重启后心跳超时的任务会被重新放回队列，多个进程/副本可以共享同一队列。
+    任务状态: queued -> running -> done / failed
+    """
+
+    # 排队数估计的有效期（秒）："已满" 的估计过期后仍按已满拒绝，但每个周期放行一个请求由 submit 的精确计数刷新
+    DEPTH_ESTIMATE_TTL = 5
+
+    def __init__(self, workers, max_queue, handler, on_failure=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._handler = handler
+        self._on_failure = on_failure  # 任务最终失败时的回调（例如归还预占的使用次数）
+        # 工作线程数取并发上限，实际同时执行的任务数由自适应限制决定（从 workers 开始）
+        self.limiter = AdaptiveConcurrencyLimiter(max(CONCURRENCY_MAX_LIMIT, workers), CONCURRENCY_MIN_LIMIT, initial=workers)
+        self._upstream = threading.local()  # 当前工作线程执行的任务的上游调用结果
+        self._depth_estimate = 0
+        self._depth_checked_at = 0
+        self.rejections = 0
+        self._cond = threading.Condition()
+        self._wakeup = threading.Event()
+        self._running = {}  # {worker_id: job_id} 当前进程正在执行的任务
+        self._threads = []
+        self._pid = None
+
+    def _ensure_workers(self):
+        """按需启动工作线程和心跳线程（在 fork 之后的进程中启动，兼容 gunicorn）"""
+        if self.workers <= 0:
+            return
+        with self._cond:
+            if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._threads = []
+                self._running = {}
+            self._threads = [t for t in self._threads if t.is_alive()]
+
+            prefix = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+            if not any(t.name == 'generation-heartbeat' for t in self._threads):
+                t = threading.Thread(target=self._heartbeat_loop, name='generation-heartbeat', daemon=True)
+                t.start()
+                self._threads.append(t)
+            while sum(1 for t in self._threads if t.name != 'generation-heartbeat') < self.limiter.max_limit:
+                worker_id = f"{prefix}:{len(self._threads)}"
+                t = threading.Thread(target=self._worker_loop, args=(worker_id,), name=f'generation-worker-{len(self._threads)}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    @staticmethod
+    def _row_to_job(row):
+        job = dict(row)
+        job['params'] = json.loads(job['params']) if job.get('params') else {}
+        job['result'] = json.loads(job['result']) if job.get('result') else None
+        return job
+
+    def _update_depth(self, depth):
+        with self._cond:
+            self._depth_estimate = max(depth, 0)
+            self._depth_checked_at = time.time()
+
+    def _reject(self):
+        with self._cond:
+            self.rejections += 1
+        return False, self.retry_after()
+
+    def retry_after(self):
+        """按当前排队数、并发限制和平均耗时估算客户端应等待的秒数"""
+        stats = self.limiter.get_stats()
+        latency = stats['latency_ewma'] or CONCURRENCY_TARGET_LATENCY / 2
+        with self._cond:
+            depth = self._depth_estimate
+        return int(min(max(depth * latency / max(stats['limit'], 1), 1), 300))
+
+    def admit(self):
+        """
+        快速准入检查（不访问数据库）：最近已知的排队数达到上限时直接拒绝
+        持续过载时每个进程每 DEPTH_ESTIMATE_TTL 秒只有一个请求会访问数据库（预占次数并重新计数）
+        返回 (allowed, retry_after_seconds)
+        """
+        with self._cond:
+            full = self._depth_estimate >= self.max_queue
+            if full and time.time() - self._depth_checked_at > self.DEPTH_ESTIMATE_TTL:
+                # 估计已过期：放行这一个请求去刷新，其余请求在下一个周期内继续按已满拒绝
+                self._depth_checked_at = time.time()
+                full = False
+        if full:
+            return self._reject()
+        return True, 0
+
+    @staticmethod
+    def _reusable_condition():
+        """仍可复用的任务：排队中、运行中，或在 IDEMPOTENCY_TTL 内成功完成"""
+        return f"(status IN ('queued', 'running') OR (status = 'done' AND finished_at >= {sql_seconds_ago(IDEMPOTENCY_TTL)}))"
+
+    def find_by_key(self, idempotency_key):
+        """按幂等键查找可复用的任务（进行中或近期已完成），没有则返回 None"""
+        if not idempotency_key:
+            return None
+        self._ensure_workers()
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            execute_query(c, f'SELECT * FROM generation_jobs WHERE idempotency_key = ? AND {self._reusable_condition()}',
+                          (idempotency_key,))
+            row = c.fetchone()
+            return self._row_to_job(row) if row else None
+        finally:
+            conn.close()
+
+    def submit(self, code, file_path, file_name, params, idempotency_key=None):
+        """
+        提交任务，返回 (job_id, created)，队列已满时返回 (None, False)
+
+        带幂等键时，若已有相同键的任务在进行中或近期已完成（并发重复提交），返回已有任务的 ID 且 created 为 False，
+        本次上传的文件会被删除，不会再发起新的生成。
+        """
+        self._ensure_workers()
+        job_id = uuid.uuid4().hex
+
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            if idempotency_key:
+                # 失败或过期任务的幂等键释放给新任务
+                execute_query(c, f'UPDATE generation_jobs SET idempotency_key = NULL '
+                                 f'WHERE idempotency_key = ? AND NOT {self._reusable_condition()}', (idempotency_key,))
+            execute_query(c, "SELECT COUNT(*) AS queued FROM generation_jobs WHERE status = 'queued'")
+            row = c.fetchone()
+            queued = row['queued'] if isinstance(row, dict) else row[0]
+            if queued >= self.max_queue:
+                self._update_depth(queued)
+                self._reject()
+                return None, False
+
+            try:
+                execute_query(c, '''
+                    INSERT INTO generation_jobs (id, code, file_path, file_name, params, status, idempotency_key)
+                    VALUES (?, ?, ?, ?, ?, 'queued', ?)
+                ''', (job_id, code, file_path, file_name, json.dumps(params, ensure_ascii=False), idempotency_key))
+                conn.commit()
+            except DB_INTEGRITY_ERRORS:
+                # 并发的重复提交已抢先入队，合并到已有任务
+                conn.rollback()
+                existing = None
+            else:
+                existing = job_id
+        finally:
+            conn.close()
+
+        if existing is None:
+            job = self.find_by_key(idempotency_key)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            if job is None:
+                return None, False
+            print(f"[任务] 重复提交，合并到已有任务: {job['id']}")
+            return job['id'], False
+
+        self._update_depth(queued + 1)
+        print(f"[任务] 已入队: {job_id} (排队中: {queued + 1})")
+        self._wakeup.set()
+        return job_id, True
+
+    def start(self):
+        """启动当前进程的工作线程（应用启动时调用），先回收上次进程遗留的孤儿任务"""
+        if self.workers <= 0:
+            return
+        # 在锁外执行，失败时只记录日志；之后由心跳线程定期重试
+        try:
+            self.requeue_orphans()
+        except Exception as e:
+            print(f"[任务] 启动时回收孤儿任务失败: {type(e).__name__}: {e}")
+        self._ensure_workers()
+
+    def get(self, job_id):
+        self._ensure_workers()
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            execute_query(c, 'SELECT * FROM generation_jobs WHERE id = ?', (job_id,))
+            row = c.fetchone()
+            return self._row_to_job(row) if row else None
+        finally:
+            conn.close()
+
+    def wait(self, job_id, timeout):
+        """长轮询：等待任务结束或超时，返回任务信息"""
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job['status'] in ('done', 'failed') or remaining <= 0:
+                return job
+            # 本进程完成的任务会立即唤醒；其他进程完成的任务靠轮询发现
+            with self._cond:
+                self._cond.wait(min(remaining, 1.0))
+
+    def _claim(self, worker_id):
+        """原子领取一个排队中的任务，没有任务时返回 None"""
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            if db_type == 'postgresql':
+                c.execute('''
+                    UPDATE generation_jobs
+                    SET status = 'running', worker_id = %s, attempts = attempts + 1,
+                        started_at = NOW(), heartbeat_at = NOW()
+                    WHERE id = (
+                        SELECT id FROM generation_jobs
+                        WHERE status = 'queued'
+                        ORDER BY created_at
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *
+                ''', (worker_id,))
+                row = c.fetchone()
+            else:
+                # SQLite 的单条 UPDATE 在数据库写锁内执行，子查询和更新是原子的
+                c.execute('''
+                    UPDATE generation_jobs
+                    SET status = 'running', worker_id = ?, attempts = attempts + 1,
+                        started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+                    WHERE id = (
+                        SELECT id FROM generation_jobs
+                        WHERE status = 'queued'
+                        ORDER BY created_at
+                        LIMIT 1
+                    )
+                ''', (worker_id,))
+                row = None
+                if c.rowcount:
+                    c.execute("SELECT * FROM generation_jobs WHERE worker_id = ? AND status = 'running'", (worker_id,))
+                    row = c.fetchone()
+            conn.commit()
+            return self._row_to_job(row) if row else None
+        finally:
+            conn.close()
+
+    def _finish(self, job_id, worker_id, status, result=None, error=None):
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            # 只有仍持有该任务的工作线程才能写入结果（任务可能已被判定为孤儿并重新分配）
+            execute_query(c, '''
+                UPDATE generation_jobs
+                SET status = ?, result = ?, error = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND worker_id = ? AND status = 'running'
+            ''', (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, job_id, worker_id))
+            updated = c.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        with self._cond:
+            self._cond.notify_all()
+        return updated > 0
+
+    def _worker_loop(self, worker_id):
+        while True:
+            # 先取得并发名额再领取任务，超出自适应并发限制的任务留在队列中排队
+            started_at = self.limiter.acquire(JOB_POLL_INTERVAL)
+            if started_at is None:
+                continue
+
+            try:
+                job = self._claim(worker_id)
+            except Exception as e:
+                print(f"[任务] 领取任务失败: {type(e).__name__}: {e}")
+                job = None
+
+            if job is None:
+                self.limiter.release(started_at)
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            with self._cond:
+                self._depth_estimate = max(self._depth_estimate - 1, 0)
+            started_at = time.time()
+            success = False
+            job_id = job['id']
+            with self._cond:
+                self._running[worker_id] = job_id
+            print(f"[任务] 开始执行: {job_id} (第 {job['attempts']} 次, 工作线程 {worker_id})")
+            self._upstream.success = None
+            try:
+                result = self._handler(job)
+                success = True
+                self._finish(job_id, worker_id, 'done', result=result)
+                print(f"[任务] 执行完成: {job_id}")
+            except Exception as e:
+                print(f"[任务] 执行失败: {job_id}: {type(e).__name__}: {e}")
+                print(f"[任务] 堆栈: {traceback.format_exc()}")
+                try:
+                    if self._finish(job_id, worker_id, 'failed', error=str(e)) and self._on_failure:
+                        self._on_failure(job)
+                except Exception as db_error:
+                    print(f"[任务] 写入失败状态出错: {db_error}")
+            finally:
+                with self._cond:
+                    self._running.pop(worker_id, None)
+                # 按上游调用的实际结果调整并发（上游失败后回退到模拟图片的任务也算失败）；
+                # 没有调用上游（命中缓存、未配置 API Key）的成功任务不参与调整
+                upstream = self._upstream.success
+                self.limiter.release(started_at, upstream if upstream is not None else (None if success else False))
+
+    def report_upstream_result(self, success):
+        """由任务处理函数在上游调用结束时调用（在执行任务的工作线程中）"""
+        self._upstream.success = success
+
+    def _heartbeat(self):
+        with self._cond:
+            job_ids = list(self._running.values())
+        if not job_ids:
+            return
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            placeholders = ','.join(['?' for _ in job_ids])
+            execute_query(c, f"UPDATE generation_jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE status = 'running' AND id IN ({placeholders})", job_ids)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def requeue_orphans(self):
+        """回收心跳超时的运行中任务（进程崩溃或重新部署留下的），并清理过期的已完成任务"""
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            stale = sql_seconds_ago(JOB_STALE_TIMEOUT)
+            execute_query(c, f'''
+                SELECT * FROM generation_jobs
+                WHERE status = 'running' AND heartbeat_at < {stale} AND attempts >= ?
+            ''', (JOB_MAX_ATTEMPTS,))
+            abandoned = []
+            for job in [self._row_to_job(row) for row in c.fetchall()]:
+                # 逐个按 id + 状态条件更新，多个进程同时回收时同一任务只会被放弃一次
+                execute_query(c, f'''
+                    UPDATE generation_jobs
+                    SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = 'running' AND heartbeat_at < {stale}
+                ''', ('任务多次中断，已放弃', job['id']))
+                if c.rowcount:
+                    abandoned.append(job)
+            failed = len(abandoned)
+            execute_query(c, f'''
+                UPDATE generation_jobs
+                SET status = 'queued', worker_id = NULL
+                WHERE status = 'running' AND heartbeat_at < {stale}
+            ''')
+            requeued = c.rowcount
+            execute_query(c, f"DELETE FROM generation_jobs WHERE status IN ('done', 'failed') AND finished_at < {sql_seconds_ago(JOB_RESULT_TTL)}")
+            conn.commit()
+        finally:
+            conn.close()
+        if self._on_failure:
+            for job in abandoned:
+                self._on_failure(job)
+        if requeued or failed:
+            print(f"[任务] 回收孤儿任务: 重新排队 {requeued} 个, 放弃 {failed} 个")
+            self._wakeup.set()
+
+    def _heartbeat_loop(self):
+        last_reap = 0
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                self._heartbeat()
+                if time.time() - last_reap >= JOB_STALE_TIMEOUT:
+                    last_reap = time.time()
+                    self.requeue_orphans()
+            except Exception as e:
+                print(f"[任务] 心跳/回收失败: {type(e).__name__}: {e}")
+
+    def get_stats(self):
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        conn = get_db_connection()
+        try:
+            c = get_db_cursor(conn)
+            execute_query(c, 'SELECT status, COUNT(*) AS total FROM generation_jobs GROUP BY status')
+            for row in c.fetchall():
+                status, total = (row['status'], row['total']) if isinstance(row, dict) else (row[0], row[1])
+                counts[status] = total
+        finally:
+            conn.close()
+        self._update_depth(counts['queued'])
+        with self._cond:
+            local_running = len(self._running)
+            rejections = self.rejections
+        return {
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'queue_depth': counts['queued'],
+            'local_running': local_running,
+            'rejections': rejections,
+            'concurrency': self.limiter.get_stats(),
+            'jobs': counts
+        }
+
 
-        print(f"[模拟模式] 图片已处理: {result_path}")
-        bg_type_text = '质感影棚' if background == 'textured' else '纯色背景'
-        bg_color_text = {'white': '白色', 'gray': '灰色', 'blue': '蓝色', 'black': '深灰', 'warm': '暖色'}.get(bg_color, '白色')
-        beauty_text = '轻微美颜' if beautify == 'yes' else '无美颜'
-        print(f"  风格: {style}, 服装: {clothing}, 背景: {bg_type_text}({bg_color_text}), 美颜: {beauty_text}")
+def run_generation_job(job):
+    """
+    执行一次生成任务（在后台工作线程中运行）
+
+    成功后扣减使用次数并记录生成日志，返回前端需要的结果字段；
+    任何失败都以异常抛出，由任务队列标记为 failed。
+    """
+    params = job['params']
+    filepath = job['file_path']
+    # 截止时间从上传时开始计算，排队过久的任务直接失败（不扣次数）
+    deadline = Deadline(at=params['deadline_at']) if params.get('deadline_at') else Deadline(GENERATION_DEADLINE)
+    deadline.check('排队')
+    print(f"[Upload] 开始处理上传: {job['file_name']}")
+    print(f"[Upload] 配置: style={params['style']}, clothing={params['clothing']}, angle={params['angle']}, "
+          f"bg={params['background']}, color={params['bg_color']}, beautify={params['beautify']}")
+
+    result_path = call_nanobanana_api(filepath, params['style'], params['clothing'], params['angle'],
+                                      params['background'], params['bg_color'], params['beautify'], deadline,
+                                      fresh=params.get('fresh', False),
+                                      on_result=generation_jobs.report_upstream_result)
+
+    print(f"[Upload] API 调用成功: {result_path}")
+
+    # 验证文件是否存在且可读
+    if not os.path.exists(result_path):
+        print(f"[Upload] 错误: 生成的文件不存在: {result_path}")
+        raise Exception('文件未正确保存')
+
+    # 验证文件大小（确保不是空文件）
+    file_size = os.path.getsize(result_path)
+    if file_size == 0:
+        print(f"[Upload] 错误: 生成的文件为空: {result_path}")
+        raise Exception('文件为空')
+
+    print(f"[Upload] 文件验证成功: {result_path} ({file_size} bytes)")
+
+    # 记录日志（包含IP和用户代理）
+    log_generation(job['code'], f"{params['style']}_{params['clothing']}_{params['background']}",
+                   job['file_name'], result_path, params['client_ip'], params['user_agent'])
+
+    return {
+        'result_url': f'/result/{os.path.basename(result_path)}',
+        # 使用次数已在上传时预占，这里是预占后的剩余次数（测试验证码为"无限"）
+        'remaining': params['remaining']
+    }
 
-        return result_path
 
+def release_job_reservation(job):
+    """任务最终失败时归还上传时预占的使用次数"""
+    try:
+        release_code(job['code'])
     except Exception as e:
-        print(f"图片处理失败: {e}")
-        return image_path  # 失败时返回原图
+        print(f"[任务] 归还使用次数失败: {job['id']}: {type(e).__name__}: {e}")
+
+
+generation_jobs = GenerationJobQueue(GENERATION_WORKERS, GENERATION_QUEUE_SIZE, run_generation_job,
+                                     on_failure=release_job_reservation)
 
 
 # ==================== 路由 ====================
@@ -1296,6 +4504,50 @@ def verify():
     })
 
 
+def compute_idempotency_key(code, options, file):
+    """
+    计算上传请求的幂等键
+
+    客户端提供 Idempotency-Key 请求头时使用该值（与验证码一起哈希），
+    否则使用图片内容 + 验证码 + 生成选项的 SHA-256，使网络重试的重复请求得到同一个键。
+    """
+    digest = hashlib.sha256()
+    digest.update(code.encode('utf-8'))
+    client_key = request.headers.get('Idempotency-Key', '').strip()
+    if client_key:
+        digest.update(b'\0key\0' + client_key[:200].encode('utf-8'))
+        return digest.hexdigest()
+
+    digest.update(b'\0options\0' + json.dumps(options, sort_keys=True).encode('utf-8'))
+    digest.update(b'\0image\0')
+    for chunk in iter(lambda: file.stream.read(PAYLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+
+def job_response(job):
+    """已存在任务的响应：已完成的直接返回结果，进行中的返回任务 ID 继续轮询"""
+    response = {
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': f"/api/jobs/{job['id']}"
+    }
+    if job['status'] == 'done':
+        response.update(job['result'])
+        return jsonify(response), 200
+    return jsonify(response), 202
+
+
+def busy_response(retry_after):
+    """排队已满时的 503 响应（带 Retry-After）"""
+    response = jsonify({'success': False, 'message': '当前排队人数过多，请稍后重试', 'retry_after': retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
 @app.route('/api/upload', methods=['POST'])
 def upload():
     """上传图片并生成（带安全检查）"""
@@ -1308,6 +4560,14 @@ def upload():
     if not allowed:
         return jsonify({'success': False, 'message': error_msg}), 429
 
+    # 排队已满时快速拒绝（在解析上传文件和查询数据库之前）
+    admitted, retry_after = generation_jobs.admit()
+    if not admitted:
+        return busy_response(retry_after)
+
+    # 本次生成的截止时间（排队、上游请求、重试和下载共用）
+    deadline = Deadline(GENERATION_DEADLINE)
+
     code = request.form.get('code', '').strip()
     style = request.form.get('style', 'portrait')
     clothing = request.form.get('clothing', 'business_suit')
@@ -1315,11 +4575,7 @@ def upload():
     background = request.form.get('background', 'textured')
     bg_color = request.form.get('bgColor', 'white')  # 获取背景色，默认白色
     beautify = request.form.get('beautify', 'no')  # 获取美颜选项，默认不美颜
-
-    # 验证验证码
-    result, error = verify_code(code)
-    if error:
-        return jsonify({'success': False, 'message': error}), 400
+    fresh = request.form.get('fresh', 'no').lower() in ('yes', 'true', '1')  # 跳过结果缓存，重新生成
 
     # 检查文件
     if 'image' not in request.files:
@@ -1332,52 +4588,93 @@ def upload():
     if not allowed_file(file.filename):
         return jsonify({'success': False, 'message': '只支持 PNG、JPG、JPEG、WEBP 格式'}), 400
 
+    # 重复提交（客户端重试）直接复用进行中或近期完成的任务，不重新生成也不重复扣次数
+    idempotency_key = compute_idempotency_key(code, {
+        'style': style,
+        'clothing': clothing,
+        'angle': angle,
+        'background': background,
+        'bg_color': bg_color,
+        'beautify': beautify,
+        'fresh': fresh
+    }, file)
+    existing_job = generation_jobs.find_by_key(idempotency_key)
+    if existing_job:
+        print(f"[Upload] 重复提交，复用任务: {existing_job['id']} ({existing_job['status']})")
+        return job_response(existing_job)
+
+    # 验证并原子预占一次使用次数（生成失败或未能入队时归还）
+    result, error = reserve_code(code)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+
     # 保存上传的文件
     filename = secure_filename(file.filename)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"{timestamp}_{filename}"
+    # 附加随机后缀，避免并发任务在同一秒内上传同名文件时互相覆盖
+    filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{filename}"
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
-
-    # 调用 API 生成图片
     try:
-        print(f"[Upload] 开始处理上传: {filename}")
-        print(f"[Upload] 配置: style={style}, clothing={clothing}, angle={angle}, bg={background}, color={bg_color}, beautify={beautify}")
-
-        result_path = call_nanobanana_api(filepath, style, clothing, angle, background, bg_color, beautify)
-
-        print(f"[Upload] API 调用成功: {result_path}")
-
-        # 验证文件是否存在且可读
-        if not os.path.exists(result_path):
-            print(f"[Upload] 错误: 生成的文件不存在: {result_path}")
-            return jsonify({'success': False, 'message': '生成失败：文件未正确保存'}), 500
-
-        # 验证文件大小（确保不是空文件）
-        file_size = os.path.getsize(result_path)
-        if file_size == 0:
-            print(f"[Upload] 错误: 生成的文件为空: {result_path}")
-            return jsonify({'success': False, 'message': '生成失败：文件为空'}), 500
+        file.save(filepath)
+
+        # 提交后台生成任务，立即返回任务 ID
+        job_id, created = generation_jobs.submit(code, filepath, filename, {
+            'style': style,
+            'clothing': clothing,
+            'angle': angle,
+            'background': background,
+            'bg_color': bg_color,
+            'beautify': beautify,
+            'fresh': fresh,
+            'remaining': result['remaining'],
+            'client_ip': client_ip,
+            'user_agent': user_agent,
+            'deadline_at': deadline.at
+        }, idempotency_key=idempotency_key)
+    except Exception as e:
+        # 保存文件（磁盘已满、客户端中途断开等）或提交任务失败时归还预占的次数
+        print(f"[Upload] 保存上传文件或提交任务失败，已归还次数: {type(e).__name__}: {e}")
+        release_code(code)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return jsonify({'success': False, 'message': '上传失败，请重试'}), 500
+
+    if not created:
+        release_code(code)
+    if not job_id:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return busy_response(generation_jobs.retry_after())
+    if not created:
+        # 并发的重复提交已合并到已有任务
+        return job_response(generation_jobs.get(job_id))
 
-        print(f"[Upload] 文件验证成功: {result_path} ({file_size} bytes)")
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/api/jobs/{job_id}'
+    }), 202
 
-        # 扣减使用次数（只在文件验证成功后）
-        use_code(code)
 
-        # 记录日志（包含IP和用户代理）
-        log_generation(code, f"{style}_{clothing}_{background}", filename, result_path, client_ip, user_agent)
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """查询生成任务状态（支持 ?wait=秒 长轮询）"""
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), JOB_LONG_POLL_MAX)
+    except ValueError:
+        wait = 0
 
-        return jsonify({
-            'success': True,
-            'result_url': f'/result/{os.path.basename(result_path)}',
-            'remaining': result['remaining'] - 1
-        })
+    job = generation_jobs.wait(job_id, wait) if wait else generation_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '任务不存在或已过期'}), 404
 
-    except Exception as e:
-        import traceback
-        print(f"[Upload] 异常: {type(e).__name__}: {e}")
-        print(f"[Upload] 堆栈: {traceback.format_exc()}")
-        return jsonify({'success': False, 'message': f'生成失败: {str(e)}'}), 500
+    response = {'success': True, 'job_id': job_id, 'status': job['status']}
+    if job['status'] == 'done':
+        response.update(job['result'])
+    elif job['status'] == 'failed':
+        response['message'] = f"生成失败: {job['error']}"
+    return jsonify(response)
 
 
 @app.route('/result/<filename>')
@@ -1452,6 +4749,19 @@ def debug_api():
     return jsonify(last_api_call)
 
 
+@app.route('/debug/metrics')
+def debug_metrics():
+    """调试端点 - 查看生成队列、并发限制、数据库连接池、审计日志、验证码缓存和统计对账指标"""
+    return jsonify({
+        'generation': generation_jobs.get_stats(),
+        'result_cache': result_cache.get_stats(),
+        'db_pool': db_pool.get_stats(),
+        'audit_log': audit_log.get_stats(),
+        'code_cache': code_cache.get_stats(),
+        'code_stats': code_stats_reconciler.get_stats()
+    })
+
+
 @app.route('/debug/network')
 def debug_network():
     """调试端点 - 查看网络配置状态"""
@@ -1464,13 +4774,11 @@ def debug_network():
         'proxies': PROXIES,
         'connect_timeout': CONNECT_TIMEOUT,
         'read_timeout': READ_TIMEOUT,
-        'circuit_breaker': {
-            'open': circuit_breaker['open'],
-            'failures': circuit_breaker['failures'],
-            'threshold': CIRCUIT_BREAKER_THRESHOLD,
-            'timeout': CIRCUIT_BREAKER_TIMEOUT,
-            'last_failure_time': circuit_breaker['last_failure_time']
-        },
+        'circuit_breaker': circuit_breakers.snapshot(),
+        'upstream_pool': upstream_client.get_stats(),
+        'routing': api_router.snapshot(),
+        'hedging': hedge_policy.get_stats(),
+        'rate_limit': upstream_limiter.get_stats(),
         'api_key_configured': bool(NANOBANANA_API_KEY),
         'api_key_length': len(NANOBANANA_API_KEY) if NANOBANANA_API_KEY else 0
     })
@@ -1483,7 +4791,8 @@ def status(code):
     if error:
         return jsonify({'success': False, 'message': error}), 400
 
-    # 获取生成历史
+    # 获取生成历史（先写入本进程缓冲中的生成记录，刚完成的生成能立即出现在历史中）
+    audit_log.flush()
     conn = get_db_connection()
     try:
         c = get_db_cursor(conn)
@@ -1539,6 +4848,218 @@ def showcase():
     return jsonify({'success': True, 'examples': examples})
 
 
+# ==================== 流式导出 ====================
+
+def stream_rows(query, params=None, batch_size=None):
+    """
+    按批读取查询结果（生成器），内存占用与总行数无关
+
+    PostgreSQL 使用服务端命名游标，每批只从数据库取 batch_size 行；SQLite 按批 fetchmany。
+    连接在生成器结束（或客户端断开、生成器被关闭）时归还连接池。
+    """
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    conn = get_db_connection()
+    try:
+        if db_type == 'postgresql' and POSTGRES_AVAILABLE:
+            c = conn.cursor(name=f'export_{uuid.uuid4().hex}', cursor_factory=RealDictCursor)
+            c.itersize = batch_size
+        else:
+            c = get_db_cursor(conn)
+        execute_query(c, query, params)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        c.close()
+    finally:
+        conn.close()
+
+
+def _row_values(row, columns):
+    """按列名取值（兼容 PostgreSQL 字典行和 SQLite 元组行）"""
+    if isinstance(row, dict):
+        return [row.get(column) for column in columns]
+    return list(row)
+
+
+def csv_export_response(filename, header, batches, format_row=None, compress=False, on_batch=None):
+    """
+    流式 CSV 响应：每批行经 csv 模块编码后立即写出，compress 为 True 时边生成边 gzip 压缩
+
+    format_row 把一行数据转换为输出的列表；on_batch 在一批数据写出后调用（例如标记已导出）。
+    """
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+        def drain():
+            data = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            return compressor.compress(data) if compressor else data
+
+        if header:
+            writer.writerow(header)
+        for rows in batches:
+            writer.writerows(format_row(row) if format_row else row for row in rows)
+            chunk = drain()
+            if chunk:
+                yield chunk
+            if on_batch:
+                on_batch(rows)
+        chunk = drain()
+        if compressor:
+            chunk += compressor.flush()
+        if chunk:
+            yield chunk
+
+    if compress:
+        filename += '.gz'
+    mimetype = 'application/gzip' if compress else ('text/csv' if filename.endswith('.csv') else 'text/plain')
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+def _wants_gzip():
+    """导出请求是否要求 gzip 压缩（?gzip=1）"""
+    return request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+
+
+def _mark_exported(rows):
+    """把一批已写出的验证码标记为已导出（使用单独的连接，不影响正在读取的游标）"""
+    codes = [row['code'] if isinstance(row, dict) else row[0] for row in rows]
+    conn = get_db_connection()
+    try:
+        c = get_db_cursor(conn)
+        placeholders = ','.join('?' for _ in codes)
+        execute_query(c, f"UPDATE verification_codes SET exported = ? WHERE code IN ({placeholders})", [True] + codes)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ==================== 批量生成验证码 ====================
+# 生成引擎在 bulk_codes.py 中（与命令行工具共用，每批写入时同时更新统计计数器）；
+# 大批量生成转为后台线程执行，进度保存在 code_generation_jobs 表中。
+
+CODE_GENERATION_SAMPLE_SIZE = 5        # 后台任务保留的预览验证码数量
+CODE_GENERATION_STALE_SECONDS = 120    # 运行中的任务超过该时间没有进度时视为已中断（例如进程重启）
+
+
+def generate_verification_codes(count, max_uses, job_id=None):
+    """
+    生成 count 个新验证码，返回 (验证码列表, 冲突次数)
+
+    传入 job_id 时每批同时更新任务进度，且只保留前几个验证码作为预览（大批量时不占用内存）。
+    """
+    codes = []
+
+    def on_batch(c, inserted):
+        if job_id is None:
+            codes.extend(inserted)
+        else:
+            codes.extend(inserted[:CODE_GENERATION_SAMPLE_SIZE - len(codes)])
+            execute_query(c, '''
+                UPDATE code_generation_jobs
+                SET generated = generated + ?, sample = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (len(inserted), json.dumps(codes), job_id))
+        # 清除这些验证码 "不存在" 的缓存
+        code_cache.invalidate(*inserted)
+
+    conn = get_db_connection()
+    try:
+        _, collisions = bulk_codes.generate_codes(conn, db_type, count, max_uses,
+                                                  batch_size=CODE_GENERATION_BATCH_SIZE, on_batch=on_batch)
+    finally:
+        conn.close()
+    return codes, collisions
+
+
+def start_code_generation_job(count, max_uses):
+    """创建批量生成任务并在后台线程中执行，返回任务 ID"""
+    job_id = uuid.uuid4().hex
+    conn = get_db_connection()
+    try:
+        c = get_db_cursor(conn)
+        execute_query(c, 'INSERT INTO code_generation_jobs (id, requested, max_uses) VALUES (?, ?, ?)',
+                      (job_id, count, max_uses))
+        conn.commit()
+    finally:
+        conn.close()
+    threading.Thread(target=run_code_generation_job, args=(job_id, count, max_uses),
+                     name=f'code-generation-{job_id[:8]}', daemon=True).start()
+    return job_id
+
+
+def run_code_generation_job(job_id, count, max_uses):
+    started = time.time()
+    collisions, error = 0, None
+    try:
+        _, collisions = generate_verification_codes(count, max_uses, job_id)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"[生成验证码] 任务 {job_id} 失败: {error}")
+
+    conn = get_db_connection()
+    try:
+        c = get_db_cursor(conn)
+        execute_query(c, '''
+            UPDATE code_generation_jobs
+            SET status = ?, error = ?, collisions = ?, updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', ('failed' if error else 'done', error, collisions, job_id))
+        conn.commit()
+    finally:
+        conn.close()
+    if not error:
+        print(f"[生成验证码] 任务 {job_id} 完成: {count} 个, 冲突 {collisions} 次, 用时 {time.time() - started:.1f} 秒")
+
+
+def get_code_generation_job(job_id):
+    """查询批量生成任务（不存在时返回 None）"""
+    columns = ('id', 'status', 'requested', 'max_uses', 'generated', 'collisions', 'sample', 'error',
+               'created_at', 'finished_at', 'stale')
+    conn = get_db_connection()
+    try:
+        c = get_db_cursor(conn)
+        execute_query(c, f'''
+            SELECT {', '.join(columns[:-1])},
+                   CASE WHEN status = 'running' AND updated_at < {sql_seconds_ago(CODE_GENERATION_STALE_SECONDS)}
+                        THEN 1 ELSE 0 END AS stale
+            FROM code_generation_jobs WHERE id = ?
+        ''', (job_id,))
+        row = c.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    if not isinstance(row, dict):
+        row = dict(zip(columns, row))
+    job = {
+        'id': row['id'],
+        'status': row['status'],
+        'requested': row['requested'],
+        'max_uses': row['max_uses'],
+        'generated': row['generated'],
+        'collisions': row['collisions'],
+        'sample': json.loads(row['sample']) if row['sample'] else [],
+        'error': row['error'],
+        'created_at': str(row['created_at']),
+        'finished_at': str(row['finished_at']) if row['finished_at'] else None
+    }
+    if row['stale']:
+        # 执行任务的进程已退出，已写入的验证码保留
+        job['status'] = 'failed'
+        job['error'] = '任务已中断'
+    return job
+
+
 # ==================== 管理后台路由 ====================
 
 @app.route('/admin/login', methods=['GET', 'POST'])
@@ -1569,134 +5090,344 @@ def admin_logout():
     return redirect(url_for('admin_login'))
 
 
+# 管理后台验证码列表每页数量
+ADMIN_PAGE_SIZE = 50
+ADMIN_PAGE_SIZE_MAX = 500
+
+
+def _codes_in(codes):
+    """返回 "code IN (...)" 条件和参数（用于统计批量操作影响的验证码）"""
+    return f"WHERE code IN ({','.join('?' for _ in codes)})", list(codes)
+
+
+def _encode_page_cursor(created_at, key):
+    """键集分页游标：最后一行的 (created_at, 唯一键)"""
+    return base64.urlsafe_b64encode(f"{created_at}|{key}".encode('utf-8')).decode('ascii')
+
+
+def _decode_page_cursor(cursor):
+    try:
+        created_at, key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+    except (ValueError, UnicodeError):
+        raise ValueError('无效的分页游标')
+    return created_at, key
+
+
+def _parse_admin_datetime(value, end_of_day=False):
+    """解析筛选条件中的日期（YYYY-MM-DD 或 YYYY-MM-DD HH:MM[:SS]），返回数据库可比较的字符串"""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    day = datetime.strptime(value, '%Y-%m-%d')
+    return day.strftime('%Y-%m-%d 23:59:59' if end_of_day else '%Y-%m-%d 00:00:00')
+
+
+def _code_listing_filters(args):
+    """把列表筛选参数转换为 WHERE 条件和参数，参数无效时抛出 ValueError"""
+    conditions, params = [], []
+
+    status = args.get('status')
+    if status:
+        if status not in ('active', 'inactive'):
+            raise ValueError('无效的状态')
+        conditions.append('status = ?')
+        params.append(status)
+
+    exported = args.get('exported')
+    if exported:
+        if exported not in ('yes', 'no'):
+            raise ValueError('无效的导出状态')
+        if exported == 'yes':
+            conditions.append('exported = ?')
+            params.append(True)
+        else:
+            conditions.append('(exported IS NULL OR exported = ?)')
+            params.append(False)
+
+    usage = args.get('usage')
+    if usage:
+        usage_conditions = {
+            'unused': 'used_count = 0',
+            'used': 'used_count > 0',
+            'exhausted': 'used_count >= max_uses',
+        }
+        if usage not in usage_conditions:
+            raise ValueError('无效的使用状态')
+        conditions.append(usage_conditions[usage])
+
+    for name, operator, end_of_day in (('created_from', '>=', False), ('created_to', '<=', True)):
+        value = args.get(name)
+        if value:
+            try:
+                params.append(_parse_admin_datetime(value, end_of_day))
+            except ValueError:
+                raise ValueError(f'无效的日期: {value}')
+            conditions.append(f'created_at {operator} ?')
+
+    return conditions, params
+
+
 @app.route('/admin')
 @admin_required
 def admin():
-    """管理后台"""
+    """管理后台（统计读取计数器表，验证码列表由页面按需分页加载）"""
+    return render_template('admin.html', stats=get_code_stats(), page_size=ADMIN_PAGE_SIZE)
+
+
+@app.route('/admin/api/stats')
+@admin_required
+def admin_api_stats():
+    """验证码统计"""
+    return jsonify({'success': True, 'stats': get_code_stats()})
+
+
+@app.route('/admin/api/codes')
+@admin_required
+def admin_api_codes():
+    """
+    验证码列表（按创建时间倒序，键集分页）
+
+    筛选参数: status（active/inactive）、exported（yes/no）、usage（unused/used/exhausted）、
+    created_from / created_to（YYYY-MM-DD[ HH:MM[:SS]]）；limit 为每页数量，
+    cursor 为上一页返回的 next_cursor（为 null 时表示没有更多数据）。
+    """
+    try:
+        conditions, params = _code_listing_filters(request.args)
+        limit = min(max(request.args.get('limit', ADMIN_PAGE_SIZE, type=int), 1), ADMIN_PAGE_SIZE_MAX)
+        cursor = request.args.get('cursor')
+        if cursor:
+            created_at, code = _decode_page_cursor(cursor)
+            conditions.append('(created_at < ? OR (created_at = ? AND code < ?))')
+            params.extend([created_at, created_at, code])
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
     conn = get_db_connection()
     try:
         c = get_db_cursor(conn)
-        execute_query(c, 'SELECT * FROM verification_codes ORDER BY created_at DESC')
-        codes = fetchall_rows(c)  # 使用 RowProxy 包装
-
-        # 预处理统计数据（替代 Jinja2 selectattr 过滤器）
-        stats = {
-            'total': len(codes),
-            'new': sum(1 for code in codes if code.used_count == 0),
-            'used': sum(1 for code in codes if code.used_count > 0),
-            'total_uses': sum(code.used_count for code in codes)
-        }
+        # 多取一行判断是否还有下一页
+        execute_query(c, f'''
+            SELECT code, max_uses, used_count, status, exported, created_at
+            FROM verification_codes
+            {where}
+            ORDER BY created_at DESC, code DESC
+            LIMIT ?
+        ''', params + [limit + 1])
+        rows = c.fetchall()
+    finally:
+        conn.close()
+
+    codes = []
+    for row in rows[:limit]:
+        if not isinstance(row, dict):
+            row = dict(zip(('code', 'max_uses', 'used_count', 'status', 'exported', 'created_at'), row))
+        codes.append({
+            'code': row['code'],
+            'max_uses': row['max_uses'],
+            'used_count': row['used_count'],
+            'remaining': row['max_uses'] - row['used_count'],
+            'status': row['status'],
+            'exported': bool(row['exported']),
+            'created_at': str(row['created_at'])
+        })
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = codes[-1]
+        next_cursor = _encode_page_cursor(last['created_at'], last['code'])
+    return jsonify({'success': True, 'codes': codes, 'next_cursor': next_cursor})
+
+
+# 安全日志查询每页最大数量
+SECURITY_LOG_PAGE_SIZE_MAX = 1000
+
+
+def _security_log_filters(args):
+    """
+    安全日志筛选条件：created_from / created_to（时间范围）、ip、code、success（yes/no）、
+    reason（失败原因前缀，如 "频率限制"）；参数无效时抛出 ValueError
+    """
+    conditions, params = [], []
+
+    for name, operator, end_of_day in (('created_from', '>=', False), ('created_to', '<=', True)):
+        value = args.get(name)
+        if value:
+            try:
+                params.append(_parse_admin_datetime(value, end_of_day))
+            except ValueError:
+                raise ValueError(f'无效的日期: {value}')
+            conditions.append(f'created_at {operator} ?')
+
+    for name in ('ip', 'code'):
+        value = args.get(name)
+        if value:
+            conditions.append(f"{'ip_address' if name == 'ip' else 'code'} = ?")
+            params.append(value.strip())
+
+    success = args.get('success')
+    if success:
+        if success not in ('yes', 'no'):
+            raise ValueError('无效的验证结果')
+        conditions.append('success = ?')
+        params.append(success == 'yes')
+
+    reason = args.get('reason')
+    if reason:
+        # 前缀匹配，转义 LIKE 通配符
+        escaped = reason.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("failure_reason LIKE ? ESCAPE '\\'")
+        params.append(escaped + '%')
+
+    return conditions, params
+
+
+def _security_log_row(row):
+    if not isinstance(row, dict):
+        row = dict(zip(('id', 'code', 'ip_address', 'success', 'failure_reason', 'created_at'), row))
+    return {
+        'id': row['id'],
+        'code': row['code'] or '',
+        'ip_address': row['ip_address'] or '',
+        'success': bool(row['success']),
+        'failure_reason': row['failure_reason'] or '',
+        'created_at': str(row['created_at'])
+    }
+
+
+@app.route('/admin/api/security_logs')
+@admin_required
+def admin_api_security_logs():
+    """
+    安全日志查询（按时间倒序，键集分页）
 
-        return render_template('admin.html', codes=codes, stats=stats)
+    筛选参数见 _security_log_filters；limit 为每页数量（最多 1000），
+    cursor 为上一页返回的 next_cursor（为 null 时表示没有更多数据）。
+    """
+    try:
+        conditions, params = _security_log_filters(request.args)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), SECURITY_LOG_PAGE_SIZE_MAX)
+        cursor = request.args.get('cursor')
+        if cursor:
+            created_at, last_id = _decode_page_cursor(cursor)
+            if not last_id.isdigit():
+                raise ValueError('无效的分页游标')
+            # created_at <= ? 让数据库可以直接在索引上定位起点，而不是从头扫描
+            conditions.append('created_at <= ? AND (created_at < ? OR id < ?)')
+            params.extend([created_at, created_at, int(last_id)])
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    # 先写入本进程缓冲中的验证记录
+    audit_log.flush()
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    conn = get_db_connection()
+    try:
+        c = get_db_cursor(conn)
+        # 多取一行判断是否还有下一页
+        execute_query(c, f'''
+            SELECT id, code, ip_address, success, failure_reason, created_at
+            FROM verification_attempts
+            {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', params + [limit + 1])
+        rows = c.fetchall()
     finally:
         conn.close()
 
+    logs = [_security_log_row(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = _encode_page_cursor(logs[-1]['created_at'], logs[-1]['id'])
+    return jsonify({'success': True, 'logs': logs, 'next_cursor': next_cursor})
+
 
 @app.route('/admin/generate_codes', methods=['POST'])
 @admin_required
 def admin_generate_codes():
-    """批量生���验证码"""
-    try:
-        data = request.json
-        count = data.get('count', 10)
-        max_uses = data.get('max_uses', 3)
+    """
+    批量生成验证码
 
-        conn = get_db_connection()
-        try:
-            c = get_db_cursor(conn)
+    数量不超过 CODE_GENERATION_SYNC_LIMIT 时直接返回生成的验证码；
+    否则创建后台任务并返回 202 和任务 ID，通过 /admin/api/generate_jobs/<job_id> 查询进度。
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        count = int(data.get('count', 10))
+        max_uses = int(data.get('max_uses', 3))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '数量和使用次数必须是整数'}), 400
+    if not 1 <= count <= CODE_GENERATION_MAX_COUNT or max_uses < 1:
+        return jsonify({'success': False, 'message': f'生成数量须在 1 到 {CODE_GENERATION_MAX_COUNT} 之间，使用次数至少为 1'}), 400
 
-            codes = []
-            for _ in range(count):
-                code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-                try:
-                    # 根据数据库类型使用不同的占位符
-                    if db_type == 'postgresql':
-                        c.execute('INSERT INTO verification_codes (code, max_uses) VALUES (%s, %s)', (code, max_uses))
-                    else:
-                        c.execute('INSERT INTO verification_codes (code, max_uses) VALUES (?, ?)', (code, max_uses))
-                    codes.append(code)
-                except Exception:
-                    # 捕获所有数据库唯一性约束错误（兼容 PostgreSQL 和 SQLite）
-                    continue
+    try:
+        if count > CODE_GENERATION_SYNC_LIMIT:
+            job_id = start_code_generation_job(count, max_uses)
+            return jsonify({'success': True, 'job_id': job_id, 'job': get_code_generation_job(job_id)}), 202
 
-            conn.commit()
-            return jsonify({'success': True, 'codes': codes, 'count': len(codes)})
-        finally:
-            conn.close()
+        codes, _ = generate_verification_codes(count, max_uses)
+        return jsonify({'success': True, 'codes': codes, 'count': len(codes)})
     except Exception as e:
-        import traceback
         print(f"[ERROR] admin_generate_codes failed: {e}")
         print(f"[ERROR] Traceback: {traceback.format_exc()}")
         return jsonify({'success': False, 'message': f'生成失败: {str(e)}'}), 500
 
 
-@app.route('/admin/export_codes')
+@app.route('/admin/api/generate_jobs/<job_id>')
 @admin_required
-def export_codes():
-    """导出所有活跃验证码"""
-    conn = get_db_connection()
-    try:
-        c = get_db_cursor(conn)
-        c.execute("SELECT code FROM verification_codes WHERE status = 'active' ORDER BY code")
-        # 兼容 PostgreSQL（返回字典）和 SQLite（返回元组）
-        codes = [row['code'] if isinstance(row, dict) else row[0] for row in c.fetchall()]
-
-        # 返回文本文件
-        output = io.StringIO()
-        for code in codes:
-            output.write(f"{code}\n")
+def admin_api_generate_job(job_id):
+    """批量生成任务进度"""
+    job = get_code_generation_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': job})
 
-        # 标记为已导出
-        if codes:
-            if db_type == 'postgresql':
-                placeholders = ','.join(['%s' for _ in codes])
-                execute_query(c, f"UPDATE verification_codes SET exported = TRUE WHERE code IN ({placeholders})", codes)
-            else:
-                placeholders = ','.join(['?' for _ in codes])
-                execute_query(c, f"UPDATE verification_codes SET exported = 1 WHERE code IN ({placeholders})", codes)
-            conn.commit()
 
-        return Response(
-            output.getvalue(),
-            mimetype='text/plain',
-            headers={'Content-Disposition': 'attachment; filename=verification_codes.txt'}
-        )
-    finally:
-        conn.close()
+@app.route('/admin/export_codes')
+@admin_required
+def export_codes():
+    """导出所有活跃验证码（流式输出，每写出一批即标记为已导出）"""
+    batches = stream_rows("SELECT code FROM verification_codes WHERE status = 'active' ORDER BY code")
+    return csv_export_response('verification_codes.txt', None, batches,
+                               format_row=lambda row: _row_values(row, ('code',)),
+                               compress=_wants_gzip(), on_batch=_mark_exported)
 
 
 @app.route('/admin/export_security_logs')
 @admin_required
 def export_security_logs():
-    """导出安全审计日志"""
-    conn = get_db_connection()
+    """导出安全审计日志（筛选条件与 /admin/api/security_logs 相同，按时间倒序流式输出，可用 ?limit= 限制行数）"""
     try:
-        c = get_db_cursor(conn)
-        c.execute('''
-            SELECT code, ip_address, success, failure_reason, created_at
-            FROM verification_attempts
-            ORDER BY created_at DESC
-            LIMIT 1000
-        ''')
-        rows = c.fetchall()
-
-        # 返回CSV文件
-        output = io.StringIO()
-        output.write("验证码,IP地址,是否成功,失败原因,时间\n")
-        for row in rows:
-            # 兼容 PostgreSQL（字典）和 SQLite（元组）
-            if isinstance(row, dict):
-                output.write(f"{row.get('code', '') or ''},{row.get('ip_address', '') or ''},{row.get('success', False)},{row.get('failure_reason', '') or ''},{row.get('created_at', '')}\n")
-            else:
-                output.write(f"{row[0] or ''},{row[1] or ''},{row[2]},{row[3] or ''},{row[4]}\n")
-
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': 'attachment; filename=security_logs.csv'}
-        )
-    finally:
-        conn.close()
+        conditions, params = _security_log_filters(request.args)
+        limit = request.args.get('limit', type=int)
+        # 负数在 SQLite 中表示不限制，在 PostgreSQL 中会在已开始输出后报错，提前拒绝
+        if limit is not None and limit < 1:
+            raise ValueError('导出数量必须大于 0')
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    # 先写入本进程缓冲中的验证记录
+    audit_log.flush()
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f'''
+        SELECT code, ip_address, success, failure_reason, created_at
+        FROM verification_attempts
+        {where}
+        ORDER BY created_at DESC, id DESC
+    '''
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    def format_row(row):
+        code, ip_address, success, failure_reason, created_at = _row_values(
+            row, ('code', 'ip_address', 'success', 'failure_reason', 'created_at'))
+        return [code or '', ip_address or '', '是' if success else '否', failure_reason or '', created_at]
+
+    return csv_export_response('security_logs.csv', ['验证码', 'IP地址', '是否成功', '失败原因', '时间'],
+                               stream_rows(query, params or None), format_row=format_row, compress=_wants_gzip())
 
 
 @app.route('/admin/batch_delete', methods=['POST'])
@@ -1721,9 +5452,13 @@ def batch_delete():
             placeholders = ','.join(['?' for _ in codes])
             query = f'DELETE FROM verification_codes WHERE code IN ({placeholders})'
 
+        where, params = _codes_in(codes)
+        before = code_stats_snapshot(c, where, params)
         c.execute(query, codes)
         deleted = c.rowcount
+        record_code_stats_change(c, before, where, params)
         conn.commit()
+        code_cache.invalidate(*codes)
         return jsonify({'success': True, 'deleted': deleted})
     finally:
         conn.close()
@@ -1750,10 +5485,14 @@ def batch_update_status():
         # 根据数据库类型使用不同的占位符
         placeholder_char = '%s' if db_type == 'postgresql' else '?'
         placeholders = ','.join([placeholder_char for _ in codes])
+        where, params = _codes_in(codes)
+        before = code_stats_snapshot(c, where, params)
         c.execute(f'UPDATE verification_codes SET status = {placeholder_char} WHERE code IN ({placeholders})', [status] + codes)
 
         updated = c.rowcount
+        record_code_stats_change(c, before, where, params)
         conn.commit()
+        code_cache.invalidate(*codes)
         return jsonify({'success': True, 'updated': updated})
     finally:
         conn.close()
@@ -1773,12 +5512,15 @@ def reset_code():
     try:
         c = get_db_cursor(conn)
 
+        before = code_stats_snapshot(c, 'WHERE code = ?', (code,))
         execute_query(c, 'UPDATE verification_codes SET used_count = 0, status = \'active\' WHERE code = ?', (code,))
 
         if c.rowcount == 0:
             return jsonify({'success': False, 'message': '验证码不存在'}), 404
 
+        record_code_stats_change(c, before, 'WHERE code = ?', (code,))
         conn.commit()
+        code_cache.invalidate(code)
         return jsonify({'success': True})
     finally:
         conn.close()
@@ -1806,9 +5548,13 @@ def batch_reset():
             placeholders = ','.join(['?' for _ in codes])
             query = f'UPDATE verification_codes SET used_count = 0, status = \'active\' WHERE code IN ({placeholders})'
 
+        where, params = _codes_in(codes)
+        before = code_stats_snapshot(c, where, params)
         c.execute(query, codes)
         reset_count = c.rowcount
+        record_code_stats_change(c, before, where, params)
         conn.commit()
+        code_cache.invalidate(*codes)
         return jsonify({'success': True, 'reset': reset_count})
     finally:
         conn.close()
@@ -1822,11 +5568,15 @@ def clear_exhausted_codes():
     try:
         c = get_db_cursor(conn)
 
-        # 删除已用完的验证码（used_count >= max_uses）
-        execute_query(c, 'DELETE FROM verification_codes WHERE used_count >= max_uses')
+        # 删除已用完的验证码（used_count >= max_uses），计数器减去被删除的部分
+        exhausted = 'WHERE used_count >= max_uses'
+        before = code_stats_snapshot(c, exhausted, ())
+        execute_query(c, f'DELETE FROM verification_codes {exhausted}')
 
         deleted = c.rowcount
+        apply_code_stats_delta(c, {key: -before[key] for key in CODE_STATS_FIELDS})
         conn.commit()
+        code_cache.clear()
         return jsonify({'success': True, 'deleted': deleted, 'message': f'已清除 {deleted} 个已用完的验证码'})
     finally:
         conn.close()
@@ -1835,34 +5585,20 @@ def clear_exhausted_codes():
 @app.route('/admin/export_all_csv')
 @admin_required
 def export_all_csv():
-    """导出所有验证码为 CSV 格式（含详细信息）"""
-    conn = get_db_connection()
-    try:
-        c = get_db_cursor(conn)
-        c.execute('''
-            SELECT code, max_uses, used_count, status, created_at
-            FROM verification_codes
-            ORDER BY created_at DESC
-        ''')
-        rows = c.fetchall()
-
-        # 返回CSV文件
-        output = io.StringIO()
-        output.write("验证码,最大使用次数,已使用次数,状态,创建时间\n")
+    """导出所有验证码为 CSV 格式（含详细信息，流式输出）"""
+    batches = stream_rows('''
+        SELECT code, max_uses, used_count, status, created_at
+        FROM verification_codes
+        ORDER BY created_at DESC
+    ''')
 
-        for row in rows:
-            if isinstance(row, dict):
-                output.write(f"{row.get('code', '')},{row.get('max_uses', 0)},{row.get('used_count', 0)},{'活跃' if row.get('status') == 'active' else '禁用'},{row.get('created_at', '')}\n")
-            else:
-                output.write(f"{row[0]},{row[1]},{row[2]},{'活跃' if row[3] == 'active' else '禁用'},{row[4]}\n")
+    def format_row(row):
+        code, max_uses, used_count, status, created_at = _row_values(
+            row, ('code', 'max_uses', 'used_count', 'status', 'created_at'))
+        return [code, max_uses, used_count, '活跃' if status == 'active' else '禁用', created_at]
 
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': 'attachment; filename=all_codes.csv'}
-        )
-    finally:
-        conn.close()
+    return csv_export_response('all_codes.csv', ['验证码', '最大使用次数', '已使用次数', '状态', '创建时间'],
+                               batches, format_row=format_row, compress=_wants_gzip())
 
 
 @app.route('/admin/get_exportable_codes')
@@ -1948,6 +5684,15 @@ def export_selected_codes():
 # 初始化数据库（在任何环境下都执行）
 init_db()
 
+# 启动后台生成工作线程（会先恢复上次进程中断的任务）
+generation_jobs.start()
+
+# 启动多线路延迟探测
+api_router.start()
+
+# 启动验证码统计计数器定期对账
+code_stats_reconciler.start()
+
 if __name__ == '__main__':
     # 支持通过环境变量配置端口
     port = int(os.getenv('PORT', 5000))
@@ -0,0 +1,152 @@
+"""
+安全日志查询/导出基准测试
+在临时 SQLite 数据库中生成大量验证尝试记录（默认 1000 万行，分布在 30 天内），
+测量 /admin/api/security_logs 各类筛选的首页、深分页耗时，以及按时间范围流式导出的吞吐量，
+并与旧的 OFFSET 分页对比。
+
+使用方法:
+    python bench_security_logs.py                  # 1000 万行
+    python bench_security_logs.py --rows 1000000   # 快速验证
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DAYS = 30
+REASONS = ['验证码不存在', '验证码已失效', '验证码使用次数已用完', '频率限制: 请求过于频繁', '请输入验证码']
+
+
+def load_app(workdir):
+    """在临时目录中导入 app（使用独立的 codes.db，不启动后台线程）"""
+    os.chdir(workdir)
+    os.environ['GENERATION_WORKERS'] = '0'
+    os.environ['CODE_STATS_RECONCILE_INTERVAL'] = '0'
+    for key in ('DATABASE_URL', 'RAILWAY_ENVIRONMENT', 'RAILWAY_VOLUME_PATH'):
+        os.environ.pop(key, None)
+    sys.path.insert(0, ROOT)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+    return app
+
+
+def populate(app, rows, start):
+    """按时间顺序批量写入验证尝试记录"""
+    rng = random.Random(42)
+    step = DAYS * 86400 / rows
+    conn = app.get_db_connection()
+    try:
+        batch = []
+        for i in range(rows):
+            created_at = (start + timedelta(seconds=int(i * step))).strftime('%Y-%m-%d %H:%M:%S')
+            success = rng.random() < 0.3
+            batch.append((
+                f'C{rng.randrange(200000):07d}',
+                f'10.{rng.randrange(200)}.{rng.randrange(250)}.{rng.randrange(1, 250)}',
+                success,
+                None if success else rng.choice(REASONS),
+                created_at
+            ))
+            if len(batch) == 100000:
+                conn.executemany('INSERT INTO verification_attempts (code, ip_address, success, failure_reason, created_at) '
+                                 'VALUES (?, ?, ?, ?, ?)', batch)
+                batch = []
+        if batch:
+            conn.executemany('INSERT INTO verification_attempts (code, ip_address, success, failure_reason, created_at) '
+                             'VALUES (?, ?, ?, ?, ?)', batch)
+        conn.commit()
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+
+
+def timed(fn, repeat=5):
+    """返回多次执行耗时的中位数（毫秒）和最后一次的结果"""
+    samples, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), result
+
+
+def raw_query(app, sql, params=()):
+    conn = app.get_db_connection()
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='安全日志查询/导出基准测试')
+    parser.add_argument('--rows', type=int, default=10_000_000, help='生成的记录数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_security_logs_')
+    try:
+        app = load_app(workdir)
+        start = datetime(2026, 1, 1)
+        started = time.perf_counter()
+        populate(app, args.rows, start)
+        print(f"已生成 {args.rows:,} 行（{time.perf_counter() - started:.1f} 秒）")
+
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session['admin_logged_in'] = True
+
+        def api(**params):
+            response = client.get('/admin/api/security_logs', query_string=params)
+            assert response.status_code == 200, response.get_data(as_text=True)
+            return response.get_json()
+
+        # 取中间位置的一行作为深分页游标
+        middle = raw_query(app, 'SELECT created_at, id FROM verification_attempts ORDER BY created_at DESC, id DESC '
+                                'LIMIT 1 OFFSET ?', (args.rows // 2,))[0]
+        deep_cursor = app._encode_page_cursor(middle[0], middle[1])
+        sample = raw_query(app, 'SELECT ip_address, code FROM verification_attempts WHERE id = ?', (args.rows // 3,))[0]
+        day = (start + timedelta(days=DAYS // 2)).strftime('%Y-%m-%d')
+
+        cases = [
+            ('首页（无筛选）', {}),
+            ('深分页（第 N/2 行之后）', {'cursor': deep_cursor}),
+            ('按 IP', {'ip': sample[0]}),
+            ('按验证码', {'code': sample[1]}),
+            ('单日时间范围', {'created_from': day, 'created_to': day}),
+            ('单日 + 失败 + 原因前缀', {'created_from': day, 'created_to': day, 'success': 'no', 'reason': '频率限制'}),
+        ]
+        print(f"\n{'查询':<28}{'耗时(ms)':>10}{'返回行数':>10}")
+        for name, params in cases:
+            elapsed, data = timed(lambda: api(limit=100, **params))
+            print(f"{name:<28}{elapsed:>10.1f}{len(data['logs']):>10}")
+
+        # 旧方式对比：OFFSET 深分页需要跳过前面的所有行
+        elapsed, _ = timed(lambda: raw_query(app, 'SELECT * FROM verification_attempts ORDER BY created_at DESC '
+                                                  'LIMIT 100 OFFSET ?', (args.rows // 2,)), repeat=3)
+        print(f"{'对比: OFFSET 深分页':<28}{elapsed:>10.1f}{100:>10}")
+
+        # 单日范围流式导出
+        started = time.perf_counter()
+        response = client.get('/admin/export_security_logs', query_string={'created_from': day, 'created_to': day},
+                              buffered=False)
+        size = sum(len(chunk) for chunk in response.response)
+        response.close()
+        elapsed = time.perf_counter() - started
+        exported = args.rows // DAYS
+        print(f"\n单日导出: 约 {exported:,} 行, {size / 1024 / 1024:.1f} MB, {elapsed:.2f} 秒"
+              f"（约 {exported / elapsed:,.0f} 行/秒）")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+SQLite 并发基准测试
+模拟多个 gunicorn worker 进程同时验证验证码和上传（预占次数 + 写生成记录），
+比较不同 journal_mode 下的吞吐量和 "database is locked" 错误数。
+
+使用方法:
+    python bench_sqlite.py                          # 默认 WAL，1/4/8 个 worker
+    python bench_sqlite.py --journal-mode DELETE    # 对比旧的回滚日志模式
+    python bench_sqlite.py --workers 1 2 4 8 16 --duration 10
+"""
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_CODE = 'BENCH001'
+
+
+def load_app(workdir, journal_mode):
+    """在临时目录中导入 app（使用独立的 codes.db，不启动后台生成线程）"""
+    os.chdir(workdir)
+    os.environ['SQLITE_JOURNAL_MODE'] = journal_mode
+    os.environ['GENERATION_WORKERS'] = '0'
+    for key in ('DATABASE_URL', 'RAILWAY_ENVIRONMENT', 'RAILWAY_VOLUME_PATH'):
+        os.environ.pop(key, None)
+    sys.path.insert(0, ROOT)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+    return app
+
+
+def worker(app, op, deadline, results):
+    """在截止时间前循环执行一种操作，返回 (成功次数, 锁冲突次数, 其它错误次数)"""
+    done = locked = errors = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        while time.time() < deadline:
+            try:
+                if op == 'verify':
+                    info, error = app.verify_code(BENCH_CODE)
+                    app.log_verification_attempt(BENCH_CODE, '127.0.0.1', info is not None, error)
+                else:
+                    info, error = app.reserve_code(BENCH_CODE)
+                    app.log_generation(BENCH_CODE, 'haima', 'bench.jpg', 'bench_result.jpg', '127.0.0.1', 'bench')
+                    app.release_code(BENCH_CODE)
+                done += 1
+            except Exception as e:
+                if 'locked' in str(e):
+                    locked += 1
+                else:
+                    errors += 1
+    results.put((done, locked, errors))
+
+
+def run(app, op, workers, duration):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    deadline = time.time() + duration
+    procs = [ctx.Process(target=worker, args=(app, op, deadline, results)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    totals = [0, 0, 0]
+    for _ in procs:
+        for i, value in enumerate(results.get()):
+            totals[i] += value
+    for p in procs:
+        p.join()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite 并发基准测试')
+    parser.add_argument('--journal-mode', default='WAL', help='SQLITE_JOURNAL_MODE（WAL / DELETE）')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help='worker 进程数')
+    parser.add_argument('--duration', type=float, default=5, help='每轮测试时长（秒）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_sqlite_')
+    try:
+        app = load_app(workdir, args.journal_mode.upper())
+        conn = app.get_db_connection()
+        conn.execute('INSERT INTO verification_codes (code, max_uses) VALUES (?, ?)', (BENCH_CODE, 10 ** 9))
+        conn.commit()
+        conn.close()
+
+        print(f"journal_mode: {app.db_pool.journal_mode}, busy_timeout: {app.SQLITE_BUSY_TIMEOUT}ms, 每轮 {args.duration:g} 秒")
+        print(f"{'操作':<8}{'worker':>8}{'次数/秒':>12}{'锁冲突':>10}{'其它错误':>10}")
+        for op in ('verify', 'upload'):
+            for workers in args.workers:
+                done, locked, errors = run(app, op, workers, args.duration)
+                print(f"{op:<8}{workers:>8}{done / args.duration:>12.1f}{locked:>10}{errors:>10}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
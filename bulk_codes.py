@@ -0,0 +1,138 @@
+"""
+验证码批量生成引擎
+管理后台（app.py 的后台生成任务）和命令行工具（generate_codes.py、simple_generate_codes.py）共用，
+支持 PostgreSQL 和 SQLite。
+
+用 secrets 生成随机验证码，每批在内存中去重后一次写入，已存在的验证码由数据库跳过，
+然后按实际写入数补足，直到写入请求的数量。每批写入时在同一个事务中更新管理后台的统计计数器。
+"""
+
+import os
+import random
+import secrets
+import sqlite3
+import string
+
+try:
+    import psycopg2
+    from psycopg2.extras import execute_values
+    POSTGRES_AVAILABLE = True
+except ImportError:
+    POSTGRES_AVAILABLE = False
+
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 8
+DEFAULT_BATCH_SIZE = 5000
+
+# 管理后台统计计数器（code_stats 表）的行数，更新时随机选择一行，避免并发更新争抢同一行锁
+CODE_STATS_SHARDS = 8
+
+
+# 随机字节映射为字符：丢弃 >= 252（36 的整数倍）的字节，保证每个字符出现的概率相同
+_BYTE_TO_CHAR = bytes(ord(CODE_ALPHABET[b % len(CODE_ALPHABET)]) for b in range(256))
+_REJECTED_BYTES = bytes(range(256 - 256 % len(CODE_ALPHABET), 256))
+
+
+def random_codes(count, length=CODE_LENGTH):
+    """生成 count 个随机验证码（可能重复，由调用方去重）"""
+    needed = count * length
+    chars = b''
+    while len(chars) < needed:
+        # 约 1.6% 的字节会被丢弃，多取一些，通常一次即可
+        chars += secrets.token_bytes((needed - len(chars)) * 33 // 32 + 16).translate(_BYTE_TO_CHAR, _REJECTED_BYTES)
+    text = chars[:needed].decode('ascii')
+    return [text[i:i + length] for i in range(0, needed, length)]
+
+
+def _insert_batch(cursor, db_type, codes, max_uses):
+    """写入一批验证码，返回实际写入的验证码（已存在的跳过）"""
+    if db_type == 'postgresql':
+        rows = execute_values(cursor, '''
+            INSERT INTO verification_codes (code, max_uses) VALUES %s
+            ON CONFLICT (code) DO NOTHING
+            RETURNING code
+        ''', [(code, max_uses) for code in codes], page_size=len(codes), fetch=True)
+        return [row['code'] if isinstance(row, dict) else row[0] for row in rows]
+
+    # SQLite 先取得写锁（其它连接此时不能写入），executemany 一次写入，rowcount 为实际写入数。
+    # 全部写入时直接返回；有验证码已存在（很少见）时，新写入的行即 rowid 大于写入前最大值的行
+    if not cursor.connection.in_transaction:
+        cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('SELECT COALESCE(MAX(rowid), 0) FROM verification_codes')
+    last_rowid = cursor.fetchone()[0]
+    cursor.executemany('INSERT OR IGNORE INTO verification_codes (code, max_uses) VALUES (?, ?)',
+                       [(code, max_uses) for code in codes])
+    if cursor.rowcount == len(codes):
+        return codes
+    cursor.execute('SELECT code FROM verification_codes WHERE rowid > ? ORDER BY rowid', (last_rowid,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _record_code_stats(cursor, db_type, created):
+    """新写入的验证码计入统计计数器（新验证码未使用且为启用状态）"""
+    placeholder = '%s' if db_type == 'postgresql' else '?'
+    cursor.execute(f'''
+        UPDATE code_stats
+        SET total = total + {placeholder}, new = new + {placeholder}, active = active + {placeholder}
+        WHERE shard = {placeholder}
+    ''', (created, created, created, random.randrange(CODE_STATS_SHARDS)))
+
+
+def generate_codes(conn, db_type, count, max_uses=3, batch_size=DEFAULT_BATCH_SIZE, on_batch=None):
+    """
+    生成并写入 count 个新验证码，返回 (写入数量, 冲突次数)
+
+    每批写入并更新统计计数器后提交；on_batch(cursor, codes) 在提交前以本批写入的验证码调用
+    （与写入在同一个事务中），可用于写出文件和报告进度。on_batch 抛出异常时本批回滚，已提交的批次保留。
+    """
+    cursor = conn.cursor()
+    created = collisions = 0
+    while created < count:
+        needed = min(count - created, batch_size)
+        batch = set()
+        while len(batch) < needed:
+            candidates = random_codes(needed - len(batch))
+            before = len(batch)
+            batch.update(candidates)
+            collisions += len(candidates) - (len(batch) - before)
+
+        try:
+            inserted = _insert_batch(cursor, db_type, list(batch), max_uses)
+            if inserted:
+                _record_code_stats(cursor, db_type, len(inserted))
+                if on_batch:
+                    on_batch(cursor, inserted)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        created += len(inserted)
+        collisions += needed - len(inserted)
+    return created, collisions
+
+
+def connect_database(database_url=None, database_path=None):
+    """
+    命令行工具连接数据库，返回 (连接, 数据库类型)
+
+    与 app.py 使用同一个数据库：Railway 环境有 DATABASE_URL 时使用 PostgreSQL，
+    否则使用 SQLite（Railway 上为持久化目录中的 codes.db，本地为 DATABASE_PATH，默认 codes.db）。
+    传入 database_url 时直接连接该 PostgreSQL。
+    """
+    is_railway = os.getenv('RAILWAY_ENVIRONMENT') or os.getenv('RAILWAY_VOLUME_PATH')
+    if database_url is None and is_railway:
+        database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        if not POSTGRES_AVAILABLE:
+            raise RuntimeError('连接 PostgreSQL 需要安装 psycopg2-binary')
+        return psycopg2.connect(database_url), 'postgresql'
+
+    if database_path is None:
+        if is_railway:
+            database_path = os.path.join(os.getenv('RAILWAY_VOLUME_MOUNT_PATH', '/data'), 'codes.db')
+        else:
+            database_path = os.getenv('DATABASE_PATH', 'codes.db')
+    if not os.path.exists(database_path):
+        raise FileNotFoundError(f'数据库不存在: {database_path}（请先启动应用初始化数据库）')
+    # 应用同时运行时等待写锁，而不是立即报 database is locked
+    return sqlite3.connect(database_path, timeout=30), 'sqlite'
@@ -1,16 +1,18 @@
 """
 验证码批量生成工具
 使用方法: python generate_codes.py --count 100 --output codes.txt
+
+与应用使用同一个数据库（Railway 上为 PostgreSQL 或持久化 SQLite，本地为 DATABASE_PATH），
+也可用 --database-url 指定 PostgreSQL。
 """
 
 import argparse
-import sqlite3
-import random
-import string
 import sys
-import os
+import time
 from dotenv import load_dotenv
 
+import bulk_codes
+
 load_dotenv()
 
 # Windows 控制台编码修复
@@ -19,50 +21,27 @@ if sys.platform == 'win32':
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
 
-def generate_code(length=8):
-    """生成随机验证码"""
-    chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
-
-
-def generate_codes(count=100, max_uses=3):
-    """批量生成验证码并保存到数据库"""
-    db_path = os.getenv('DATABASE_PATH', 'codes.db')
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-
-    # 创建表（如果不存在）
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS verification_codes (
-            code TEXT PRIMARY KEY,
-            max_uses INTEGER DEFAULT 3,
-            used_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'active'
-        )
-    ''')
-
-    codes = []
-    for _ in range(count):
-        code = generate_code()
-        c.execute('''
-            INSERT INTO verification_codes (code, max_uses)
-            VALUES (?, ?)
-        ''', (code, max_uses))
-        codes.append(code)
-
-    conn.commit()
-    conn.close()
-
-    return codes
+def generate_codes(count=100, max_uses=3, output='codes.txt', batch_size=bulk_codes.DEFAULT_BATCH_SIZE,
+                   database_url=None):
+    """批量生成验证码并保存到数据库，每批写入后同时写出到文件，返回前 10 个验证码和冲突次数"""
+    conn, db_type = bulk_codes.connect_database(database_url)
+    preview = []
+    written = 0
 
+    with open(output, 'w') as f:
+        def on_batch(cursor, codes):
+            nonlocal written
+            f.writelines(code + '\n' for code in codes)
+            preview.extend(codes[:10 - len(preview)])
+            written += len(codes)
+            print(f"   已生成 {written}/{count}", end='\r', flush=True)
 
-def export_to_file(codes, filename='codes.txt'):
-    """导出验证码到文件"""
-    with open(filename, 'w') as f:
-        for code in codes:
-            f.write(code + '\n')
-    print(f"✅ 已导出 {len(codes)} 个验证码到 {filename}")
+        try:
+            _, collisions = bulk_codes.generate_codes(conn, db_type, count, max_uses, batch_size, on_batch)
+        finally:
+            conn.close()
+    print()
+    return preview, collisions
 
 
 def main():
@@ -70,19 +49,27 @@ def main():
     parser.add_argument('--count', type=int, default=100, help='生成数量')
     parser.add_argument('--output', type=str, default='codes.txt', help='输出文件')
     parser.add_argument('--uses', type=int, default=3, help='每个验证码最大使用次数')
+    parser.add_argument('--batch-size', type=int, default=bulk_codes.DEFAULT_BATCH_SIZE, help='每批写入数量')
+    parser.add_argument('--database-url', type=str, default=None, help='PostgreSQL 连接地址（默认与应用相同）')
 
     args = parser.parse_args()
 
     print(f"🔄 正在生成 {args.count} 个验证码...")
-    codes = generate_codes(args.count, args.uses)
-    export_to_file(codes, args.output)
+    started = time.time()
+    try:
+        preview, collisions = generate_codes(args.count, args.uses, args.output, args.batch_size, args.database_url)
+    except (FileNotFoundError, RuntimeError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"✅ 已生成并导出 {args.count} 个验证码到 {args.output}"
+          f"（用时 {time.time() - started:.1f} 秒，冲突 {collisions} 次）")
 
     print("\n📋 前10个验证码预览:")
-    for code in codes[:10]:
+    for code in preview:
         print(f"   {code}")
 
-    if len(codes) > 10:
-        print(f"   ... 还有 {len(codes) - 10} 个")
+    if args.count > 10:
+        print(f"   ... 还有 {args.count - 10} 个")
 
 
 if __name__ == '__main__':
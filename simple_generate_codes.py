@@ -3,49 +3,29 @@
 Simple verification code generator
 Generates codes and displays them without requiring admin login
 """
-import os
-import sys
-import random
-import string
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Import database functions
-import sqlite3
-
-def get_db_path():
-    """Get database path"""
-    if os.getenv('RAILWAY_ENVIRONMENT') == 'production':
-        return os.path.join(os.getenv('RAILWAY_VOLUME_MOUNT_PATH', '/data'), 'codes.db')
-    return os.getenv('DATABASE_PATH', 'codes.db')
+# Shared bulk generator (same database selection as the app: PostgreSQL or SQLite)
+import bulk_codes
 
 def generate_codes(count=10, max_uses=3):
     """Generate verification codes"""
-    db_path = get_db_path()
-
-    # Check if database exists
-    if not os.path.exists(db_path):
-        print(f"⚠️  Database not found at: {db_path}")
+    try:
+        conn, db_type = bulk_codes.connect_database()
+    except FileNotFoundError as e:
+        print(f"⚠️  {e}")
         print("Please run the application first to initialize the database.")
         return []
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
     codes = []
-    for _ in range(count):
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        try:
-            cursor.execute('INSERT INTO verification_codes (code, max_uses) VALUES (?, ?)', (code, max_uses))
-            codes.append(code)
-        except sqlite3.IntegrityError:
-            # Code already exists, skip
-            continue
-
-    conn.commit()
-    conn.close()
+    try:
+        bulk_codes.generate_codes(conn, db_type, count, max_uses,
+                                  on_batch=lambda cursor, inserted: codes.extend(inserted))
+    finally:
+        conn.close()
 
     return codes
 
@@ -5,6 +5,8 @@ let currentCode = '';
 let selectedFile = null;
 let remainingCount = 0;
 let isGenerating = false;  // 标记是否正在生成
+let lastGenerationKey = null;  // 上一次成功生成的照片+选项，用于"再生成一次"时跳过服务端结果缓存
+let pendingIdempotency = null;  // 尚未成功的提交 {generationKey, key}：重复点击同一张照片+选项时沿用同一个幂等键
 
 // 页面关闭前警告（生成中）
 window.addEventListener('beforeunload', function(e) {
@@ -222,6 +224,36 @@ function handleFile(file) {
     reader.readAsDataURL(file);
 }
 
+// 生成任务最长等待时间（5分钟）
+const JOB_TIMEOUT_MS = 300000;
+
+// 轮询生成任务状态（服务端长轮询，直到完成、失败或超时）
+async function waitForJob(jobId) {
+    const deadline = Date.now() + JOB_TIMEOUT_MS;
+
+    while (Date.now() < deadline) {
+        let data;
+        try {
+            const response = await fetch(`/api/jobs/${jobId}?wait=25`);
+            data = await response.json();
+        } catch (error) {
+            // 网络抖动时稍后重试，任务仍在服务端继续执行
+            console.warn('[Job] 查询任务状态失败，稍后重试:', error);
+            await new Promise(resolve => setTimeout(resolve, 2000));
+            continue;
+        }
+
+        if (!data.success || data.status === 'done') {
+            return data;
+        }
+        if (data.status === 'failed') {
+            return { success: false, message: data.message };
+        }
+    }
+
+    throw new Error('timeout: 生成超时，图片处理需要较长时间，请稍后重试或联系客服');
+}
+
 // 生成肖像
 async function generatePortrait() {
     if (!selectedFile) {
@@ -266,22 +298,30 @@ async function generatePortrait() {
     formData.append('bgColor', bgColor);
     formData.append('beautify', beautify);
 
-    // 创建超时 Promise (150秒超时)
-    const timeoutPromise = new Promise((_, reject) => {
-        setTimeout(() => {
-            reject(new Error('timeout: 生成超时，图片处理需要较长时间，请稍后重试或联系客服'));
-        }, 150000);
-    });
+    // 同一张照片、同样的选项再次生成时，要求服务端重新生成新的结果（不使用缓存）
+    const generationKey = JSON.stringify([currentCode, selectedFile.name, selectedFile.size, selectedFile.lastModified,
+                                          clothing, angle, background, bgColor, beautify]);
+    formData.append('fresh', generationKey === lastGenerationKey ? 'yes' : 'no');
+
+    // 同一张照片+选项在成功之前重复提交（网络卡住后再次点击）沿用同一个幂等键，合并到同一个任务；
+    // 成功后或更换照片/选项时才生成新的键，"再生成一次"因此是新任务
+    if (!pendingIdempotency || pendingIdempotency.generationKey !== generationKey) {
+        pendingIdempotency = {
+            generationKey,
+            key: (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : `${Date.now()}-${Math.random().toString(36).slice(2)}`
+        };
+    }
+    const idempotencyKey = pendingIdempotency.key;
 
     try {
-        // 使用 Promise.race 实现超时控制
-        const response = await Promise.race([
-            fetch('/api/upload', {
-                method: 'POST',
-                body: formData
-            }),
-            timeoutPromise
-        ]);
+        // 提交生成任务（服务端立即返回任务 ID）
+        const response = await fetch('/api/upload', {
+            method: 'POST',
+            headers: { 'Idempotency-Key': idempotencyKey },
+            body: formData
+        });
 
         console.log('[API] 响应状态:', response.status);
         console.log('[API] 响应类型:', response.headers.get('content-type'));
@@ -298,11 +338,20 @@ async function generatePortrait() {
             return;
         }
 
-        const data = await response.json();
+        let data = await response.json();
 
         console.log('[API] 响应数据:', data);
 
+        // 等待后台任务完成
+        if (data.success && data.job_id) {
+            data = await waitForJob(data.job_id);
+            console.log('[API] 任务结果:', data);
+        }
+
         if (data.success) {
+            lastGenerationKey = generationKey;
+            pendingIdempotency = null;
+
             // 更新剩余次数
             remainingCount = data.remaining;
             remainingCountSpan.textContent = remainingCount;